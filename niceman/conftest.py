@@ -14,9 +14,26 @@
 from niceman.tests.fixtures import niceman_cfg_path
 from niceman.formats.tests.fixtures import demo1_spec, reprozip_spec2
 
+import os
+
+import mock
 import pytest
 
 
+@pytest.fixture(autouse=True, scope='session')
+def _cache_dirs(tmpdir_factory):
+    """Keep caches (e.g. of dpkg files lists and .deb files) out of the
+    user's cache directory while testing"""
+    from niceman import cfg
+    cache_dir = tmpdir_factory.mktemp('cache')
+    with mock.patch.dict(os.environ, {
+            'NICEMAN_DEBIAN_DPKG_CACHE_DIR': str(cache_dir.join('dpkg')),
+            'NICEMAN_DEBIAN_DEB_CACHE_DIR': str(cache_dir.join('debs'))}):
+        cfg.reload()
+        yield
+    cfg.reload()
+
+
 def pytest_addoption(parser):
     parser.addoption("--runslow", action="store_true",
                      default=False, help="run slow tests")
@@ -29,4 +46,4 @@ def pytest_collection_modifyitems(config, items):
     skip_slow = pytest.mark.skip(reason="need --runslow option to run")
     for item in items:
         if "slow" in item.keywords:
-            item.add_marker(skip_slow)
\ No newline at end of file
+            item.add_marker(skip_slow)
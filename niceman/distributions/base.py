@@ -11,13 +11,16 @@
 import os
 import abc
 import attr
+import bisect
 import collections
 import yaml
 
 from importlib import import_module
+from six import string_types
 from six import viewvalues
 
 from niceman.resource.session import get_local_session
+from niceman import utils
 
 import logging
 lgr = logging.getLogger('niceman.distributions')
@@ -33,6 +36,237 @@ def TypedList(type_):
     return attr.ib(default=Factory(list), metadata={'type': type_})
 
 
+def _split_path(path):
+    """Split path into its (interned) directory, or None, and name"""
+    if '/' not in path:
+        return None, path
+    dirpath, name = path.rsplit('/', 1)
+    return utils.intern_str(dirpath), name
+
+
+def _join_path(dirpath, name):
+    return name if dirpath is None else dirpath + '/' + name
+
+
+def _dir_sort_key(dirpath):
+    return dirpath is not None, dirpath or ''
+
+
+class PathList(object):
+    """Compact collection of paths of files
+
+    Tracing could associate tens of thousands of files with packages, mostly
+    sharing a few directories.  Paths are stored grouped by directory: each
+    directory is interned, so kept in memory once for all the packages, and
+    names of files within it are joined into a single string.  For existing
+    callers it behaves like a list of paths (`append`, `extend`, iteration,
+    indexing, `len`, `in`, comparison with lists), but paths are
+    deduplicated and reordered (sorted by directory).  It is not a list
+    though: `+`, `sort`, `remove` and item assignment are not supported,
+    and `attr.asdict` leaves it as it is, so it needs to be converted with
+    `list()` to be serialized e.g. into JSON.
+
+    In YAML it is represented as a trie of nested directories (see
+    `to_spec`), while a plain list of paths is still accepted (see
+    `from_spec`).
+    """
+
+    __slots__ = ('_dirs', '_keys', '_names', '_ends', '_len', '_pending',
+                 '_split')
+
+    def __init__(self, paths=()):
+        self._dirs = []  # sorted unique directories
+        self._keys = []  # _dir_sort_key of them, to bisect
+        self._names = []  # '/'-separated sorted names of files within them
+        self._ends = []  # number of files within them and preceding ones
+        self._len = 0
+        self._pending = []  # paths appended since last compaction
+        self._split = None  # (index, names) of the last directory indexed
+        self.extend(paths)
+
+    def append(self, path):
+        self._pending.append(path)
+        # compact in batches growing with the collection
+        if len(self._pending) > max(1024, self._len):
+            self._compact()
+
+    def extend(self, paths):
+        for path in paths:
+            self.append(path)
+
+    def _compact(self):
+        if not self._pending:
+            return
+        by_dir = collections.defaultdict(set)
+        for dirpath, names in zip(self._dirs, self._names):
+            by_dir[dirpath].update(names.split('/'))
+        for path in self._pending:
+            dirpath, name = _split_path(path)
+            by_dir[dirpath].add(name)
+        self._dirs = sorted(by_dir, key=_dir_sort_key)
+        self._keys = [_dir_sort_key(d) for d in self._dirs]
+        self._names = ['/'.join(sorted(by_dir[d])) for d in self._dirs]
+        self._ends = []
+        self._len = 0
+        for dirpath in self._dirs:
+            self._len += len(by_dir[dirpath])
+            self._ends.append(self._len)
+        self._pending = []
+        self._split = None
+
+    def _iter_items(self):
+        """Generate sorted unique (directory, name) pairs"""
+        self._compact()
+        for dirpath, names in zip(self._dirs, self._names):
+            for name in names.split('/'):
+                yield dirpath, name
+
+    def __contains__(self, path):
+        if not isinstance(path, string_types):
+            return False
+        self._compact()
+        dirpath, name = _split_path(path)
+        i = bisect.bisect_left(self._keys, _dir_sort_key(dirpath))
+        if i == len(self._dirs) or self._dirs[i] != dirpath:
+            return False
+        names = self._names[i]
+        return (names == name or names.startswith(name + '/')
+                or names.endswith('/' + name) or '/%s/' % name in names)
+
+    def __len__(self):
+        self._compact()
+        return self._len
+
+    def __iter__(self):
+        return (_join_path(*item) for item in self._iter_items())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        self._compact()
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("PathList index out of range")
+        i = bisect.bisect_right(self._ends, index)
+        # keep names of the directory split, for indexing in a loop
+        if self._split is None or self._split[0] != i:
+            self._split = (i, self._names[i].split('/'))
+        start = self._ends[i - 1] if i else 0
+        return _join_path(self._dirs[i], self._split[1][index - start])
+
+    def __eq__(self, other):
+        # as sets of paths: order and duplicates in lists are ignored
+        if isinstance(other, (list, tuple, set)):
+            other = PathList(other)
+        if not isinstance(other, PathList):
+            return NotImplemented
+        self._compact()
+        other._compact()
+        return self._dirs == other._dirs and self._names == other._names
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None  # mutable
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def to_spec(self):
+        """Return representation of the paths as a trie of directories
+
+        A directory is represented by a list of names of its files, followed
+        by a dict of its subdirectories (only the list or the dict if there
+        are no subdirectories or files).  Chains of directories with a single
+        subdirectory are collapsed into a single key, e.g.::
+
+          /usr:
+            bin: [afni, dcm2niix]
+            share/doc/afni:
+            - README
+            - examples: [example1]
+        """
+        # name -> None for a file, or -> dict for a directory, which has
+        # a None key if it is a file too
+        root = {}
+        for dirpath, name in self._iter_items():
+            node = root
+            for dirname in ([] if dirpath is None else dirpath.split('/')):
+                child = node.get(dirname)
+                if child is None:
+                    child = node[dirname] = \
+                        {None: None} if dirname in node else {}
+                node = child
+            if node.get(name) is None:
+                node[name] = None
+            else:
+                node[name][None] = None
+        return self._node_to_spec(root)
+
+    @classmethod
+    def _node_to_spec(cls, node):
+        files = []
+        dirs = {}
+        for name, child in node.items():
+            if name is None:
+                continue
+            if child is None or None in child:
+                files.append(name)
+            if child is None:
+                continue
+            # collapse chain of directories with a single subdirectory
+            while len(child) == 1:
+                (subname, subchild), = child.items()
+                if subname is None or subchild is None or None in subchild:
+                    break
+                name += '/' + subname
+                child = subchild
+            if len(child) > (None in child):
+                dirs[name] = cls._node_to_spec(child)
+        files.sort()
+        if not dirs:
+            return files
+        return files + [dirs] if files else dirs
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Create from a representation produced by to_spec, or from paths
+
+        Returns `spec` itself if it is already a PathList.
+        """
+        if isinstance(spec, PathList):
+            return spec
+        paths = cls()
+        paths._add_spec(spec, None)
+        return paths
+
+    def _add_spec(self, spec, prefix):
+        if spec is None:
+            if prefix is not None:
+                self.append(prefix)
+        elif isinstance(spec, string_types):
+            self.append(_join_path(prefix, spec))
+        elif isinstance(spec, dict):
+            for name, value in spec.items():
+                self._add_spec(value, _join_path(prefix, name))
+        else:
+            for item in spec:
+                self._add_spec(item, prefix)
+
+
+def FilesList(**kwargs):
+    """A helper to generate an attribute holding files (as a PathList)
+
+    Lists of paths, and nested representations loaded from YAML, get
+    converted into a PathList.  Note that a PathList compares equal to a
+    list holding the same paths in any order, or with duplicates.
+    """
+    return attr.ib(default=Factory(PathList), converter=PathList.from_spec,
+                   **kwargs)
+
+
 #
 # Models
 #
@@ -54,6 +288,11 @@ def _register_with_representer(cls):
     yaml.SafeDumper.add_representer(cls, SpecObject.yaml_representer)
 
 
+yaml.SafeDumper.add_representer(
+    PathList,
+    lambda dumper, data: dumper.represent_data(data.to_spec()))
+
+
 @attr.s
 class Package(SpecObject):
     # files used/associated with the package
@@ -154,11 +393,18 @@ class DistributionTracer(object):
     # Default to being able to handle directories
     HANDLES_DIRS = True
 
-    def __init__(self, session=None):
+    # Names of files or directories (e.g. "conda-meta") marking roots of
+    # environments, which tracer looks for within directories above files
+    ROOT_MARKERS = ()
+
+    def __init__(self, session=None, hints=None):
         # will be (re)used to run external commands, and let's hardcode LC_ALL
         # codepage just in case since we might want to comprehend error
         # messages
         self._session = session or get_local_session()
+        # what is known about the files beforehand, e.g. as gathered by the
+        # tracing agent (see retrace.run_tracing_agent)
+        self._hints = hints or {}
         # to ease _init within derived classes which should not be parametrized
         # more anyways
         self._init()
@@ -166,6 +412,18 @@ class DistributionTracer(object):
     def _init(self):
         pass
 
+    def _prefetch_within_paths(self, paths, names):
+        """Gather at once information about names within paths and parents
+
+        So tests for the presence of e.g. "conda-meta" within all the
+        directories above the paths (see PathRoot) could be done with the
+        session's stat_cache without a command per test.
+        """
+        self._session.stat_cache.prefetch(
+            '%s/%s' % (path, name)
+            for path in utils.get_path_roots_candidates(paths)
+            for name in names)
+
     @abc.abstractmethod
     def identify_distributions(self, files):
         raise NotImplementedError()
@@ -210,6 +468,8 @@ class DistributionTracer(object):
         # TODO: probably that _get_packagefields should create packagespecs
         # internally and just return them.  But we should make them hashable
         file_to_package_dict = self._get_packagefields_for_files(files)
+        stat_cache = self._session.stat_cache
+        stat_cache.prefetch(file_to_package_dict)
         for f in files:
             # Stores the file
             if f not in file_to_package_dict:
@@ -231,7 +491,7 @@ class DistributionTracer(object):
                         if pkg:
                             found_packages[pkgfields_hashable] = pkg
                             # we store only non-directories within 'files'
-                            if not self._session.isdir(f):
+                            if not stat_cache.isdir(f):
                                 pkg.files.append(f)
                             nb_pkg_files += 1
                         else:
@@ -19,6 +19,7 @@ from niceman.dochelpers import exc_str
 from niceman.utils import PathRoot, is_subpath
 
 from .base import SpecObject
+from .base import FilesList
 from .base import DistributionTracer
 from .base import Package
 from .base import TypedList
@@ -70,7 +71,7 @@ class CondaPackage(Package):
     url = attr.ib()
     location = attr.ib(default=None)
     editable = attr.ib(default=False)
-    files = attr.ib(default=attr.Factory(list))
+    files = FilesList()
 
 
 @attr.s
@@ -135,6 +136,8 @@ class CondaTracer(DistributionTracer):
     """conda distributions tracer
     """
 
+    ROOT_MARKERS = ('bin', 'envs', 'conda-meta')
+
     def _init(self):
         self._get_conda_env_path = PathRoot(self._is_conda_env_path)
         self._get_conda_root_path = PathRoot(self._is_conda_root_path)
@@ -160,12 +163,14 @@ class CondaTracer(DistributionTracer):
     def _get_conda_package_details(self, conda_path):
         packages = {}
         file_to_package_map = {}
-        for meta_file in self._get_conda_meta_files(conda_path):
+        meta_files = list(self._get_conda_meta_files(conda_path))
+        # there is a file per package, so all are read at once
+        contents = self._session.read_many(meta_files)
+        for meta_file in meta_files:
             try:
-                out, err = self._session.execute_command(
-                    'cat %s' % meta_file
-                )
-                details = json.loads(out)
+                if meta_file not in contents:
+                    raise IOError("Could not read %s" % meta_file)
+                details = json.loads(contents[meta_file])
 #                print meta_file
 #                print(json.dumps(details, indent=4))
                 if "name" in details:
@@ -247,11 +252,11 @@ class CondaTracer(DistributionTracer):
         return details
 
     def _is_conda_env_path(self, path):
-        return self._session.exists('%s/conda-meta' % path)
+        return self._session.stat_cache.exists('%s/conda-meta' % path)
 
     def _is_conda_root_path(self, path):
-        return all(map(self._session.exists, ('%s/%s' % (path, d) for d in
-                                              ('bin', 'envs', 'conda-meta'))))
+        return all(map(self._session.stat_cache.exists,
+                       ('%s/%s' % (path, d) for d in self.ROOT_MARKERS)))
 
     def identify_distributions(self, paths):
         conda_paths = set()
@@ -263,6 +268,7 @@ class CondaTracer(DistributionTracer):
         total_file_count = len(unknown_files)
 
         # First, loop through all the files and identify conda paths
+        self._prefetch_within_paths(paths, self.ROOT_MARKERS)
         for path in paths:
             conda_path = self._get_conda_env_path(path)
             if conda_path:
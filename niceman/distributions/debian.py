@@ -8,6 +8,14 @@
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Support for Debian(-based) distribution(s)."""
 import os
+import bisect
+import posixpath
+import shutil
+import gzip
+import hashlib
+import json
+import tempfile
+import weakref
 
 import itertools
 from datetime import datetime
@@ -16,9 +24,11 @@ import attr
 from collections import defaultdict
 
 from six.moves import map
+from multiprocessing.pool import ThreadPool
 
 import pytz
 
+from niceman import cfg
 from niceman import utils
 
 from email.utils import mktime_tz, parsedate_tz
@@ -30,7 +40,13 @@ import requests
 from niceman.support.distributions.debian import \
     parse_apt_cache_show_pkgs_output, parse_apt_cache_policy_pkgs_output, \
     parse_apt_cache_policy_source_info, get_apt_release_file_names, \
-    get_spec_from_release_file
+    get_spec_from_release_fields, get_release_files_headers, \
+    parse_dpkg_list_files_output, \
+    parse_dpkg_query_output, get_installed_pkgs_from_dpkg_status, \
+    get_apt_lists_index, get_apt_packages_list_name, \
+    DPKG_STATUS_FILE, DPKG_INFO_DIR, DPKG_QUERY_FORMAT, \
+    APT_LISTS_DUMP_SCRIPT, APT_RELEASE_HEADERS_DUMP_SCRIPT, \
+    parse_depends_field, order_by_dependencies
 
 # Pick a conservative max command-line
 from niceman.utils import get_cmd_batch_len, execute_command_batch, \
@@ -46,53 +62,110 @@ from niceman.distributions.base import DistributionTracer
 
 lgr = logging.getLogger('niceman.distributions.debian')
 
+# How many states of dpkg databases (e.g. of different hosts) to keep in cache
+_DPKG_CACHE_MAX_ENTRIES = 8
+
+# Dates of apt release files already looked up within a session (see
+# _get_session_memo), so they are not fetched again by tracers created for
+# the same session
+_RELEASE_DATES_MEMO = {}
+
+# Where DebianDistribution.install_packages records its progress in a session
+_APT_INSTALL_STATE_FILE = '/var/lib/niceman/apt-install.json'
+
+# Where apt keeps downloaded .deb files
+_APT_ARCHIVES_DIR = '/var/cache/apt/archives'
+
+# Downloads .deb files of packages into the apt cache, so apt-get install
+# does not need to fetch them again
+_APT_DOWNLOAD_COMMAND = [
+    'sh', '-c', 'cd %s && exec apt-get download "$@"' % _APT_ARCHIVES_DIR,
+    'sh']
+
+# Fields of apt-cache show records used to describe packages (see
+# _update_pkg_details)
+_APT_CACHE_SHOW_FIELDS = ("package", "architecture", "version", "source",
+                          "size", "md5sum", "sha1", "sha256")
+
 from .base import SpecObject
+from .base import FilesList
 from .base import Package
 from .base import Distribution
 from .base import TypedList
 from .base import _register_with_representer
-from ..support.exceptions import CommandError
+from ..dochelpers import exc_str
+from ..support.exceptions import CommandError, SessionRuntimeError
 #
 # Models
 #
 
-# TODO: flyweight/singleton ?
-# To make them hashable we need to freeze them... not sure if we are ready:
-#@attr.s(cmp=True, hash=True, frozen=True)
-@attr.s(cmp=True)
+
+def _intern_versions(versions):
+    """Intern versions and names of their sources of DEBPackage.versions"""
+    if not versions:
+        return versions
+    return {utils.intern_str(version): [utils.intern_str(s) for s in sources]
+            for version, sources in versions.items()}
+
+
+def _str_attr(**kwargs):
+    """Attribute holding a string, equal ones of which are shared"""
+    return attr.ib(converter=utils.intern_str, **kwargs)
+
+
+@attr.s(cmp=True, hash=True, frozen=True)
 class APTSource(SpecObject):
     """APT origin information
+
+    Instances are immutable, and equal ones could be shared (see
+    intern_apt_source).
     """
-    name = attr.ib()
-    component = attr.ib(default=None)
-    archive = attr.ib(default=None)
-    architecture = attr.ib(default=None)
-    codename = attr.ib(default=None)
-    origin = attr.ib(default=None)
-    label = attr.ib(default=None)
-    site = attr.ib(default=None)
-    archive_uri = attr.ib(default=None)
-    date = attr.ib(default=None)
+    name = _str_attr()
+    component = _str_attr(default=None)
+    archive = _str_attr(default=None)
+    architecture = _str_attr(default=None)
+    codename = _str_attr(default=None)
+    origin = _str_attr(default=None)
+    label = _str_attr(default=None)
+    site = _str_attr(default=None)
+    archive_uri = _str_attr(default=None)
+    date = _str_attr(default=None)
 _register_with_representer(APTSource)
 
+# APTSource instances in use, by their fields (see intern_apt_source)
+_APT_SOURCES = weakref.WeakValueDictionary()
+
+
+def intern_apt_source(source):
+    """Return the APTSource instance equal to `source` already in use
+
+    or `source` itself if there is none yet.
+    """
+    return _APT_SOURCES.setdefault(attr.astuple(source), source)
+
 
 @attr.s(slots=True, frozen=True, cmp=False, hash=True)
 class DEBPackage(Package):
-    """Debian package information"""
-    name = attr.ib()
+    """Debian package information
+
+    Strings which are likely to be repeated among packages (versions,
+    architectures, names of sources, ...) are interned.
+    """
+    name = _str_attr()
     # Optional
-    upstream_name = attr.ib(default=None)
-    version = attr.ib(default=None)
-    architecture = attr.ib(default=None)
-    source_name = attr.ib(default=None, hash=False)
-    source_version = attr.ib(default=None, hash=False)
+    upstream_name = _str_attr(default=None)
+    version = _str_attr(default=None)
+    architecture = _str_attr(default=None)
+    source_name = _str_attr(default=None, hash=False)
+    source_version = _str_attr(default=None, hash=False)
     size = attr.ib(default=None, hash=False)
     md5 = attr.ib(default=None, hash=False)
     sha1 = attr.ib(default=None, hash=False)
     sha256 = attr.ib(default=None, hash=False)
-    versions = attr.ib(default=None, hash=False)  # Hash ver_str -> [Array of source names]
+    versions = attr.ib(default=None, hash=False,
+                       converter=_intern_versions)  # Hash ver_str -> [Array of source names]
     install_date = attr.ib(default=None, hash=False)
-    files = attr.ib(default=attr.Factory(list), hash=False)
+    files = FilesList(hash=False)
 
     def satisfies(self, other):
         """return True if this package (self) satisfies the requirements of 
@@ -112,6 +185,343 @@ class DEBPackage(Package):
 
 _register_with_representer(DEBPackage)
 
+# Hosts of the snapshot archives of the origins of apt sources
+_SNAPSHOT_SITES = {
+    'Debian': 'snapshot.debian.org',
+    'NeuroDebian': 'snapshot-neuro.debian.net:5002',
+}
+
+# Format of timestamps of snapshots in their URLs
+_SNAPSHOT_TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+_RE_SNAPSHOT_NEXT_CHANGE = re.compile(
+    r'<a href="/archive/\w*debian/(\w+)/dists/\w+/">next change</a>')
+
+
+@attr.s(frozen=True)
+class SnapshotQuery(object):
+    """Lookup of the snapshot following `timestamp` of `codename` dists"""
+    site = attr.ib()
+    archive = attr.ib()
+    timestamp = attr.ib()
+    codename = attr.ib()
+
+    @property
+    def index_key(self):
+        return "/".join((self.site, self.archive, self.codename))
+
+    @property
+    def url(self):
+        return 'http://{}/archive/{}/{}/dists/{}/'.format(
+            self.site, self.archive, self.timestamp, self.codename)
+
+
+class SnapshotResolver(object):
+    """Base class for resolvers of the next changes of snapshot archives
+
+    Resolvers can be chained: queries a resolver knows nothing about are
+    passed to the `fallback` one.
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+
+    def get_next_changes(self, queries):
+        """Resolve timestamps of the next changes for all the queries at once
+
+        Parameters
+        ----------
+        queries : iterable of SnapshotQuery
+
+        Returns
+        -------
+        dict
+          SnapshotQuery -> timestamp of the next change, or None if there is
+          none (or it could not be determined).
+        """
+        queries = set(queries)
+        changes = self._get_next_changes(queries) if queries else {}
+        missing = [q for q in queries if q not in changes]
+        if missing and self.fallback:
+            changes.update(self.fallback.get_next_changes(missing))
+        for query in missing:
+            changes.setdefault(query, None)
+        return changes
+
+    def _get_next_changes(self, queries):
+        """Return next changes for the queries known to this resolver"""
+        raise NotImplementedError
+
+
+class SnapshotIndexResolver(SnapshotResolver):
+    """Resolve next changes offline from an index of snapshot timestamps
+
+    The index is a JSON file mapping "site/archive/codename" (e.g.
+    "snapshot.debian.org/debian/sid") to the list of timestamps of the
+    snapshots in which the dists of that codename changed. It could be
+    produced from a local mirror of the snapshot archive or be a fixture.
+    """
+
+    def __init__(self, index, fallback=None):
+        super(SnapshotIndexResolver, self).__init__(fallback=fallback)
+        if isinstance(index, dict):
+            self.path = None
+        else:
+            self.path = index
+            with open(index) as f:
+                index = json.load(f)
+        self._index = {key: sorted(timestamps)
+                       for key, timestamps in index.items()}
+
+    def add(self, site, archive, codename, timestamps):
+        """Add timestamps of changes of `codename` dists to the index"""
+        key = "/".join((site, archive, codename))
+        self._index[key] = sorted(set(self._index.get(key, [])) |
+                                  set(timestamps))
+
+    def save(self, path=None):
+        path = path or self.path
+        utils.assure_dir(os.path.dirname(os.path.abspath(path)))
+        with open(path, 'w') as f:
+            json.dump(self._index, f, indent=1, sort_keys=True)
+
+    def _get_next_changes(self, queries):
+        changes = {}
+        for query in queries:
+            timestamps = self._index.get(query.index_key)
+            if timestamps is None:
+                continue
+            # all timestamps are of the same format, so compare as strings
+            i = bisect.bisect_right(timestamps, query.timestamp)
+            changes[query] = timestamps[i] if i < len(timestamps) else None
+        return changes
+
+
+class SnapshotWebResolver(SnapshotResolver):
+    """Resolve next changes from the "next change" links of snapshot pages
+
+    Pages are fetched concurrently with a `timeout`, and the results are
+    kept in memory and, if `cache` file is given, across runs. Failed
+    lookups are not cached.
+    """
+
+    def __init__(self, timeout=10, jobs=4, cache=None, fallback=None):
+        super(SnapshotWebResolver, self).__init__(fallback=fallback)
+        self.timeout = timeout
+        self.jobs = jobs
+        self.cache = cache
+        self._changes = {}
+        if cache and os.path.exists(cache):
+            try:
+                with open(cache) as f:
+                    self._changes = json.load(f)
+            except (IOError, OSError, ValueError) as exc:
+                lgr.debug("Failed to load snapshots cache %s: %s",
+                          cache, exc_str(exc))
+
+    def _fetch(self, url):
+        try:
+            r = requests.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as exc:
+            lgr.warning("Failed to fetch snapshot page %s: %s",
+                        url, exc_str(exc))
+            return url, False, None
+        m = _RE_SNAPSHOT_NEXT_CHANGE.search(r.text)
+        return url, True, m.group(1) if m else None
+
+    def _get_next_changes(self, queries):
+        urls = set(q.url for q in queries) - set(self._changes)
+        if urls:
+            if self.jobs > 1 and len(urls) > 1:
+                pool = ThreadPool(min(self.jobs, len(urls)))
+                try:
+                    results = pool.map(self._fetch, sorted(urls))
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                results = [self._fetch(url) for url in sorted(urls)]
+            fetched = {url: change for url, ok, change in results if ok}
+            self._changes.update(fetched)
+            if fetched and self.cache:
+                self._save_cache()
+        return {q: self._changes[q.url] for q in queries
+                if q.url in self._changes}
+
+    def _save_cache(self):
+        try:
+            utils.assure_dir(os.path.dirname(os.path.abspath(self.cache)))
+            tmp_file = self.cache + '.%d.tmp' % os.getpid()
+            with open(tmp_file, 'w') as f:
+                json.dump(self._changes, f, indent=1, sort_keys=True)
+            os.rename(tmp_file, self.cache)
+        except (IOError, OSError) as exc:
+            lgr.debug("Failed to save snapshots cache %s: %s",
+                      self.cache, exc_str(exc))
+
+
+def get_snapshot_resolver():
+    """Return resolver of snapshot changes as configured
+
+    Configuration options (section "debian"):
+
+    - "snapshot index": JSON index of snapshots timestamps to consult first
+      (see SnapshotIndexResolver)
+    - "snapshot online": whether to fetch pages of snapshot sites (default
+      True)
+    - "snapshot timeout": timeout of fetching a page in seconds (default 10)
+    - "snapshot cache": file to keep results of fetched pages in
+    """
+    resolver = None
+    if cfg.getboolean('debian', 'snapshot online', default=True):
+        cache = cfg.get('debian', 'snapshot cache')
+        resolver = SnapshotWebResolver(
+            timeout=cfg.get_as_dtype('debian', 'snapshot timeout', float,
+                                     default=10),
+            cache=os.path.expanduser(cache) if cache else None)
+    index = cfg.get('debian', 'snapshot index')
+    if index:
+        resolver = SnapshotIndexResolver(os.path.expanduser(index),
+                                         fallback=resolver)
+    return resolver or SnapshotIndexResolver({})
+
+
+def get_deb_filename(package):
+    """Return name of the .deb file of a package as apt stores it
+
+    E.g. "libc6_2.19-18+deb8u4_amd64.deb", or None if the version or
+    architecture of the package is not known.
+    """
+    if not (package.version and package.architecture):
+        return None
+    return "%s_%s_%s.deb" % (package.name,
+                             package.version.replace(':', '%3a'),
+                             package.architecture)
+
+
+class DebCache(object):
+    """Host-side cache of .deb files addressed by their content
+
+    Files are stored as <sha256>.deb (or md5-<md5>.deb if only MD5 of a
+    package is known), so they are shared by all the packages, resources
+    and specs.  Least recently used files are removed once the cache grows
+    over `max_size` bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def _get_hash(package):
+        if package.sha256:
+            return 'sha256', package.sha256
+        if package.md5:
+            return 'md5', package.md5
+        return None, None
+
+    @classmethod
+    def is_cacheable(cls, package):
+        """Whether .deb file of a package could be cached"""
+        return bool(get_deb_filename(package) and cls._get_hash(package)[1])
+
+    def _get_file(self, package):
+        algorithm, digest = self._get_hash(package)
+        name = digest if algorithm == 'sha256' else 'md5-' + digest
+        return os.path.join(self.path, name + '.deb')
+
+    def get(self, package):
+        """Return path to the cached .deb file of a package, or None"""
+        if not self.is_cacheable(package):
+            return None
+        path = self._get_file(package)
+        if not os.path.exists(path):
+            return None
+        # mark as recently used
+        os.utime(path, None)
+        return path
+
+    def add(self, package, filename):
+        """Add .deb file of a package to the cache
+
+        The file is cached only if its content matches the hash recorded for
+        the package.
+
+        Returns
+        -------
+        bool
+          Whether the file was cached
+        """
+        if not self.is_cacheable(package):
+            return False
+        path = self._get_file(package)
+        algorithm, digest = self._get_hash(package)
+        file_hash = hashlib.new(algorithm)
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(block)
+        if file_hash.hexdigest() != digest:
+            lgr.debug("Not caching %s: its %s does not match %s",
+                      filename, algorithm, package)
+            return False
+        utils.assure_dir(self.path)
+        # copy under a temporary name first so concurrent runs never see
+        # partially written files
+        tmp_file = path + '.%d.tmp' % os.getpid()
+        shutil.copyfile(filename, tmp_file)
+        os.rename(tmp_file, path)
+        return True
+
+    def prune(self):
+        """Remove least recently used files over the size limit"""
+        if not os.path.isdir(self.path):
+            return
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.deb'):
+                st = os.stat(os.path.join(self.path, name))
+                files.append((st.st_mtime, st.st_size, name))
+        size = sum(f[1] for f in files)
+        for _, file_size, name in sorted(files):
+            if size <= self.max_size:
+                break
+            lgr.debug("Removing %s from the cache of .deb files", name)
+            os.unlink(os.path.join(self.path, name))
+            size -= file_size
+
+
+def get_deb_cache():
+    """Return cache of .deb files as configured, or None if disabled
+
+    Configuration options (section "debian"):
+
+    - "deb cache": whether to cache .deb files (default True)
+    - "deb cache dir": where to cache them
+    - "deb cache size": size limit of the cache in MB (default 2048)
+    """
+    if not cfg.getboolean('debian', 'deb cache', default=True):
+        return None
+    return DebCache(
+        cfg.getpath('debian', 'deb cache dir',
+                    default=os.path.join(cfg.dirs.user_cache_dir, 'debs')),
+        int(cfg.get_as_dtype('debian', 'deb cache size', float,
+                             default=2048) * 1024 * 1024))
+
+
+def _put_content(session, content, path):
+    """Write `content` into the file at `path` of the session"""
+    fd, tmp_file = tempfile.mkstemp(
+        **utils.get_tempfile_kwargs(prefix=os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        # readable by everyone as any file under /etc/apt or /var/lib
+        os.chmod(tmp_file, 0o644)
+        session.put(tmp_file, path)
+    finally:
+        os.unlink(tmp_file)
+
+
 @attr.s
 class DebianDistribution(Distribution):
     """
@@ -139,7 +549,8 @@ class DebianDistribution(Distribution):
         # session.set_env(DEBIAN_FRONTEND='noninteractive', this_session_only=True)
 
     def _init_apt_sources(self, session,
-        apt_source_file='/etc/apt/sources.list.d/niceman.sources.list'):
+        apt_source_file='/etc/apt/sources.list.d/niceman.sources.list',
+        resolver=None):
         """
         Update /etc/apt/sources if necessary based on source date.
 
@@ -147,116 +558,248 @@ class DebianDistribution(Distribution):
         ----------
         session : Session object
         apt_source_file: string
+        resolver: SnapshotResolver, optional
+          To find the snapshots following the ones of the sources.  By
+          default the one returned by get_snapshot_resolver is used.
         """
 
-        repo_info = {
-            'Debian': {
-                'url': 'snapshot.debian.org',
-                'keyserver': None,
-                'key': None
-            },
-            'NeuroDebian': {
-                'url': 'snapshot-neuro.debian.net:5002',
-                'keyserver': 'hkp://pool.sks-keyservers.net:80',
-                'key': '0xA5D32F012649A5A9'
-            }
+        repo_keys = {
+            'NeuroDebian': ('hkp://pool.sks-keyservers.net:80',
+                            '0xA5D32F012649A5A9')
         }
 
-        # Create a new apt sources file if needed.
-        if not session.exists(apt_source_file):
-            session.execute_command(
-                "sh -c 'echo \"# Niceman repo sources\" > {}'"
-                .format(apt_source_file))
-
-        for source in [s for s in self.apt_sources
-            if s.origin in repo_info.keys()]:
-            
-            # Write snapshot repo to apt sources file.
+        queries = []
+        for source in self.apt_sources:
+            if source.origin not in _SNAPSHOT_SITES:
+                continue
+            if not source.date:
+                lgr.warning("No date is known for apt source %s, "
+                            "not adding its snapshot", source.name)
+                continue
             date = datetime.strptime(source.date.split('+')[0], "%Y-%m-%d %X")
-            template = 'deb http://{}/archive/{}/{}/ {} main contrib non-free'
-            source_line = template.format(
-                repo_info[source.origin]['url'],
-                source.origin.lower(),
-                date.strftime("%Y%m%dT%H%M%SZ"),
-                source.codename
-            )
-            self._write_apt_sources(session, apt_source_file, source_line)
-
-            # Write "next" snapshot repo to apt sources file.
-            template_list_page = 'http://{}/archive/{}/{}/dists/{}/'
-            url = template_list_page.format(
-                repo_info[source.origin]['url'],
-                source.origin.lower(),
-                date.strftime("%Y%m%dT%H%M%SZ"),
-                source.codename
-            )
-            r = requests.get(url)
-            m = re.search(
-                '<a href="/archive/\w*debian/(\w+)/dists/\w+/">next change</a>',
-                r.text)
-            if m:
-                source_line = template.format(
-                    repo_info[source.origin]['url'],
-                    source.origin.lower(),
-                    m.group(1),
-                    source.codename
-                )
-                self._write_apt_sources(session, apt_source_file, source_line)
-
-            # Add keyserver if needed.
-            if repo_info[source.origin]['keyserver']:
+            queries.append((source, SnapshotQuery(
+                site=_SNAPSHOT_SITES[source.origin],
+                archive=source.origin.lower(),
+                timestamp=date.strftime(_SNAPSHOT_TIMESTAMP_FORMAT),
+                codename=source.codename)))
+
+        # Look up "next" snapshots of all sources at once
+        if resolver is None:
+            resolver = get_snapshot_resolver()
+        next_changes = resolver.get_next_changes(q for _, q in queries)
+
+        # Write snapshot repos and the "next" ones to apt sources file.
+        template = 'deb http://{}/archive/{}/{}/ {} main contrib non-free'
+        source_lines = [
+            template.format(query.site, query.archive, timestamp,
+                            query.codename)
+            for _, query in queries
+            for timestamp in (query.timestamp, next_changes[query])
+            if timestamp]
+        self._write_apt_sources(session, apt_source_file, source_lines)
+
+        # Add keyservers if needed.
+        for origin in sorted(set(source.origin for source, _ in queries)):
+            if origin in repo_keys:
+                keyserver, key = repo_keys[origin]
                 session.execute_command(['apt-key', 'adv', '--recv-keys',
-                    '--keyserver', repo_info[source.origin]['keyserver'],
-                    repo_info[source.origin]['key']])
+                    '--keyserver', keyserver, key])
 
-    def _write_apt_sources(self, session, apt_source_file, source_line):
+    def _write_apt_sources(self, session, apt_source_file, source_lines):
         """
-        Write a line to the /etc/apt/sources.d/ file
+        Add lines missing from the /etc/apt/sources.d/ file
+
+        The file is read once, and if any line is missing, its new content
+        is written back at once (the file is created if needed).
 
         Parameters
         ----------
         session : Session object
         apt_source_file: string
-        source_line: string
+        source_lines: list of string
         """
-        command = "grep -q '{}' {}"
-        out, line_not_found = session.execute_command(command.format(
-            source_line, apt_source_file))
-        if line_not_found:
-            lgr.debug("Adding line '{}' to {}".format(source_line,
-                apt_source_file))
-            session.execute_command("sh -c 'echo {} >> {}'".format(
-                source_line, apt_source_file))
-
-    def install_packages(self, session, use_version=True):
+        if session.exists(apt_source_file):
+            content = session.read(apt_source_file)
+        else:
+            content = "# Niceman repo sources\n"
+        present = set(line.strip() for line in content.splitlines())
+        new_lines = []
+        for source_line in source_lines:
+            if source_line not in present:
+                lgr.debug("Adding line '{}' to {}".format(source_line,
+                    apt_source_file))
+                present.add(source_line)
+                new_lines.append(source_line)
+        if not new_lines and content.endswith("\n"):
+            return
+        if content and not content.endswith("\n"):
+            content += "\n"
+        content += "".join(line + "\n" for line in new_lines)
+        _put_content(session, content, apt_source_file)
+
+    def install_packages(self, session, use_version=True,
+                         state_file=_APT_INSTALL_STATE_FILE):
         """
         Install the packages associated to this distribution by the provenance
         into the environment.
 
+        .deb files of all the packages are downloaded first (concurrently if
+        the session allows, see execute_command_batch), so an unsatisfiable
+        versioned spec fails the installation before anything gets
+        installed.  Files of packages with known versions and hashes are
+        taken from and added to the host-side cache (see get_deb_cache).
+        Packages are then installed in chunks fitting the command line, with
+        dependencies in the earlier chunks.  Progress is recorded in
+        `state_file` of the session, so that an interrupted installation of
+        the same packages resumes where it stopped.
+
         Parameters
         ----------
         session : object
         use_version : bool, optional
           Use version information if provided.
           TODO: support outside or deprecate
-            
+        state_file : str, optional
+          Path to the file in the session to record progress in.
         """
         package_specs = []
+        versioned = []  # packages of which .deb files could be cached
 
         for package in self.packages:
             package_spec = package.name
             if use_version and package.version:
                 package_spec += '=%s' % package.version
+                versioned.append(package)
             package_specs.append(package_spec)
 
-        # Doing in one shot to fail early if any of the versioned specs
-        # couldn't be satisfied
-        lgr.debug("Installing %s", ', '.join(package_specs))
-        session.execute_command(
-            # TODO: Pull env out of provenance for this command.
-            ['apt-get', 'install', '-y'] + package_specs,
-            # env={'DEBIAN_FRONTEND': 'noninteractive'}
-        )
+        if not package_specs:
+            return
+
+        state = self._load_install_state(session, state_file, package_specs)
+        if not state['downloaded']:
+            deb_cache = get_deb_cache() if versioned else None
+            cached = self._put_cached_debs(session, deb_cache, versioned) \
+                if deb_cache else set()
+            to_download = [spec for spec in package_specs
+                           if spec not in cached]
+            lgr.debug("Downloading %d packages (%d found in cache)",
+                      len(to_download), len(package_specs) - len(to_download))
+            for _ in execute_command_batch(
+                    session, _APT_DOWNLOAD_COMMAND, to_download):
+                pass
+            if deb_cache:
+                self._cache_debs(
+                    session, deb_cache,
+                    [p for p in versioned
+                     if '%s=%s' % (p.name, p.version) not in cached])
+            state['downloaded'] = True
+            self._save_install_state(session, state_file, state)
+
+        installed = set(state['installed'])
+        pending = [spec for spec in package_specs if spec not in installed]
+        # TODO: Pull env out of provenance for this command.
+        command = ['apt-get', 'install', '-y']
+        chunk_len = get_cmd_batch_len(
+            package_specs, sum(map(len, command)) + len(command))
+        if len(pending) > chunk_len:
+            # apt would install dependencies from later chunks at their
+            # candidate versions, so get them installed first
+            pending = self._order_by_dependencies(session, pending)
+        for i in range(0, len(pending), chunk_len):
+            chunk = pending[i:i + chunk_len]
+            lgr.debug("Installing %s", ', '.join(chunk))
+            session.execute_command(command + chunk)
+            if i + chunk_len < len(pending):
+                state['installed'].extend(chunk)
+                self._save_install_state(session, state_file, state)
+        session.execute_command(['rm', '-f', state_file])
+
+    @staticmethod
+    def _put_cached_debs(session, deb_cache, packages):
+        """Put cached .deb files of packages into the apt cache of the session
+
+        Returns
+        -------
+        set
+          Specs (name=version) of the packages put into the session
+        """
+        cached = set()
+        paths = []
+        for package in packages:
+            path = deb_cache.get(package)
+            if path:
+                paths.append((path, posixpath.join(_APT_ARCHIVES_DIR,
+                                                   get_deb_filename(package))))
+                cached.add('%s=%s' % (package.name, package.version))
+        if paths:
+            session.put_many(paths)
+        return cached
+
+    @staticmethod
+    def _cache_debs(session, deb_cache, packages):
+        """Add .deb files downloaded into the session to the cache"""
+        packages = [p for p in packages if deb_cache.is_cacheable(p)]
+        if not packages:
+            return
+        tmp_dir = tempfile.mkdtemp(**utils.get_tempfile_kwargs(prefix='deb'))
+        try:
+            tmp_files = [os.path.join(tmp_dir, get_deb_filename(package))
+                         for package in packages]
+            try:
+                # files which could be gotten are there, even if it failed
+                session.get_many(
+                    (posixpath.join(_APT_ARCHIVES_DIR,
+                                    get_deb_filename(package)), tmp_file)
+                    for package, tmp_file in zip(packages, tmp_files))
+            except Exception as exc:
+                lgr.debug("Failed to get some of .deb files: %s",
+                          exc_str(exc))
+            added = False
+            for package, tmp_file in zip(packages, tmp_files):
+                if os.path.exists(tmp_file):
+                    added = deb_cache.add(package, tmp_file) or added
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if added:
+            deb_cache.prune()
+
+    @staticmethod
+    def _load_install_state(session, state_file, package_specs):
+        """Return progress of installation of `package_specs` in the session
+        """
+        signature = hashlib.sha1(utils.to_binarystring(
+            "\n".join(sorted(package_specs)))).hexdigest()
+        if session.exists(state_file):
+            try:
+                state = json.loads(session.read(state_file))
+                if state.get('signature') == signature:
+                    lgr.info("Resuming installation of packages: %d of %d "
+                             "installed", len(state['installed']),
+                             len(package_specs))
+                    return state
+            except ValueError as exc:
+                lgr.debug("Ignoring invalid %s: %s", state_file, exc_str(exc))
+        return {'signature': signature, 'downloaded': False, 'installed': []}
+
+    @staticmethod
+    def _save_install_state(session, state_file, state):
+        _put_content(session, json.dumps(state), state_file)
+
+    @staticmethod
+    def _order_by_dependencies(session, package_specs):
+        """Order specs of packages so their dependencies come first"""
+        specs = {spec.split('=', 1)[0]: spec for spec in package_specs}
+        depends = defaultdict(set)
+        for out, _, _ in execute_command_batch(
+                session, ['apt-cache', 'show'], package_specs):
+            for pkg in parse_apt_cache_show_pkgs_output(
+                    out, ("depends", "pre-depends")):
+                for field in ("depends", "pre-depends"):
+                    if field in pkg:
+                        depends[pkg["package"]] |= \
+                            parse_depends_field(pkg[field])
+        return [specs[name] for name in
+                order_by_dependencies(list(specs), depends)]
 
     def normalize(self):
         # TODO:
@@ -265,6 +808,37 @@ class DebianDistribution(Distribution):
         #   would make us require supporting flexible typing -- string or a list
         pass
 
+    def _get_packages_index(self):
+        """Return packages indexed by name and by (name, architecture)
+
+        The index is rebuilt whenever the list of packages was replaced or
+        modified in place, which is checked by identity of the packages
+        (they are immutable, and Package.__eq__ does not tell them apart).
+        """
+        # packages are kept referenced by the index, so their ids are not
+        # reused while it exists
+        ids = tuple(map(id, self.packages))
+        index = getattr(self, '_packages_index', None)
+        if index is None or index[0] != ids:
+            by_name = defaultdict(list)
+            by_name_arch = defaultdict(list)
+            for p in self.packages:
+                by_name[p.name].append(p)
+                by_name_arch[(p.name, p.architecture)].append(p)
+            index = self._packages_index = (
+                ids, tuple(self.packages), by_name, by_name_arch)
+        return index[2:]
+
+    @staticmethod
+    def _satisfies_package(index, package):
+        by_name, by_name_arch = index
+        if package.architecture is None:
+            candidates = by_name.get(package.name, ())
+        else:
+            candidates = by_name_arch.get(
+                (package.name, package.architecture), ())
+        return any(p.satisfies(package) for p in candidates)
+
     def satisfies_package(self, package):
         """return True if this distribution (self) satisfies the requirements 
         of the passed package"""
@@ -272,7 +846,7 @@ class DebianDistribution(Distribution):
             raise TypeError('satisfies_package() requires a package argument')
         if not isinstance(package, DEBPackage):
             return False
-        return any([ p.satisfies(package) for p in self.packages ])
+        return self._satisfies_package(self._get_packages_index(), package)
 
     def satisfies(self, other):
         """return True if this distribution (self) satisfies the requirements 
@@ -281,24 +855,109 @@ class DebianDistribution(Distribution):
             raise TypeError('satisfies() requires a distribution argument')
         if not isinstance(other, DebianDistribution):
             return False
-        return all(map(self.satisfies_package, other.packages))
+        index = self._get_packages_index()
+        return all(self._satisfies_package(index, p) for p in other.packages)
 
     def __sub__(self, other):
         # the semantics of distribution subtraction are, for d1 - d2:
         #     what is specified in d1 that is not specified in d2
         #     or how does d2 fall short of d1
         #     or what is in d1 that isn't satisfied by d2
-        return [ p for p in self.packages if not other.satisfies_package(p) ]
+        if not isinstance(other, DebianDistribution):
+            return [p for p in self.packages
+                    if not other.satisfies_package(p)]
+        index = other._get_packages_index()
+        return [p for p in self.packages
+                if not other._satisfies_package(index, p)]
 
     # to grow:
     #  def __iadd__(self, another_instance or DEBPackage, or APTSource)
     #  def __add__(self, another_instance or DEBPackage, or APTSource)
-    # but for the checks we should get away from a plain "list of" to some
-    # structure to help identify on presence
 
 _register_with_representer(DebianDistribution)
 
 
+def _get_session_memo(memo, session):
+    """Return a dict to memoize values for the session in the `memo`
+
+    Sessions are not necessarily hashable, so they are identified by id,
+    and a weak reference is kept to not confuse a new session with a
+    former one.
+    """
+    for key in [k for k, (ref, _) in memo.items() if ref() is None]:
+        del memo[key]  # sessions which are gone
+    ref, values = memo.get(id(session), (None, None))
+    if ref is None or ref() is not session:
+        ref, values = memo[id(session)] = (weakref.ref(session), {})
+    return values
+
+
+def _get_dpkg_pkgfields(pkg):
+    """Return package fields for a package as dpkg names it (name[:arch])"""
+    name, _, architecture = pkg.partition(':')
+    pkgfields = {'name': name}
+    if architecture:
+        pkgfields['architecture'] = architecture
+    return pkgfields
+
+
+def _get_dpkg_cache_dir():
+    return cfg.getpath('debian', 'dpkg cache dir',
+                       default=os.path.join(cfg.dirs.user_cache_dir, 'dpkg'))
+
+
+def _get_dpkg_cache_file(signature):
+    return os.path.join(
+        _get_dpkg_cache_dir(),
+        'files-%s.json.gz'
+        % hashlib.sha1(utils.to_binarystring(signature)).hexdigest())
+
+
+def _load_dpkg_files_cache(signature):
+    """Load files lists of dpkg packages cached for the database `signature`
+
+    Returns None if nothing was cached (or cache is not usable)
+    """
+    cache_file = _get_dpkg_cache_file(signature)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with gzip.open(cache_file, 'rb') as f:
+            cached = json.loads(utils.to_unicode(f.read(), "utf-8"))
+    except (IOError, OSError, ValueError) as exc:
+        lgr.debug("Failed to load dpkg cache %s: %s", cache_file, exc_str(exc))
+        return None
+    if cached.get('signature') != signature:
+        return None
+    return cached['packages']
+
+
+def _save_dpkg_files_cache(signature, pkg_files):
+    """Cache files lists of dpkg packages for the database `signature`
+
+    Only _DPKG_CACHE_MAX_ENTRIES most recently saved entries are kept.
+    """
+    cache_file = _get_dpkg_cache_file(signature)
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        utils.assure_dir(cache_dir)
+        # write into a temporary file first so concurrent runs never see
+        # partially written cache
+        tmp_file = cache_file + '.%d.tmp' % os.getpid()
+        with gzip.open(tmp_file, 'wb') as f:
+            f.write(utils.to_binarystring(
+                json.dumps({'signature': signature, 'packages': pkg_files})))
+        os.rename(tmp_file, cache_file)
+        cache_files = sorted(
+            (os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+             if f.startswith('files-') and f.endswith('.json.gz')),
+            key=os.path.getmtime, reverse=True)
+        for f in cache_files[_DPKG_CACHE_MAX_ENTRIES:]:
+            os.unlink(f)
+    except (IOError, OSError) as exc:
+        lgr.debug("Failed to save dpkg cache %s: %s", cache_file, exc_str(exc))
+
+
 class DebTracer(DistributionTracer):
     """.deb-based (and using apt and dpkg) systems package tracer
     """
@@ -314,25 +973,33 @@ class DebTracer(DistributionTracer):
         self._apt_source_names = set()
         self._all_apt_sources = {}
         self._source_line_to_name_map = {}
+        self._dpkg_file_index = None  # path -> package fields, built once
+        self._apt_lists_index = None  # (list files, index) of apt lists
 
     def identify_distributions(self, files):
         if not files:
             return
-        
-        try:
-            debian_version = self._session.read('/etc/debian_version').strip()
-            self._session.exists('/etc/os-release')
-            # for now would also match Ubuntu -- there it would have
-            # ID=ubuntu and ID_LIKE=debian
-            # TODO: load/parse /etc/os-release into a dict and better use
-            # VERSION_ID and then ID (to decide if Debian or Ubuntu or ...)
-            _, _ = self._session.execute_command('grep -i "^ID.*=debian"'
-                                                     ' /etc/os-release')
-            _, _ = self._session.execute_command('ls -ld /etc/apt')
-        except CommandError as exc:
-            lgr.debug("Did not detect Debian (or derivative): %s", exc)
+        if self._hints.get('debian', True) is None:
+            lgr.debug("Did not detect Debian (or derivative): no dpkg "
+                      "database found by the tracing agent")
             return
 
+        # all read at once since it takes a command per call in remote sessions
+        contents = self._session.read_many(
+            ['/etc/debian_version', '/etc/os-release'])
+        # for now would also match Ubuntu -- there it would have
+        # ID=ubuntu and ID_LIKE=debian
+        # TODO: load/parse /etc/os-release into a dict and better use
+        # VERSION_ID and then ID (to decide if Debian or Ubuntu or ...)
+        if not ('/etc/debian_version' in contents
+                and re.search('^ID.*=debian',
+                              contents.get('/etc/os-release', ''),
+                              flags=re.IGNORECASE | re.MULTILINE)
+                and self._session.stat_cache.isdir('/etc/apt')):
+            lgr.debug("Did not detect Debian (or derivative)")
+            return
+        debian_version = contents['/etc/debian_version'].strip()
+
         packages, remaining_files = self.identify_packages_from_files(files)
         # TODO: add option to report distribution even if no packages/files
         # found association
@@ -357,10 +1024,23 @@ class DebTracer(DistributionTracer):
         yield dist, remaining_files
 
     def _get_packagefields_for_files(self, files):
-        # Call dpkg query in batches
+        owners = self._hints.get('debian')
+        if owners is not None and self._hints['files'].issuperset(files):
+            # the tracing agent looked them up in the dpkg database already
+            pkgfields = {}
+            for pkg in set(owners.values()):
+                pkgfields[pkg] = _get_dpkg_pkgfields(pkg)
+            return {f: pkgfields[owners[f]] for f in files if f in owners}
+
+        # Lookup files in the dpkg database if we managed to load it
+        file_index = self._get_dpkg_file_index()
+        if file_index is not None:
+            return {f: file_index[f] for f in files if f in file_index}
+
+        # Otherwise call dpkg query in batches
         exec_gen = execute_command_batch(
             self._session, ['dpkg-query', '-S'], files,
-            cmd_err_filter('no path found matching pattern'))
+            cmd_err_filter('no path found matching pattern'), ordered=False)
         # Parse and accumulate stat results in a dict
         file_to_package_dict = {}
         for (out, _, exc) in exec_gen:
@@ -388,6 +1068,91 @@ class DebTracer(DistributionTracer):
                 file_to_package_dict[found_name] = pkg
         return file_to_package_dict
 
+    def _get_dpkg_file_index(self):
+        """Return path -> package fields index built from the dpkg database
+
+        The index is built only once per tracer.  If the database could not
+        be read within the session, None is returned and callers should
+        fall back to querying dpkg-query.
+        """
+        if self._dpkg_file_index is None:
+            try:
+                pkg_files = self._get_dpkg_db_files()
+            except (CommandError, SessionRuntimeError) as exc:
+                lgr.debug("Could not read dpkg database, will use "
+                          "dpkg-query: %s", exc_str(exc))
+                pkg_files = {}
+            file_index = {}
+            for pkg in sorted(pkg_files):
+                pkgfields = _get_dpkg_pkgfields(pkg)
+                for path in pkg_files[pkg]:
+                    # Directories are shared among packages, so (as
+                    # dpkg-query -S) we just assign them to the first one
+                    file_index.setdefault(path, pkgfields)
+            lgr.debug("Loaded %d paths for %d packages from dpkg database",
+                      len(file_index), len(pkg_files))
+            self._dpkg_file_index = file_index
+        return self._dpkg_file_index or None
+
+    def _get_dpkg_db_files(self):
+        """Return files lists of installed packages, possibly from the cache
+
+        Cache is stored under the user cache directory and is keyed by the
+        state of the dpkg database, so it gets invalidated whenever any
+        package is (un)installed.  It could be disabled by setting
+        "dpkg cache" option in "debian" section of the configuration (e.g.
+        NICEMAN_DEBIAN_DPKG_CACHE=no).
+        """
+        signature = None
+        if cfg.getboolean('debian', 'dpkg cache', default=True):
+            try:
+                signature = self._get_dpkg_db_signature()
+            except CommandError as exc:
+                lgr.debug("Could not stat dpkg database: %s", exc_str(exc))
+        if signature:
+            pkg_files = _load_dpkg_files_cache(signature)
+            if pkg_files is not None:
+                lgr.debug("Loaded files of %d packages from dpkg cache",
+                          len(pkg_files))
+                return pkg_files
+        pkg_files = self._read_dpkg_db_files()
+        if signature:
+            _save_dpkg_files_cache(signature, pkg_files)
+        return pkg_files
+
+    def _get_dpkg_db_signature(self):
+        """Return a string identifying current state of the dpkg database
+
+        dpkg replaces the status file and adds/removes .list files whenever
+        packages get (un)installed, so their inodes, modification times and
+        sizes change.
+        """
+        out, _ = self._session.execute_command(
+            ['stat', '-c', '%n %i %Y %s', DPKG_STATUS_FILE, DPKG_INFO_DIR]
+        )
+        return utils.to_unicode(out, "utf-8").strip()
+
+    def _read_dpkg_db_files(self):
+        """Read the lists of files of installed packages from dpkg database
+
+        All the .list files are dumped by a single grep call, so it costs
+        just two commands regardless of the number of packages or the type
+        of the session.
+
+        Returns
+        -------
+        dict
+          package (as "name" or "name:arch") -> list of paths
+        """
+        out, _ = self._session.execute_command(
+            ['grep', '-r', '-a', '-H', '--include=*.list', '', DPKG_INFO_DIR]
+        )
+        pkg_files = parse_dpkg_list_files_output(utils.to_unicode(out, "utf-8"))
+        installed = get_installed_pkgs_from_dpkg_status(
+            utils.to_unicode(self._session.read(DPKG_STATUS_FILE), "utf-8"))
+        return {pkg: files for pkg, files in pkg_files.items()
+                if pkg in installed}
+
     def _get_apt_source_name(self, src):
         # Create a unique name for the origin
         name_fmt = "apt_%s_%s_%s_%%d" % (src.origin or "", src.archive or "",
@@ -406,13 +1171,17 @@ class DebTracer(DistributionTracer):
         # Store the package details as dicts so that we can easily add to them
         pkg_dicts = [attr.asdict(pkg) for pkg in packages]
 
-        # Use dpkg -s <pkg> to get arch and version
+        # Use dpkg-query -W to get arch, version and source of all
+        # installed packages at once
         self._get_pkgs_arch_and_version(pkg_dicts)
 
-        # Use apt-cache show <pkg> to get details
-        self._get_pkgs_details_from_apt_cache_show(pkg_dicts)
+        # Get details from the apt Packages lists, and fall back to
+        # apt-cache show <pkg> only for the packages not found there
+        missing = self._get_pkgs_details_from_apt_lists(pkg_dicts)
+        if missing:
+            self._get_pkgs_details_from_apt_cache_show(missing)
 
-        # Now use "apt-cache policy pkg:arch" to get versions
+        # Now get versions (and their sources) available from apt
         self._get_pkgs_versions_and_sources(pkg_dicts)
 
         # Get install date from the modify time of the dpkg info file
@@ -441,11 +1210,20 @@ class DebTracer(DistributionTracer):
         out = utils.to_unicode(out, "utf-8")
 
         src_info = parse_apt_cache_policy_source_info(out)
+        # Look up the dates of all the sources at once
+        release_files = {
+            src_name: get_apt_release_file_names(
+                src_vals.get("archive_uri"), src_vals.get("uri_suite"))
+            for src_name, src_vals in src_info.items()}
+        dates = self._get_release_files_dates(
+            itertools.chain.from_iterable(release_files.values()))
         for src_name in src_info:
             src_vals = src_info[src_name]
-            date = self._get_date_from_release_file(
-                src_vals.get("archive_uri"), src_vals.get("uri_suite"))
-            self._all_apt_sources[src_name] = \
+            date = None
+            # InRelease (the last one) is preferred if both are present
+            for filename in release_files[src_name]:
+                date = dates.get(filename) or date
+            self._all_apt_sources[src_name] = intern_apt_source(
                 APTSource(
                     name=src_name,
                     component=src_vals.get("component"),
@@ -456,37 +1234,32 @@ class DebTracer(DistributionTracer):
                     label=src_vals.get("label"),
                     site=src_vals.get("site"),
                     date=date,
-                    archive_uri=src_vals.get("archive_uri"))
+                    archive_uri=src_vals.get("archive_uri")))
 
     def _get_pkgs_arch_and_version(self, pkg_dicts):
-        # Convert package names to name:arch format
-        # Use "dpkg -s pkg" to get the installed version and arch
+        # Use a single "dpkg-query -W" call to get the installed version,
+        # arch and source of all the packages
         # Note: "architecture" is in the dict, but may be null
-        queries = [(p["name"] if not p["architecture"]
-                    else "%(name)s:%(architecture)s" % p)
-                   for p in pkg_dicts]
-        # Call "dpkg -s" in batches
-        exec_gen = execute_command_batch(self._session, ['dpkg', '-s'],
-                                         queries)
-        # Parse and accumulate "dpkg -s" results
-        # dpkg -s uses the same output as apt-cache show pkg
-        results = (parse_apt_cache_show_pkgs_output(out)
-                   for (out, _, _) in exec_gen)
-        # Combine sequence of lists
-        results = itertools.chain.from_iterable(results)
-        # Turn dpkg -s results into a lookup table by package name
+        out, _ = self._session.execute_command(
+            ['dpkg-query', '-W', '-f=' + DPKG_QUERY_FORMAT]
+        )
+        results = parse_dpkg_query_output(utils.to_unicode(out, "utf-8"))
+        # Turn dpkg-query results into a lookup table by package name
         results = self.create_lookup_from_apt_cache_show(results)
         # Loop through each package and find the respective dpkg results
         for p in pkg_dicts:
             r = results.get(p["name"] if not p["architecture"]
                             else "%(name)s:%(architecture)s" % p)
             if not r:
-                lgr.warning("Was unable to run dpkg -s for %s" %
+                lgr.warning("Was unable to get dpkg details for %s" %
                             p["name"])
                 continue
             # Update the dictionary with found results
             p["architecture"] = r["architecture"]
             p["version"] = r["version"]
+            for f in ("source_name", "source_version"):
+                if f in r:
+                    p[f] = r[f]
 
     @staticmethod
     def create_lookup_from_apt_cache_show(cmd_results):
@@ -502,9 +1275,10 @@ class DebTracer(DistributionTracer):
                    for p in pkg_dicts]
         # Call "apt-cache show" in batches
         exec_gen = execute_command_batch(self._session, ['apt-cache', 'show'],
-                                         queries)
+                                         queries, ordered=False)
         # Parse and accumulate "apt-cache show" results
-        results = (parse_apt_cache_show_pkgs_output(out)
+        results = (parse_apt_cache_show_pkgs_output(out,
+                                                    _APT_CACHE_SHOW_FIELDS)
                    for (out, _, _) in exec_gen)
         # Combine sequence of lists
         results = itertools.chain.from_iterable(results)
@@ -517,50 +1291,155 @@ class DebTracer(DistributionTracer):
                 lgr.warning("Was unable to run apt-cache show for %s" %
                             p["name"])
                 continue
-            # Update the dictionary with found results (if present)
-            for f in ("source_name", "source_version", "size", "md5",
-                      "sha1", "sha256"):
-                if f in r:
-                    p[f] = r[f]
+            self._update_pkg_details(p, r)
+
+    def _get_apt_lists_index(self):
+        """Return (list_files, index) of the apt Packages lists
+
+        All the lists (possibly compressed) are dumped by a single command
+        and indexed in a single pass over its output, only once per tracer.
+        See get_apt_lists_index for the description of the returned values.
+        """
+        if self._apt_lists_index is None:
+            try:
+                out, _ = self._session.execute_command(
+                    ['sh', '-c', APT_LISTS_DUMP_SCRIPT]
+                )
+                self._apt_lists_index = get_apt_lists_index(
+                    utils.to_unicode(out, "utf-8"))
+            except CommandError as exc:
+                lgr.debug("Could not read apt lists: %s", exc_str(exc))
+                self._apt_lists_index = ([], {})
+        return self._apt_lists_index
+
+    def _get_pkgs_details_from_apt_lists(self, pkg_dicts):
+        """Get details of the packages from the apt Packages lists
+
+        Returns
+        -------
+        list
+          Package dicts which were not found in the lists
+        """
+        _, index = self._get_apt_lists_index()
+        missing = []
+        for p in pkg_dicts:
+            details = index.get((p["name"], p["architecture"]), {}) \
+                .get(p["version"])
+            if not details:
+                missing.append(p)
+                continue
+            self._update_pkg_details(p, details)
+        lgr.debug("Found details for %d out of %d packages in apt lists",
+                  len(pkg_dicts) - len(missing), len(pkg_dicts))
+        return missing
+
+    @staticmethod
+    def _update_pkg_details(pkg_dict, details):
+        # Update the dictionary with found results (if present)
+        for f in ("source_name", "source_version", "size", "md5",
+                  "sha1", "sha256"):
+            if f in details:
+                pkg_dict[f] = details[f]
 
     def _get_pkgs_install_date(self, pkg_dicts):
-        # Convert package names to dpkg list filenames
-        queries = [self._pkg_name_to_dpkg_list_file(p["name"])
-                   for p in pkg_dicts]
-        # Call stat in batches
-        exec_gen = execute_command_batch(
-            self._session, ['stat', '-c', '%n: %Y'], queries,
-            cmd_err_filter('No such file or directory'))
-        # Parse and accumulate stat results in a dict
+        # Get modification times of all dpkg list files with a single call
+        out, _ = self._session.execute_command(
+            ['find', DPKG_INFO_DIR, '-name', '*.list', '-printf', '%f %T@\\n']
+        )
+        # Parse the output and store by package ("name" or "name:arch")
         results = {}
-        for (out, _, exc) in exec_gen:
-            if exc:
-                out = exc.stdout  # One file not found, so continue
-            # Parse the output and store by filename
-            for outlines in out.splitlines():
-                (fname, ftime) = outlines.split(": ")
-                results[fname] = str(
-                    pytz.utc.localize(
-                        datetime.utcfromtimestamp(float(ftime))))
+        for outline in utils.to_unicode(out, "utf-8").splitlines():
+            fname, _, ftime = outline.rpartition(" ")
+            results[fname[:-len(".list")]] = str(
+                pytz.utc.localize(
+                    datetime.utcfromtimestamp(int(float(ftime)))))
 
         # Now lookup the packages in the results
         for p in pkg_dicts:
-            fname = self._pkg_name_to_dpkg_list_file(p["name"])
-            if fname in results:
-                p["install_date"] = results[fname]
-
-    @staticmethod
-    def _pkg_name_to_dpkg_list_file(name):
-        query = "/var/lib/dpkg/info/" + name + ".list"
-        return query
+            for name in ("%(name)s:%(architecture)s" % p, p["name"]):
+                if name in results:
+                    p["install_date"] = results[name]
+                    break
 
     def _get_pkgs_versions_and_sources(self, pkg_dicts):
+        # Version tables could be constructed from the apt lists index
+        # only if we know which source each of the lists comes from
+        list_sources = self._get_apt_lists_sources()
+        if list_sources is None:
+            self._get_pkgs_versions_and_sources_from_apt_cache_policy(
+                pkg_dicts)
+            return
+        _, index = self._get_apt_lists_index()
+        for p in pkg_dicts:
+            ver_dict = {}
+            versions = index.get((p["name"], p["architecture"]), {})
+            for version, details in versions.items():
+                src_names = [
+                    self._get_apt_source_short_name(list_sources[l])
+                    for l in details["lists"] if l in list_sources]
+                if src_names:
+                    ver_dict[version] = src_names
+            # As apt-cache policy, list dpkg status as the source of the
+            # installed version
+            if p["version"] and DPKG_STATUS_FILE in self._all_apt_sources:
+                ver_dict.setdefault(p["version"], []).append(
+                    self._get_apt_source_short_name(DPKG_STATUS_FILE))
+            if not ver_dict:
+                lgr.warning("Was unable to get version table for %s" %
+                            p["name"])
+                continue
+            p["versions"] = ver_dict
+
+    def _get_apt_lists_sources(self):
+        """Map names of the dumped apt lists to the sources from apt-cache policy
+
+        Returns None if some of the "Packages" sources known to apt could not
+        be matched to the dumped lists.
+        """
+        list_files, _ = self._get_apt_lists_index()
+        list_files = set(list_files)
+        list_sources = {}
+        for src in self._all_apt_sources:
+            if src == DPKG_STATUS_FILE:
+                continue
+            list_file = get_apt_packages_list_name(src)
+            if list_file is None:
+                if src.endswith(" Packages"):
+                    lgr.debug("Cannot determine apt list for %s", src)
+                    return None
+                continue  # e.g. Translation-en
+            if list_file not in list_files:
+                lgr.debug("Did not find apt list %s for %s", list_file, src)
+                return None
+            list_sources[list_file] = src
+        return list_sources
+
+    def _get_apt_source_short_name(self, s):
+        """Return short name for the source line s, naming it if necessary"""
+        # If we haven't named the source yet, name it
+        if s not in self._source_line_to_name_map:
+            # Make sure we can find the source
+            if s not in self._all_apt_sources:
+                lgr.warning("Cannot find source %s" % s)
+                return None
+            # Grab and name the source
+            source = self._all_apt_sources[s]
+            src_name = self._get_apt_source_name(source)
+            source = self._all_apt_sources[s] = intern_apt_source(
+                attr.evolve(source, name=src_name))
+            # Now add the source to our used sources
+            self._apt_sources[src_name] = source
+            # add the name for easy future lookup
+            self._source_line_to_name_map[s] = src_name
+        return self._source_line_to_name_map[s]
+
+    def _get_pkgs_versions_and_sources_from_apt_cache_policy(self, pkg_dicts):
         # Convert package names to name:arch format
         queries = ["%(name)s:%(architecture)s" % p for p in pkg_dicts]
         # Call apt-cache policy in batches
         exec_gen = execute_command_batch(self._session,
                                          ['apt-cache', 'policy'],
-                                         queries)
+                                         queries, ordered=False)
         # Parse results into a single generator
         results = (parse_apt_cache_policy_pkgs_output(out)
                    for (out, _, _) in exec_gen)
@@ -581,41 +1460,45 @@ class DebTracer(DistributionTracer):
                 key = v["version"]
                 ver_dict[key] = []
                 for s in v.get("sources"):
-                    s = s["source"]
-                    # If we haven't named the source yet, name it
-                    if s not in self._source_line_to_name_map:
-                        # Make sure we can find the source
-                        if s not in self._all_apt_sources:
-                            lgr.warning("Cannot find source %s" % s)
-                            continue
-                        # Grab and name the source
-                        source = self._all_apt_sources[s]
-                        src_name = self._get_apt_source_name(source)
-                        source.name = src_name
-                        # Now add the source to our used sources
-                        self._apt_sources[src_name] = source
-                        # add the name for easy future lookup
-                        self._source_line_to_name_map[s] = src_name
                     # Look up and add the short name for the source
-                    ver_dict[key].append(
-                        self._source_line_to_name_map[s])
+                    src_name = self._get_apt_source_short_name(s["source"])
+                    if src_name:
+                        ver_dict[key].append(src_name)
             p["versions"] = ver_dict
 
-    def _get_date_from_release_file(self, archive_uri, uri_suite):
-        date = None
-        for filename in get_apt_release_file_names(archive_uri, uri_suite):
+    def _get_release_files_dates(self, filenames):
+        """Return dates of the release files (None for missing files)
+
+        Only the headers of the release files not looked up already within
+        the session are fetched, all with a single command.
+        """
+        memo = _get_session_memo(_RELEASE_DATES_MEMO, self._session)
+        filenames = list(filenames)
+        missing = sorted(set(filenames).difference(memo))
+        if missing:
             try:
-                out = self._session.read(filename)
-                spec = get_spec_from_release_file(out)
-                date = str(pytz.utc.localize(
-                    datetime.utcfromtimestamp(
-                        mktime_tz(parsedate_tz(spec.date)))))
-            except CommandError as _:
-                # NOTE: We will be trying release files that end in
-                # "Release" and "InRelease", so we expect to fail in opening
-                # specific attempts.
-                pass
-        return date
+                out, _ = self._session.execute_command(
+                    ['sh', '-c', APT_RELEASE_HEADERS_DUMP_SCRIPT, 'sh'] +
+                    missing)
+            except CommandError as exc:
+                lgr.warning("Failed to read apt release files: %s",
+                            exc_str(exc))
+                return {}
+            headers = get_release_files_headers(
+                utils.to_unicode(out, "utf-8"))
+            for filename in missing:
+                memo[filename] = self._get_date_from_release_fields(
+                    headers[filename]) if filename in headers else None
+        return {f: memo[f] for f in filenames}
+
+    @staticmethod
+    def _get_date_from_release_fields(release):
+        spec = get_spec_from_release_fields(release)
+        parsed = parsedate_tz(spec.date) if spec.date else None
+        if not parsed:
+            return None
+        return str(pytz.utc.localize(
+            datetime.utcfromtimestamp(mktime_tz(parsed))))
 
     @staticmethod
     def _parse_dpkgquery_line(line):
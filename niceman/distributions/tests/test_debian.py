@@ -6,24 +6,40 @@
 #   copyright and license terms.
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+import hashlib
 import json
 import os
+import random
+import threading
+import time
 from os.path import islink
 from os.path import join, isfile
 
 from pprint import pprint
 
 import attr
+import requests
 
 from niceman.distributions.debian import DebTracer
 from niceman.distributions.debian import DEBPackage
 from niceman.distributions.debian import DebianDistribution
+from niceman.distributions.debian import APTSource
+from niceman.distributions.debian import SnapshotQuery
+from niceman.distributions.debian import SnapshotIndexResolver
+from niceman.distributions.debian import SnapshotWebResolver
+from niceman.distributions.debian import DebCache
+from niceman.distributions.debian import intern_apt_source
 
 import pytest
 
 import mock
 
+from six.moves import BaseHTTPServer
+
 from niceman.support.exceptions import CommandError
+from niceman.support.distributions.debian import APT_LISTS_DUMP_SCRIPT
+from niceman.support.distributions.debian import \
+    APT_RELEASE_HEADERS_DUMP_SCRIPT
 from niceman.tests.utils import skip_if_no_apt_cache
 
 
@@ -43,7 +59,8 @@ def test_dpkg_manager_identify_packages():
     distributions = list(tracer.identify_distributions(files))
     assert len(distributions) == 1
     distribution, unknown_files = distributions[0]
-    print(json.dumps(attr.asdict(distribution), indent=4))
+    # files of packages are PathLists
+    print(json.dumps(attr.asdict(distribution), indent=4, default=list))
     assert distribution.apt_sources
     # Make sure both a non-local origin was found
     for o in distribution.apt_sources:
@@ -68,7 +85,8 @@ def test_check_bin_packages():
     distributions = list(tracer.identify_distributions(files))
     assert len(distributions) == 1
     distribution, unknown_files = distributions[0]
-    print(json.dumps(attr.asdict(distribution), indent=4))
+    # files of packages are PathLists
+    print(json.dumps(attr.asdict(distribution), indent=4, default=list))
     non_local_origins = [o for o in distribution.apt_sources if o.site]
     assert len(non_local_origins) > 0, "A non-local origin must be found"
     for o in non_local_origins:
@@ -152,7 +170,7 @@ def test_get_packagefields_for_files():
              '/bogus'
              ]
 
-    def exec_cmd_batch_mock(session, cmd, subfiles, exc_classes):
+    def exec_cmd_batch_mock(session, cmd, subfiles, exc_classes, **kwargs):
         assert subfiles == files  # we get all of the passed in
         assert cmd == ['dpkg-query', '-S']
 
@@ -166,8 +184,12 @@ afni: /usr/lib/afni/bin/afni
 fail2ban: /usr/bin/fail2ban-server
 fail2ban: /usr/bin/fail2ban-server
 """, None, None)
+    # Test the fallback to dpkg-query, which is used if dpkg database could
+    # not be loaded
     with mock.patch('niceman.distributions.debian.execute_command_batch',
-                    exec_cmd_batch_mock):
+                    exec_cmd_batch_mock), \
+            mock.patch.object(manager, '_get_dpkg_file_index',
+                              return_value=None):
         out = manager._get_packagefields_for_files(files)
 
     assert out == {
@@ -178,6 +200,345 @@ fail2ban: /usr/bin/fail2ban-server
         '/bin/sh': {'name': u'dash'}
     }
 
+_DPKG_LIST_FILES_OUTPUT = """\
+/var/lib/dpkg/info/dash.list:/bin/sh
+/var/lib/dpkg/info/zlib1g:i386.list:/lib/i386-linux-gnu
+/var/lib/dpkg/info/zlib1g:i386.list:/lib/i386-linux-gnu/libz.so.1.2.8
+/var/lib/dpkg/info/zlib1g:amd64.list:/lib/x86_64-linux-gnu/libz.so.1.2.8
+/var/lib/dpkg/info/fail2ban.list:/usr/bin/fail2ban-server
+/var/lib/dpkg/info/removed.list:/usr/bin/removed
+/var/lib/dpkg/info/gcc-6-base:i386.list:/lib/i386-linux-gnu
+"""
+
+_DPKG_STATUS = """\
+Package: dash
+Status: install ok installed
+Architecture: amd64
+
+Package: zlib1g
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+
+Package: zlib1g
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+
+Package: gcc-6-base
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+
+Package: fail2ban
+Status: install ok installed
+Architecture: all
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+"""
+
+
+def _get_dpkg_db_session(signature="/var/lib/dpkg/status 1 1000 200"):
+    """Session mock which provides dpkg database with the test records"""
+    def execute_command(cmd):
+        if cmd[0] == 'stat':
+            return (signature, '')
+        assert cmd[0] == 'grep'
+        return (_DPKG_LIST_FILES_OUTPUT, '')
+
+    session = mock.MagicMock()
+    session.execute_command.side_effect = execute_command
+    session.read.return_value = _DPKG_STATUS
+    return session
+
+
+def _get_grep_calls(session):
+    return [c for c in session.execute_command.call_args_list
+            if c[0][0][0] == 'grep']
+
+
+@pytest.fixture
+def dpkg_cache_dir(tmpdir):
+    with mock.patch('niceman.distributions.debian._get_dpkg_cache_dir',
+                    return_value=str(tmpdir)):
+        yield str(tmpdir)
+
+
+def test_get_packagefields_for_files_from_dpkg_db(dpkg_cache_dir):
+    session = _get_dpkg_db_session()
+    manager = DebTracer(session=session)
+    files = ['/bin/sh',
+             '/lib/i386-linux-gnu',
+             '/lib/i386-linux-gnu/libz.so.1.2.8',
+             '/lib/x86_64-linux-gnu/libz.so.1.2.8',
+             '/usr/bin/fail2ban-server',
+             '/usr/bin/removed',
+             '/bogus']
+    with mock.patch('niceman.distributions.debian.execute_command_batch') \
+            as exec_cmd_batch_mock:
+        out = manager._get_packagefields_for_files(files)
+        # and the database is read only once
+        manager._get_packagefields_for_files(files)
+    assert not exec_cmd_batch_mock.called
+    assert len(_get_grep_calls(session)) == 1
+    assert session.read.call_count == 1
+    assert out == {
+        '/bin/sh': {'name': 'dash'},
+        # shared directory is assigned to a single package
+        '/lib/i386-linux-gnu': {'name': 'gcc-6-base', 'architecture': 'i386'},
+        '/lib/i386-linux-gnu/libz.so.1.2.8':
+            {'name': 'zlib1g', 'architecture': 'i386'},
+        '/lib/x86_64-linux-gnu/libz.so.1.2.8':
+            {'name': 'zlib1g', 'architecture': 'amd64'},
+        '/usr/bin/fail2ban-server': {'name': 'fail2ban'},
+    }
+
+
+def test_dpkg_db_cache(dpkg_cache_dir):
+    files = ['/bin/sh', '/lib/x86_64-linux-gnu/libz.so.1.2.8', '/bogus']
+    session = _get_dpkg_db_session()
+    out = DebTracer(session=session)._get_packagefields_for_files(files)
+    assert len(_get_grep_calls(session)) == 1
+    assert len(os.listdir(dpkg_cache_dir)) == 1
+
+    # A new tracer for the same state of the database should use the cache
+    session = _get_dpkg_db_session()
+    assert DebTracer(session=session)._get_packagefields_for_files(files) \
+        == out
+    assert not _get_grep_calls(session)
+    assert not session.read.called
+
+    # but whenever the database changes, it should be read again
+    session = _get_dpkg_db_session(
+        signature="/var/lib/dpkg/status 2 1001 300")
+    assert DebTracer(session=session)._get_packagefields_for_files(files) \
+        == out
+    assert len(_get_grep_calls(session)) == 1
+    assert len(os.listdir(dpkg_cache_dir)) == 2
+
+    # and cache could be disabled
+    session = _get_dpkg_db_session()
+    with mock.patch.dict(os.environ, {'NICEMAN_DEBIAN_DPKG_CACHE': 'no'}):
+        from niceman import cfg
+        cfg.reload()
+        try:
+            DebTracer(session=session)._get_packagefields_for_files(files)
+        finally:
+            cfg.remove_option('debian', 'dpkg cache')
+    assert len(_get_grep_calls(session)) == 1
+
+
+def test_dpkg_db_cache_pruned(dpkg_cache_dir):
+    from niceman.distributions import debian
+    nentries = debian._DPKG_CACHE_MAX_ENTRIES
+    for i in range(nentries):
+        debian._save_dpkg_files_cache("signature %d" % i, {'p': ['/f']})
+        # make sure that entries are ordered in time
+        os.utime(debian._get_dpkg_cache_file("signature %d" % i),
+                 (1000 + i, 1000 + i))
+    debian._save_dpkg_files_cache("signature new", {'p': ['/f']})
+    assert len(os.listdir(dpkg_cache_dir)) == nentries
+    # the oldest one is gone
+    assert debian._load_dpkg_files_cache("signature 0") is None
+    assert debian._load_dpkg_files_cache("signature 1") == {'p': ['/f']}
+    assert debian._load_dpkg_files_cache("signature new") == {'p': ['/f']}
+
+
+def test_get_packagefields_for_files_dpkg_db_failure():
+    session = mock.MagicMock()
+    session.execute_command.side_effect = CommandError("grep", "failed")
+    manager = DebTracer(session=session)
+
+    def exec_cmd_batch_mock(session, cmd, subfiles, exc_classes, **kwargs):
+        assert cmd == ['dpkg-query', '-S']
+        yield ("dash: /bin/sh\n", None, None)
+
+    with mock.patch('niceman.distributions.debian.execute_command_batch',
+                    exec_cmd_batch_mock):
+        out = manager._get_packagefields_for_files(['/bin/sh'])
+    assert out == {'/bin/sh': {'name': 'dash'}}
+
+
+def _get_details_session():
+    """Session mock with outputs of the commands used to get package details
+    """
+    outputs = {
+        'dpkg-query': """\
+zlib1g:amd64\tzlib1g\tamd64\t1:1.2.8.dfsg-5\tzlib\t1:1.2.8.dfsg-5
+afni\tafni\tamd64\t16.2.07~dfsg.1-2~nd90+1\tafni-src\t16.2.07~dfsg.1-2~nd90+1
+removed\tremoved\tamd64\t\t\t
+""",
+        'sh -c ' + APT_LISTS_DUMP_SCRIPT: """\
+Niceman-Apt-List: deb.debian.org_debian_dists_jessie_main_binary-amd64_Packages.gz
+
+Package: zlib1g
+Source: zlib
+Version: 1:1.2.8.dfsg-5
+Architecture: amd64
+Size: 51286
+MD5sum: 2a3f7e0a8b6b7bd1ab8e1ea7d8bdfd3e
+SHA256: 3c0d1c6b1e4de0a4fd9e4a0e4bdb2e3a0b1c4f4c3e0c2b1a0d9e8f7a6b5c4d3e
+Description: compression library - runtime
+ zlib is a library implementing the deflate compression method found
+ in gzip and PKZIP.
+
+Package: zlib1g
+Source: zlib
+Version: 1:1.2.8.dfsg-2
+Architecture: amd64
+Size: 50000
+
+Niceman-Apt-List: deb.debian.org_debian_dists_sid_main_binary-amd64_Packages
+
+Package: zlib1g
+Source: zlib
+Version: 1:1.2.8.dfsg-5
+Architecture: amd64
+Size: 51286
+
+""",
+        'find /var/lib/dpkg/info': """\
+zlib1g:amd64.list 1483228800.0000000000
+afni.list 1483315200.5000000000
+""",
+        'apt-cache show': """\
+Package: afni
+Source: afni-src
+Version: 16.2.07~dfsg.1-2~nd90+1
+Architecture: amd64
+Size: 12345
+MD5sum: 0123456789abcdef0123456789abcdef
+""",
+        'apt-cache policy': """\
+Package files:
+ 100 /var/lib/dpkg/status
+     release a=now
+ 500 http://deb.debian.org/debian jessie/main amd64 Packages
+     release o=Debian,a=oldstable,n=jessie,l=Debian,c=main,b=amd64
+     origin deb.debian.org
+ 500 http://deb.debian.org/debian sid/main amd64 Packages
+     release o=Debian,a=unstable,n=sid,l=Debian,c=main,b=amd64
+     origin deb.debian.org
+Pinned packages:
+""",
+    }
+
+    outputs['sh -c ' + APT_RELEASE_HEADERS_DUMP_SCRIPT] = """\
+Niceman-Release-File: /var/lib/apt/lists/deb.debian.org_debian_dists_jessie_InRelease
+
+Origin: Debian
+Suite: oldstable
+Codename: jessie
+Date: Sat, 14 Oct 2017 10:24:26 UTC
+
+"""
+
+    def execute_command(cmd):
+        for prefix, out in outputs.items():
+            if ' '.join(cmd).startswith(prefix):
+                return out, ''
+        raise AssertionError("Unexpected command %s" % cmd)
+
+    session = mock.MagicMock()
+    session.execute_command.side_effect = execute_command
+    return session
+
+
+def test_get_details_for_packages():
+    session = _get_details_session()
+    tracer = DebTracer(session=session)
+    packages = tracer.get_details_for_packages(
+        [DEBPackage(name='zlib1g', architecture='amd64'),
+         DEBPackage(name='afni')])
+    zlib, afni = packages
+    assert zlib.version == '1:1.2.8.dfsg-5'
+    assert zlib.source_name == 'zlib'
+    assert zlib.source_version is None
+    assert zlib.size == '51286'
+    assert zlib.md5 == '2a3f7e0a8b6b7bd1ab8e1ea7d8bdfd3e'
+    assert zlib.install_date == '2017-01-01 00:00:00+00:00'
+    # afni is not in the lists, so details come from apt-cache show
+    assert afni.architecture == 'amd64'
+    assert afni.version == '16.2.07~dfsg.1-2~nd90+1'
+    assert afni.source_name == 'afni-src'
+    assert afni.size == '12345'
+    assert afni.install_date == '2017-01-02 00:00:00+00:00'
+    # version tables come from the apt lists
+    assert zlib.versions == {
+        '1:1.2.8.dfsg-5': ['apt_Debian_oldstable_main_0',
+                           'apt_Debian_unstable_main_0',
+                           'apt__now__0'],
+        '1:1.2.8.dfsg-2': ['apt_Debian_oldstable_main_0']}
+    assert afni.versions == {'16.2.07~dfsg.1-2~nd90+1': ['apt__now__0']}
+    # and the number of commands does not depend on the number of packages
+    cmds = [c[0][0][:2] for c in session.execute_command.call_args_list]
+    assert sorted(cmds) == sorted([
+        ['apt-cache', 'policy'],  # all sources
+        ['dpkg-query', '-W'],
+        ['sh', '-c'],  # dump of apt lists
+        ['sh', '-c'],  # dump of release files headers
+        ['apt-cache', 'show'],  # only for afni
+        ['find', '/var/lib/dpkg/info'],
+    ])
+
+
+def test_find_all_sources_release_dates():
+    session = _get_details_session()
+    tracer = DebTracer(session=session)
+    tracer._find_all_sources()
+    sources = tracer._all_apt_sources
+    assert sources['http://deb.debian.org/debian jessie/main amd64 Packages']\
+        .date == '2017-10-14 10:24:26+00:00'
+    assert sources['http://deb.debian.org/debian sid/main amd64 Packages']\
+        .date is None
+    release_cmds = [c[0][0][3:] for c in session.execute_command.call_args_list
+                    if c[0][0][:3] == ['sh', '-c', APT_RELEASE_HEADERS_DUMP_SCRIPT]]
+    # all release files were looked up at once
+    assert release_cmds == [[
+        'sh',
+        '/var/lib/apt/lists/deb.debian.org_debian_dists_jessie_InRelease',
+        '/var/lib/apt/lists/deb.debian.org_debian_dists_jessie_Release',
+        '/var/lib/apt/lists/deb.debian.org_debian_dists_sid_InRelease',
+        '/var/lib/apt/lists/deb.debian.org_debian_dists_sid_Release',
+        '/var/lib/apt/lists/var_lib_dpkg_status_InRelease',
+        '/var/lib/apt/lists/var_lib_dpkg_status_Release',
+    ]]
+    # and are not looked up again within the same session
+    session.execute_command.reset_mock()
+    tracer = DebTracer(session=session)
+    tracer._find_all_sources()
+    assert tracer._all_apt_sources == sources
+    assert [c[0][0][:2] for c in session.execute_command.call_args_list] \
+        == [['apt-cache', 'policy']]
+
+
+def test_get_details_for_packages_unknown_apt_list():
+    # If some source could not be matched to the dumped lists, version
+    # tables are obtained from apt-cache policy
+    session = _get_details_session()
+    tracer = DebTracer(session=session)
+    tracer._apt_lists_index = ([], {})
+    with mock.patch('niceman.distributions.debian.execute_command_batch') \
+            as exec_cmd_batch_mock:
+        exec_cmd_batch_mock.return_value = [("""\
+zlib1g:amd64:
+  Installed: 1:1.2.8.dfsg-5
+  Candidate: 1:1.2.8.dfsg-5
+  Version table:
+ *** 1:1.2.8.dfsg-5 500
+        500 http://deb.debian.org/debian jessie/main amd64 Packages
+        100 /var/lib/dpkg/status
+""", None, None)]
+        tracer._find_all_sources()
+        pkg_dicts = [{'name': 'zlib1g', 'architecture': 'amd64'}]
+        tracer._get_pkgs_versions_and_sources(pkg_dicts)
+    assert exec_cmd_batch_mock.call_args[0][1] == ['apt-cache', 'policy']
+    assert pkg_dicts[0]['versions'] == {
+        '1:1.2.8.dfsg-5': ['apt_Debian_oldstable_main_0', 'apt__now__0']}
+
+
 @pytest.fixture
 def setup_packages():
     """set up the package comparison tests"""
@@ -240,3 +601,423 @@ def test_distribution_sub():
     result = d2-d1
     assert len(result) == 1
     assert result[0] == p1v11
+
+
+_SNAPSHOT_SID_CHANGES = ["20170531T084046Z", "20170601T034215Z",
+                         "20170602T093012Z"]
+
+
+@pytest.fixture
+def snapshot_site():
+    """Local stand-in for snapshot.debian.org serving pages of sid dists"""
+    requested = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            parts = self.path.strip('/').split('/')
+            # archive/debian/<timestamp>/dists/sid
+            if len(parts) != 5 or parts[-1] != 'sid':
+                self.send_error(404)
+                return
+            if parts[2] == 'slow':
+                time.sleep(0.5)  # longer than the client waits
+                return
+            later = [t for t in _SNAPSHOT_SID_CHANGES if t > parts[2]]
+            body = '<html><body>'
+            if later:
+                body += '<a href="/archive/debian/%s/dists/sid/">' \
+                        'next change</a>' % later[0]
+            body = (body + '</body></html>').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield '127.0.0.1:%d' % server.server_address[1], requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_snapshot_web_resolver(snapshot_site, tmpdir):
+    site, requested = snapshot_site
+    cache = str(tmpdir.join('snapshots.json'))
+    q1 = SnapshotQuery(site, 'debian', '20170531T084046Z', 'sid')
+    q2 = SnapshotQuery(site, 'debian', '20170602T093012Z', 'sid')
+    q3 = SnapshotQuery(site, 'debian', '20170531T084046Z', 'jessie')
+    resolver = SnapshotWebResolver(timeout=5, cache=cache)
+    assert resolver.get_next_changes([q1, q2, q3, q1]) == {
+        q1: '20170601T034215Z', q2: None, q3: None}
+    assert len(requested) == 3
+    # all of them are remembered, and jessie page was not found (no next
+    # change) rather than failed to be fetched
+    assert resolver.get_next_changes([q1, q2, q3])[q1] == '20170601T034215Z'
+    assert len(requested) == 3
+    # and also across runs
+    resolver = SnapshotWebResolver(timeout=5, cache=cache)
+    assert resolver.get_next_changes([q1])[q1] == '20170601T034215Z'
+    assert len(requested) == 3
+
+
+def test_snapshot_web_resolver_timeout(snapshot_site):
+    site, requested = snapshot_site
+    query = SnapshotQuery(site, 'debian', 'slow', 'sid')
+    resolver = SnapshotWebResolver(timeout=0.1)
+    with mock.patch('requests.get', wraps=requests.get) as requests_get:
+        assert resolver.get_next_changes([query]) == {query: None}
+        # failures are not remembered
+        assert resolver.get_next_changes([query]) == {query: None}
+    assert requests_get.call_count == 2
+
+
+def test_snapshot_index_resolver(tmpdir):
+    index = {'snapshot.debian.org/debian/sid': _SNAPSHOT_SID_CHANGES[::-1]}
+    q1 = SnapshotQuery('snapshot.debian.org', 'debian', '20170531T084046Z',
+                       'sid')
+    q2 = SnapshotQuery('snapshot.debian.org', 'debian', '20170601T120000Z',
+                       'sid')
+    q3 = SnapshotQuery('snapshot.debian.org', 'debian', '20170602T093012Z',
+                       'sid')
+    q4 = SnapshotQuery('snapshot.debian.org', 'debian', '20170602T093012Z',
+                       'stretch')
+    fallback = mock.MagicMock()
+    fallback.get_next_changes.return_value = {q4: '20170603T000000Z'}
+    resolver = SnapshotIndexResolver(index, fallback=fallback)
+    assert resolver.get_next_changes([q1, q2, q3, q4]) == {
+        q1: '20170601T034215Z', q2: '20170602T093012Z', q3: None,
+        q4: '20170603T000000Z'}
+    fallback.get_next_changes.assert_called_once_with([q4])
+
+    # round trip through a file
+    index_file = str(tmpdir.join('index.json'))
+    resolver.add('snapshot.debian.org', 'debian', 'stretch',
+                 ['20170603T000000Z'])
+    resolver.save(index_file)
+    resolver = SnapshotIndexResolver(index_file)
+    assert resolver.get_next_changes([q2, q4]) == {
+        q2: '20170602T093012Z', q4: '20170603T000000Z'}
+
+
+def test_init_apt_sources_offline():
+    snapshot = 'deb http://snapshot.debian.org/archive/debian/'
+    written = []
+
+    def put(src_path, dest_path):
+        with open(src_path) as f:
+            written.append((dest_path, f.read()))
+
+    session = mock.MagicMock()
+    session.exists.return_value = True
+    session.read.return_value = \
+        '# Niceman repo sources\n' \
+        '%s20170531T084046Z/ sid main contrib non-free' % snapshot
+    session.put.side_effect = put
+    distribution = DebianDistribution(
+        name='debian',
+        apt_sources=[
+            APTSource(name='apt_Debian_sid_main', origin='Debian',
+                      codename='sid', date='2017-05-31 08:40:46+00:00'),
+            APTSource(name='apt_Debian_jessie_main', origin='Debian',
+                      codename='jessie', date='2017-05-31 08:40:46+00:00'),
+            APTSource(name='apt_Debian_sid_contrib', origin='Debian',
+                      codename='sid', date='2017-05-31 08:40:46+00:00'),
+            APTSource(name='apt_Other', origin='Other', codename='sid',
+                      date='2017-05-31 08:40:46+00:00'),
+        ])
+    index = {'snapshot.debian.org/debian/sid': _SNAPSHOT_SID_CHANGES}
+    with mock.patch('requests.get') as requests_get:
+        distribution._init_apt_sources(
+            session, 'sources.list', resolver=SnapshotIndexResolver(index))
+    assert not requests_get.called
+    # file was read and written once, without running any command
+    session.read.assert_called_once_with('sources.list')
+    assert not session.execute_command.called
+    assert written == [(
+        'sources.list',
+        '# Niceman repo sources\n' + ''.join(
+            '%s%s/ %s main contrib non-free\n'
+            % (snapshot, timestamp, codename)
+            for timestamp, codename in [('20170531T084046Z', 'sid'),
+                                        ('20170601T034215Z', 'sid'),
+                                        ('20170531T084046Z', 'jessie')]))]
+
+    # nothing is written if all lines are present
+    session.read.return_value = written[0][1]
+    distribution._init_apt_sources(
+        session, 'sources.list', resolver=SnapshotIndexResolver(index))
+    assert len(written) == 1
+
+
+class _InstallSession(object):
+    """Session with files, which fails to install packages from `failing`"""
+
+    def __init__(self, failing=()):
+        self.files = {}
+        self.commands = []
+        self.failing = set(failing)
+
+    def exists(self, path):
+        return path in self.files
+
+    def read(self, path):
+        return self.files[path]
+
+    def put(self, src_path, dest_path):
+        with open(src_path) as f:
+            self.files[dest_path] = f.read()
+
+    def get(self, src_path, dest_path):
+        with open(dest_path, 'w') as f:
+            f.write(self.files[src_path])
+
+    def put_many(self, paths):
+        for src_path, dest_path in paths:
+            self.put(src_path, dest_path)
+
+    def get_many(self, paths):
+        for src_path, dest_path in paths:
+            self.get(src_path, dest_path)
+
+    def execute_command(self, command):
+        self.commands.append(command)
+        if command[:2] == ['rm', '-f']:
+            self.files.pop(command[2], None)
+        elif command[:2] == ['apt-cache', 'show']:
+            return '''\
+Package: b
+Version: 2
+Depends: c (>= 1), libc6
+
+Package: a
+Version: 1
+Pre-Depends: b | d
+''', ''
+        elif command[:3] == ['apt-get', 'install', '-y'] and \
+                self.failing.intersection(command):
+            raise CommandError(cmd=command)
+        return '', ''
+
+
+def _get_install_distribution():
+    return DebianDistribution(
+        name='debian',
+        packages=[DEBPackage(name='a', version='1'),
+                  DEBPackage(name='b', version='2'),
+                  DEBPackage(name='c', version='3'),
+                  DEBPackage(name='d')])
+
+
+def test_install_packages():
+    session = _InstallSession()
+    _get_install_distribution().install_packages(session, state_file='state')
+    download, install, rm = session.commands
+    assert download[-4:] == ['a=1', 'b=2', 'c=3', 'd']
+    assert 'apt-get download "$@"' in download[2]
+    assert install == ['apt-get', 'install', '-y', 'a=1', 'b=2', 'c=3', 'd']
+    assert rm == ['rm', '-f', 'state']
+    assert not session.files
+
+
+def test_install_packages_chunked_resumed():
+    session = _InstallSession(failing=['a=1'])
+    distribution = _get_install_distribution()
+    with mock.patch('niceman.distributions.debian.get_cmd_batch_len',
+                    return_value=2), \
+            pytest.raises(CommandError):
+        distribution.install_packages(session, state_file='state')
+    # dependencies were installed first and then it failed
+    assert session.commands[-2:] == [
+        ['apt-get', 'install', '-y', 'c=3', 'b=2'],
+        ['apt-get', 'install', '-y', 'd', 'a=1']]
+    state = json.loads(session.files['state'])
+    assert state['downloaded']
+    assert state['installed'] == ['c=3', 'b=2']
+
+    # rerun does not download nor install those again
+    session.failing = set()
+    session.commands = []
+    with mock.patch('niceman.distributions.debian.get_cmd_batch_len',
+                    return_value=2):
+        distribution.install_packages(session, state_file='state')
+    assert session.commands == [
+        ['apt-get', 'install', '-y', 'a=1', 'd'],
+        ['rm', '-f', 'state']]
+
+    # installation of other packages starts over
+    session.files['state'] = json.dumps(state)
+    session.commands = []
+    distribution.packages = distribution.packages[:2]
+    distribution.install_packages(session, state_file='state')
+    assert session.commands[0][-2:] == ['a=1', 'b=2']
+    assert session.commands[1] == ['apt-get', 'install', '-y', 'a=1', 'b=2']
+
+
+def _get_deb_package(name, content, **kwargs):
+    return DEBPackage(
+        name=name, version='1:1.0', architecture='amd64',
+        sha256=hashlib.sha256(content.encode()).hexdigest(), **kwargs)
+
+
+def test_deb_cache(tmpdir):
+    cache = DebCache(str(tmpdir.join('cache')), max_size=20)
+    a = _get_deb_package('a', 'a' * 10)
+    b = DEBPackage(name='b', version='1', architecture='all',
+                   md5=hashlib.md5(b'b' * 10).hexdigest())
+    c = _get_deb_package('c', 'c' * 10)
+    assert not cache.is_cacheable(DEBPackage(name='d', version='1',
+                                             architecture='all'))
+    assert not cache.is_cacheable(DEBPackage(name='d', sha256='0'))
+    for package in (a, b, c):
+        tmpdir.join(package.name).write(package.name * 10)
+    assert cache.get(a) is None
+    assert cache.add(a, str(tmpdir.join('a')))
+    assert cache.add(b, str(tmpdir.join('b')))
+    # content not matching the hash is not cached
+    assert not cache.add(c, str(tmpdir.join('a')))
+    assert cache.get(c) is None
+    assert open(cache.get(a)).read() == 'a' * 10
+    assert cache.get(b).endswith('md5-%s.deb' % b.md5)
+    # b is the least recently used one after a was used again
+    os.utime(cache.get(b), (0, 0))
+    assert cache.get(a)
+    assert cache.add(c, str(tmpdir.join('c')))
+    cache.prune()
+    assert cache.get(b) is None
+    assert cache.get(a) and cache.get(c)
+
+
+def test_install_packages_deb_cache(tmpdir):
+    deb_cache = DebCache(str(tmpdir), max_size=1024)
+    distribution = DebianDistribution(
+        name='debian',
+        packages=[_get_deb_package('a', 'deb a'),
+                  _get_deb_package('b', 'deb b'),
+                  DEBPackage(name='c', version='3')])
+    deb_a = '/var/cache/apt/archives/a_1%3a1.0_amd64.deb'
+    deb_b = '/var/cache/apt/archives/b_1%3a1.0_amd64.deb'
+    session = _InstallSession()
+    # as if downloaded, but b is broken
+    session.files.update({deb_a: 'deb a', deb_b: 'broken'})
+    with mock.patch('niceman.distributions.debian.get_deb_cache',
+                    return_value=deb_cache):
+        distribution.install_packages(session, state_file='state')
+        assert session.commands[0][-3:] == ['a=1:1.0', 'b=1:1.0', 'c=3']
+        assert deb_cache.get(distribution.packages[0])
+        assert not deb_cache.get(distribution.packages[1])
+
+        session = _InstallSession()
+        distribution.install_packages(session, state_file='state')
+    # a was served from the cache
+    assert session.files[deb_a] == 'deb a'
+    assert session.commands[0][-2:] == ['b=1:1.0', 'c=3']
+    assert session.commands[1] == \
+        ['apt-get', 'install', '-y', 'a=1:1.0', 'b=1:1.0', 'c=3']
+
+
+def test_deb_package_interned():
+    # strings built at runtime, as if loaded from a spec
+    def s(value):
+        return ''.join(list(value))
+    a = DEBPackage(name=s('a'), version=s('1.0-1'), architecture=s('amd64'),
+                   versions={s('1.0-1'): [s('apt_Debian_sid_main')]})
+    b = DEBPackage(name=s('b'), version=s('1.0-1'), architecture=s('amd64'),
+                   versions={s('1.0-1'): [s('apt_Debian_sid_main')]})
+    assert a.version is b.version
+    assert a.architecture is b.architecture
+    assert list(a.versions)[0] is list(b.versions)[0]
+    assert a.versions['1.0-1'][0] is b.versions['1.0-1'][0]
+    assert DEBPackage(name='c').version is None
+
+
+def test_apt_source_interned():
+    def source(**kwargs):
+        return APTSource(name='apt_Debian_sid_main', origin='Debian',
+                         codename='sid', component='main', **kwargs)
+    a, b = source(), source()
+    assert a == b and hash(a) == hash(b)
+    assert a != source(architecture='amd64')
+    with pytest.raises(attr.exceptions.FrozenInstanceError):
+        a.name = 'other'
+    assert intern_apt_source(a) is a
+    assert intern_apt_source(b) is a
+    assert len(set([a, b])) == 1
+
+
+def _satisfies_package_reference(distribution, package):
+    # former implementation, going through all the packages
+    return any(p.satisfies(package) for p in distribution.packages)
+
+
+def _get_random_packages(n, seed):
+    rng = random.Random(seed)
+    return [DEBPackage(name='pkg%d' % rng.randint(0, n),
+                       version=rng.choice([None, '1', '2']),
+                       architecture=rng.choice([None, 'amd64', 'i386']))
+            for _ in range(n)]
+
+
+def test_distribution_sub_indexed():
+    d1 = DebianDistribution(name='debian 1',
+                            packages=_get_random_packages(300, 1))
+    d2 = DebianDistribution(name='debian 2',
+                            packages=_get_random_packages(300, 2))
+    for a, b in ((d1, d2), (d2, d1), (d1, d1)):
+        assert a - b == [p for p in a.packages
+                         if not _satisfies_package_reference(b, p)]
+        assert a.satisfies(b) == all(
+            _satisfies_package_reference(a, p) for p in b.packages)
+    assert not d1 - d1
+    assert d1.satisfies(d1)
+
+    # index follows changes of the packages
+    p = DEBPackage(name='new', version='1', architecture='amd64')
+    assert not d1.satisfies_package(p)
+    d1.packages.append(p)
+    assert d1.satisfies_package(p)
+    assert d1.satisfies_package(DEBPackage(name='new'))
+    assert not d1.satisfies_package(DEBPackage(name='new', version='2'))
+    d1.packages[-1] = DEBPackage(name='new', version='2')
+    assert not d1.satisfies_package(p)
+    assert d1.satisfies_package(DEBPackage(name='new', version='2'))
+    d1.packages = [p]
+    assert d1.satisfies_package(p)
+    assert not d2.satisfies_package(p)
+    assert d1 - d2 == [p]
+
+
+@pytest.mark.slow
+def test_distribution_sub_benchmark():
+    d1 = DebianDistribution(name='debian 1',
+                            packages=_get_random_packages(2000, 1))
+    d2 = DebianDistribution(name='debian 2',
+                            packages=_get_random_packages(2000, 2))
+
+    t0 = time.time()
+    expected = [p for p in d1.packages
+                if not _satisfies_package_reference(d2, p)]
+    t_reference = time.time() - t0
+
+    t0 = time.time()
+    result = d1 - d2
+    t_indexed = time.time() - t0
+    assert result == expected
+    # quadratic vs linear, so should be orders of magnitude faster
+    assert t_indexed * 10 < t_reference, (t_indexed, t_reference)
+
+    # and scales to larger specs
+    d1.packages = _get_random_packages(20000, 3)
+    d2.packages = _get_random_packages(20000, 4)
+    t0 = time.time()
+    d1 - d2
+    d1.satisfies(d2)
+    assert time.time() - t0 < t_reference
@@ -9,8 +9,10 @@
 
 from ...formats import Provenance
 
+import json
 import logging
 from mock import MagicMock, call, patch
+from pytest import raises
 
 from niceman.utils import swallow_logs
 from niceman.utils import items_to_dict
@@ -56,6 +58,7 @@ def test_distributions(demo1_spec):
         if isinstance(command, str):
             if command.startswith('grep'):
                 return (None, 1)
+        return ('', '')
 
     provenance = Provenance.factory(demo1_spec)
     distributions = provenance.get_distributions()
@@ -100,4 +103,45 @@ dcm2niix=1:1.0.20171017+git3-g9ccc4c0-1~nd16.04+1', log.lines)
         call.add_command(['pip', 'install', 'piponlypkg']),
     ]
     environment.assert_has_calls(calls, any_order=True)
-    """
\ No newline at end of file
+    """
+
+
+def test_path_list():
+    from ..base import PathList
+    paths = ['/usr/bin/b', '/usr/bin/a', '/usr/lib/x/libx.so',
+             '/usr/share/doc/a/README', '/usr/share/doc/a/ex/1',
+             'relative/file', '/usr/lib/x']  # /usr/lib/x is a file and a dir
+    files = PathList(paths)
+    files.append('/usr/bin/a')  # duplicate
+    assert len(files) == len(paths)
+    assert list(files) == sorted(paths)
+    assert files == paths
+    assert files != paths[1:]
+    assert files[0] == '/usr/bin/a'
+    assert [files[i] for i in range(len(files))] == sorted(paths)
+    assert files[-1] == 'relative/file'
+    assert files[1:3] == ['/usr/bin/b', '/usr/lib/x']
+    with raises(IndexError):
+        files[len(paths)]
+    # compares as a set of paths
+    assert files == paths[::-1] + paths[:1]
+    assert '/usr/lib/x' in files
+    assert '/usr/lib' not in files
+    assert '/usr/bin/c' not in files
+    assert PathList() == []
+    assert not PathList()
+    assert json.loads(json.dumps(files, default=list)) == sorted(paths)
+
+    spec = files.to_spec()
+    assert spec == {
+        '/usr': {
+            'bin': ['a', 'b'],
+            'lib': ['x', {'x': ['libx.so']}],
+            'share/doc/a': ['README', {'ex': ['1']}],
+        },
+        'relative': ['file'],
+    }
+    assert PathList.from_spec(spec) == files
+    # plain lists of paths are still accepted
+    assert PathList.from_spec(paths) == files
+    assert PathList.from_spec(files) is files
@@ -0,0 +1,102 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from niceman.distributions import tracing_agent
+from niceman.distributions.tracing_agent import get_dpkg_owners
+from niceman.distributions.tracing_agent import trace
+from niceman.tests.fixtures import git_repo_fixture
+
+
+git_repo = git_repo_fixture()
+
+
+def test_get_dpkg_owners(tmpdir):
+    info_dir = tmpdir.mkdir('info')
+    info_dir.join('a.list').write('/usr\n/usr/bin\n/usr/bin/a\n')
+    info_dir.join('b:amd64.list').write('/usr\n/usr/bin/b\n')
+    info_dir.join('c.list').write('/usr/bin/c\n')  # config files only
+    info_dir.join('a.md5sums').write('/usr/bin/c\n')
+    status_file = tmpdir.join('status')
+    status_file.write("""\
+Package: a
+Status: install ok installed
+Description: a
+ Status: not-installed
+
+Package: b
+Status: install ok installed
+Architecture: amd64
+
+Package: c
+Status: deinstall ok config-files
+""")
+    files = ['/usr', '/usr/bin/a', '/usr/bin/b', '/usr/bin/c', '/usr/bin/d']
+    assert get_dpkg_owners(files, str(info_dir), str(status_file)) == {
+        '/usr': 'a', '/usr/bin/a': 'a', '/usr/bin/b': 'b:amd64'}
+    assert get_dpkg_owners(files, str(tmpdir.join('missing')),
+                           str(status_file)) is None
+
+
+def test_trace(git_repo, tmpdir):
+    venv = tmpdir.mkdir('venv')
+    venv.mkdir('bin').join('activate').write('VIRTUAL_ENV="/venv"\n')
+    venv.join('bin', 'python').write('')
+    other = tmpdir.mkdir('other')
+    other.mkdir('bin').join('activate').write('')
+    conda = tmpdir.mkdir('conda')
+    conda.mkdir('conda-meta')
+    conda.mkdir('lib').join('libz.so').write('')
+    svn = tmpdir.mkdir('svn')
+    svn.mkdir('.svn')
+    svn.join('file').write('')
+    with open(os.path.join(git_repo, 'untracked'), 'w') as f:
+        f.write('')
+    os.mkdir(os.path.join(git_repo, 'subdir', 'untracked'))
+    files = [str(venv.join('bin', 'python')), str(other.join('bin')),
+             str(conda.join('lib', 'libz.so')), str(svn.join('file')),
+             os.path.join(git_repo, 'foo'),
+             os.path.join(git_repo, 'subdir', 'baz'),
+             os.path.join(git_repo, 'subdir', 'untracked'),
+             os.path.join(git_repo, 'untracked'),
+             str(tmpdir.join('missing')),
+             'relative']
+    result = trace(files, ['conda-meta', 'bin/activate'])
+    stats = result['stats']
+    assert stats[files[0]][0] == 'f'
+    assert stats[files[1]][0] == 'd'
+    assert str(tmpdir.join('missing')) not in stats
+    assert str(conda.join('conda-meta')) in stats
+    assert str(venv.join('conda-meta')) not in stats
+    assert str(venv.join('bin/activate')) in stats
+    assert str(venv) in result['probed']
+    assert 'relative' not in result['probed']
+    assert result['venvs'] == {str(venv): True, str(other): False}
+    # as VCSTracer, also assigns anything directly within top directory
+    assert result['git'] == dict(
+        (f, git_repo) for f in files[4:6] + [files[7]])
+    assert result['vcs_unresolved'] == [str(svn.join('file'))]
+    assert result['debian'] is None or isinstance(result['debian'], dict)
+
+
+def test_main(tmpdir):
+    # agent is self-contained, so could run on its own
+    agent = str(tmpdir.join('agent.py'))
+    shutil.copy(os.path.splitext(tracing_agent.__file__)[0] + '.py', agent)
+    request = tmpdir.join('request.json')
+    request.write(json.dumps({'files': [agent], 'markers': ['bin']}))
+    out = subprocess.check_output([sys.executable, agent, str(request)],
+                                  cwd=str(tmpdir), env={})
+    result = json.loads(out.decode('utf-8'))
+    assert result['stats'][agent][0] == 'f'
+    assert str(tmpdir) in result['probed']
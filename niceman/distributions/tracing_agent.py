@@ -0,0 +1,263 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Agent assigning files to packages next to them, within a session
+
+Tracers run a command (or a few) in the session for every file, directory
+or repository they look at, which is costly when each command is a
+round trip to a remote host or a container.  So retrace copies this
+script into the session (it must stay self-contained, using only the
+standard library of Python 2.7 or 3) and runs it over all the files at
+once.  It prints JSON with
+
+- stats: details (type, size, mtime, link, target type) of the files, and
+  of the markers (e.g. conda-meta) within directories containing them
+  ("probed"), so tracers could find roots of environments
+- debian: file -> package (as name or name:arch) from the dpkg database
+- git: file -> top directory of the git repository tracking it
+- vcs_unresolved: files which might be under control of some other VCS
+  (or git is not available) so they should be resolved by the tracer
+- venvs: directory (with bin/activate) -> whether it is a virtualenv
+
+Usage: python tracing_agent.py REQUEST.json, with a JSON request
+{"files": [...], "markers": [...]} of absolute paths and names of markers.
+"""
+
+import json
+import os
+import stat
+import subprocess
+import sys
+
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+DPKG_INFO_DIR = '/var/lib/dpkg/info'
+
+# Letters as "find -printf %y" reports types of files
+_FILE_TYPES = (
+    (stat.S_ISREG, 'f'),
+    (stat.S_ISDIR, 'd'),
+    (stat.S_ISLNK, 'l'),
+    (stat.S_ISCHR, 'c'),
+    (stat.S_ISBLK, 'b'),
+    (stat.S_ISFIFO, 'p'),
+    (stat.S_ISSOCK, 's'),
+)
+
+
+def get_file_type(mode):
+    for test, letter in _FILE_TYPES:
+        if test(mode):
+            return letter
+    return None
+
+
+def get_stat(path):
+    """Return [type, size, mtime, link, target type], or None if missing"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    type_ = target_type = get_file_type(st.st_mode)
+    link = None
+    if type_ == 'l':
+        link = os.readlink(path)
+        try:
+            target_type = get_file_type(os.stat(path).st_mode)
+        except OSError:
+            target_type = None
+    return [type_, st.st_size, st.st_mtime, link, target_type]
+
+
+def walk_up(path):
+    """Yield path and all its parent directories (as PathRoot does)"""
+    while path not in (os.path.pathsep, os.path.sep, ''):
+        yield path
+        path = os.path.dirname(path)
+
+
+def get_roots_candidates(files):
+    candidates = set()
+    for path in files:
+        for pth in walk_up(path):
+            if pth in candidates:
+                break
+            candidates.add(pth)
+    return candidates
+
+
+def _read_text(path):
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8', 'replace')
+
+
+def get_installed_dpkg_packages(status_file=DPKG_STATUS_FILE):
+    """Return names (and name:arch) of packages with files installed"""
+    installed = set()
+    for paragraph in _read_text(status_file).split('\n\n'):
+        fields = {}
+        for line in paragraph.splitlines():
+            if line[:1] in (' ', '\t'):
+                continue
+            name, sep, value = line.partition(':')
+            if sep:
+                fields[name.lower()] = value.strip()
+        if 'package' not in fields:
+            continue
+        state = fields.get('status', '').split()
+        if not state or state[-1] in ('not-installed', 'config-files'):
+            continue
+        installed.add(fields['package'])
+        if 'architecture' in fields:
+            installed.add('%(package)s:%(architecture)s' % fields)
+    return installed
+
+
+def get_dpkg_owners(files, info_dir=DPKG_INFO_DIR,
+                    status_file=DPKG_STATUS_FILE):
+    """Return file -> package installing it, or None if there is no dpkg
+
+    As dpkg-query -S, directories shared among packages are assigned to the
+    first package (by name).
+    """
+    if not (os.path.isdir(info_dir) and os.path.isfile(status_file)):
+        return None
+    installed = get_installed_dpkg_packages(status_file)
+    files = set(files)
+    owners = {}
+    for list_file in sorted(os.listdir(info_dir)):
+        pkg = list_file[:-len('.list')]
+        if not list_file.endswith('.list') or pkg not in installed:
+            continue
+        try:
+            paths = _read_text(os.path.join(info_dir, list_file)).splitlines()
+        except (IOError, OSError):
+            continue
+        for path in paths:
+            if path in files and path not in owners:
+                owners[path] = pkg
+    return owners
+
+
+def _run(command, cwd):
+    """Return output of a command, or None if it failed"""
+    try:
+        process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    out, _ = process.communicate()
+    if process.returncode:
+        return None
+    return out.decode('utf-8', 'replace')
+
+
+def _find_vcs(dirpath, cache):
+    """Return (closest directory with .git or None, whether .svn is above)"""
+    chain = []
+    found = (None, False)
+    for pth in walk_up(dirpath):
+        if pth in cache:
+            found = cache[pth]
+            break
+        chain.append(pth)
+    for pth in reversed(chain):
+        git_dir, svn = found
+        if os.path.exists(os.path.join(pth, '.git')):
+            git_dir = pth
+        if os.path.exists(os.path.join(pth, '.svn')):
+            svn = True
+        found = cache[pth] = (git_dir, svn)
+    return found
+
+
+def get_git_owners(files, isdir):
+    """Return (file -> git top directory, files to be resolved by tracer)
+
+    Repositories are found as VCSTracer would do (git rev-parse run within
+    directory of a file), but only once per repository, and files it
+    tracks are listed once too.  Files within svn working copies are left
+    to the tracer, since svn is tried first.
+    """
+    owners = {}
+    unresolved = []
+    found_cache = {}
+    tops = {}  # directory with .git -> top directory or None
+    tracked = {}  # top directory -> set of tracked files, or None
+    for path in files:
+        dirpath = path if isdir(path) else os.path.dirname(path)
+        git_dir, svn = _find_vcs(dirpath, found_cache)
+        if svn:
+            unresolved.append(path)
+            continue
+        if git_dir is None:
+            continue  # not under any VCS we know about
+        if git_dir not in tops:
+            out = _run(['git', 'rev-parse', '--show-toplevel'], git_dir)
+            tops[git_dir] = out.rstrip('\n') if out else None
+        top = tops[git_dir]
+        if top is not None and top not in tracked:
+            out = _run(['git', 'ls-files', '-z'], top)
+            tracked[top] = set(out.split('\0')) if out is not None else None
+        if top is None or tracked[top] is None:
+            unresolved.append(path)
+        elif dirpath == top or path[len(top) + 1:] in tracked[top]:
+            # as the tracer, which assigns anything directly within top
+            # directory of a known repository
+            owners[path] = top
+    return owners, unresolved
+
+
+def is_venv(path):
+    try:
+        return 'VIRTUAL_ENV' in _read_text(
+            os.path.join(path, 'bin', 'activate'))
+    except (IOError, OSError):
+        return False
+
+
+def trace(files, markers):
+    """Gather information about files (see module docstring)"""
+    files = [f for f in files if os.path.isabs(f)]
+    stats = {}
+    for path in files:
+        stats[path] = get_stat(path)
+    probed = sorted(get_roots_candidates(files))
+    venvs = {}
+    for dirpath in probed:
+        for marker in markers:
+            path = os.path.join(dirpath, marker)
+            stats[path] = get_stat(path)
+        activate = stats.get(os.path.join(dirpath, 'bin', 'activate')) \
+            or get_stat(os.path.join(dirpath, 'bin', 'activate'))
+        if activate:
+            venvs[dirpath] = is_venv(dirpath)
+
+    def isdir(path):
+        stat_ = stats.get(path)
+        return bool(stat_) and stat_[4] == 'd'
+
+    git, vcs_unresolved = get_git_owners(files, isdir)
+    return {
+        'stats': dict((p, s) for p, s in stats.items() if s is not None),
+        'probed': probed,
+        'debian': get_dpkg_owners(files),
+        'git': git,
+        'vcs_unresolved': vcs_unresolved,
+        'venvs': venvs,
+    }
+
+
+def main(argv):
+    with open(argv[1]) as f:
+        request = json.load(f)
+    json.dump(trace(request['files'], request.get('markers', [])),
+              sys.stdout)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -30,6 +30,7 @@ from niceman.cmd import CommandError
 lgr = getLogger('niceman.distributions.vcs')
 
 from niceman.distributions.base import DistributionTracer
+from niceman.distributions.base import FilesList
 from niceman.distributions.base import SpecObject
 from niceman.distributions.base import Distribution
 from niceman.distributions.base import TypedList
@@ -75,7 +76,7 @@ class VCSRepo(SpecObject):
     """Base VCS repo class"""
 
     path = attr.ib()
-    files = attr.ib(default=attr.Factory(list))
+    files = FilesList()
 
 
 @attr.s
@@ -486,6 +487,17 @@ class VCSTracer(DistributionTracer):
         # very naive just to get a ball rolling
         if not isabs(path):
             path = abspath(path)
+
+        if path in self._hints.get('files', ()) \
+                and path not in self._hints['vcs_unresolved']:
+            # the tracing agent found the git repository tracking it already
+            top = self._hints['git'].get(path)
+            if top is None:
+                return None
+            if top not in self._known_repos:
+                self._known_repos[top] = GitRepoShim(top, session=self._session)
+            return self._known_repos[top]
+
         dirpath = path if isdir(path) else dirname(path)
 
         # quick check first
@@ -21,6 +21,7 @@ from niceman.dochelpers import exc_str
 from niceman.utils import PathRoot, is_subpath
 
 from .base import DistributionTracer
+from .base import FilesList
 from .base import Package
 from .base import SpecObject
 from .base import TypedList
@@ -35,7 +36,7 @@ class VenvPackage(Package):
     local = attr.ib()
     location = attr.ib(default=None)
     editable = attr.ib(default=False)
-    files = attr.ib(default=attr.Factory(list))
+    files = FilesList()
 
 
 @attr.s
@@ -64,6 +65,8 @@ class VenvTracer(DistributionTracer):
     """Distribution tracer for virtualenv.
     """
 
+    ROOT_MARKERS = ('bin/activate',)
+
     def _init(self):
         self._path_root = PathRoot(self._is_venv_directory)
 
@@ -85,6 +88,11 @@ class VenvTracer(DistributionTracer):
         return packages, file_to_pkg
 
     def _is_venv_directory(self, path):
+        if not self._session.stat_cache.exists(path + "/bin/activate"):
+            return False
+        venvs = self._hints.get('venvs', {})
+        if path in venvs:
+            return venvs[path]  # checked by the tracing agent
         try:
             self._session.execute_command(["grep", "-q", "VIRTUAL_ENV",
                                            "{}/bin/activate".format(path)])
@@ -102,6 +110,7 @@ class VenvTracer(DistributionTracer):
         found_package_count = 0
         total_file_count = len(unknown_files)
 
+        self._prefetch_within_paths(files, self.ROOT_MARKERS)
         venv_paths = map(self._get_venv_path, files)
         venv_paths = set(filter(None, venv_paths))
 
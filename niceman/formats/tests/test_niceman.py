@@ -13,6 +13,9 @@ import io
 
 from pprint import pprint
 
+from niceman.distributions.base import EnvironmentSpec
+from niceman.distributions.debian import DEBPackage
+from niceman.distributions.debian import DebianDistribution
 from niceman.formats.niceman import NicemanProvenance
 
 from .constants import NICEMAN_SPEC1_YML_FILENAME
@@ -34,3 +37,18 @@ def test_write():
     # and we could do the full round trip while retaining the same "value"
     assert env == env_reparsed
     print(out)
+
+
+def test_write_files():
+    files = ['/usr/bin/afni', '/usr/bin/3dcalc', '/usr/share/afni/a.txt']
+    env = EnvironmentSpec(distributions=[DebianDistribution(
+        name='debian',
+        packages=[DEBPackage(name='afni', files=files)])])
+    output = io.StringIO()
+    NicemanProvenance.write(output, env)
+    out = output.getvalue()
+    # directories are listed once
+    assert out.count('/usr') == 1
+    assert 'afni.txt' not in out and 'share/afni' in out
+    env_reparsed = NicemanProvenance(out).get_environment()
+    assert env_reparsed.distributions[0].packages[0].files == files
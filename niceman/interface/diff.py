@@ -0,0 +1,289 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Helper utility to compare packages of environment specs
+"""
+
+from collections import namedtuple
+
+import attr
+import six
+
+from .base import Interface
+from ..support.param import Parameter
+from ..support.constraints import EnsureStr
+from ..support.exceptions import InsufficientArgumentsError
+
+__docformat__ = 'restructuredtext'
+
+from logging import getLogger
+lgr = getLogger('niceman.api.diff')
+
+
+class Diff(Interface):
+    """Compare packages of environment specs
+
+    Packages of each of the specs are compared with those of the first one:
+    packages added (+), removed (-) or which changed their version or
+    source (~) are listed per type of distribution.
+
+    Examples
+    --------
+
+      $ niceman diff yesterday.yml today.yml
+
+    """
+
+    _params_ = dict(
+        specs=Parameter(
+            args=("specs",),
+            doc="files with specifications (in NICEMAN format) to compare",
+            metavar='SPEC',
+            nargs="+",
+            constraints=EnsureStr(),
+        ),
+    )
+
+    @staticmethod
+    def __call__(specs):
+        from niceman.ui import ui
+        from niceman.formats import Provenance
+
+        if len(specs) < 2:
+            raise InsufficientArgumentsError(
+                "Need at least two specs to compare")
+
+        strings = StringTable()
+        tables = []
+        for spec in specs:
+            lgr.info("reading spec file %s", spec)
+            tables.append(get_spec_tables(
+                Provenance.factory(spec).get_distributions(), strings))
+
+        diffs = []
+        for spec, spec_tables in zip(specs[1:], tables[1:]):
+            ui.message("--- %s\n+++ %s" % (specs[0], spec))
+            spec_diffs = diff_spec_tables(tables[0], spec_tables)
+            for dist_type in sorted(spec_diffs):
+                diff = spec_diffs[dist_type]
+                if not (diff.added or diff.removed or diff.changed):
+                    continue
+                ui.message(dist_type)
+                for row in diff.removed:
+                    ui.message("- %s" % _format_row(row))
+                for row in diff.added:
+                    ui.message("+ %s" % _format_row(row))
+                for old, new in diff.changed:
+                    ui.message("~ %s -> %s"
+                               % (_format_row(old), _format_version(new)))
+            diffs.append(spec_diffs)
+        return diffs
+
+
+class StringTable(object):
+    """Strings interned to be referred to by integer ids
+
+    A table is shared by the package tables of all the compared specs, so
+    every distinct string (name, version, ...) is kept once however many
+    specs mention it, and compared as an integer.  Id 0 stands for None.
+    """
+
+    def __init__(self):
+        self._strings = [None]
+        self._ids = {None: 0}
+
+    def intern(self, value):
+        """Return id of a string (or of a value converted into one)"""
+        try:
+            return self._ids[value]
+        except (KeyError, TypeError):  # new, or not hashable
+            pass
+        if not isinstance(value, six.text_type):
+            value = six.text_type(value)
+        id_ = self._ids.get(value)
+        if id_ is None:
+            id_ = self._ids[value] = len(self._strings)
+            self._strings.append(value)
+        return id_
+
+    def __getitem__(self, id_):
+        return self._strings[id_]
+
+    def __len__(self):
+        return len(self._strings)
+
+
+# Columns of package tables.  Packages are identified by the first three
+# (environment is e.g. a path to a conda or virtualenv environment)
+PACKAGE_COLUMNS = ('environment', 'name', 'architecture', 'version', 'source')
+
+# Attributes of packages of different types providing the columns, in order
+# of preference
+_PACKAGE_ATTRIBUTES = {
+    'name': ('name', 'path', 'id'),
+    'architecture': ('architecture',),
+    'version': ('version', 'hexsha', 'revision'),
+    'source': ('source_name', 'channel_name', 'url'),
+}
+
+
+# Row of a package table with the strings of its columns (a plain tuple
+# since there could be many thousands of them)
+PackageRow = namedtuple('PackageRow', PACKAGE_COLUMNS)
+
+
+class PackagesTable(object):
+    """Interned strings describing packages of distributions
+
+    Packages are kept as ids of their strings, keyed by the ids of their
+    environment, name and architecture, so tables are compared by these
+    keys without looking up any string.
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+        # (environment, name, architecture) -> (version, source)
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, package, environment=None):
+        # packages nested within environments are loaded from specs as dicts
+        get = package.get if isinstance(package, dict) \
+            else lambda a: getattr(package, a, None)
+        row = [self.strings.intern(environment)]
+        for column in PACKAGE_COLUMNS[1:]:
+            value = None
+            for attribute in _PACKAGE_ATTRIBUTES[column]:
+                value = get(attribute)
+                if value is not None:
+                    break
+            row.append(self.strings.intern(value))
+        self._rows[tuple(row[:3])] = tuple(row[3:])
+
+    def add_distribution(self, distribution):
+        """Append packages of a distribution, also within its environments"""
+        for package in getattr(distribution, 'packages', None) or []:
+            self.append(package)
+        for environment in getattr(distribution, 'environments', None) or []:
+            name = getattr(environment, 'path', None) \
+                or getattr(environment, 'name', None)
+            for package in environment.packages:
+                self.append(package, name)
+
+    def get_rows(self):
+        """Return dict (environment, name, architecture) -> (version, source)
+
+        All as ids of the strings.
+        """
+        return self._rows
+
+
+def get_distribution_type(distribution):
+    """Return type of a distribution, e.g. "debian" for DebianDistribution"""
+    name = type(distribution).__name__
+    if name.endswith('Distribution'):
+        name = name[:-len('Distribution')]
+    return name.lower()
+
+
+def get_spec_tables(distributions, strings):
+    """Return tables of packages of distributions per their type
+
+    Parameters
+    ----------
+    distributions : list of Distribution
+    strings : StringTable
+      To intern strings into
+
+    Returns
+    -------
+    dict
+      Type of distribution -> PackagesTable
+    """
+    tables = {}
+    for distribution in distributions:
+        dist_type = get_distribution_type(distribution)
+        if dist_type not in tables:
+            tables[dist_type] = PackagesTable(strings)
+        tables[dist_type].add_distribution(distribution)
+    return tables
+
+
+@attr.s
+class TableDiff(object):
+    """Differences between two tables of packages
+
+    added and removed are lists of PackageRow, and changed is a list of
+    (old, new) PackageRow pairs, all sorted by environment, name and
+    architecture.
+    """
+    added = attr.ib(default=attr.Factory(list))
+    removed = attr.ib(default=attr.Factory(list))
+    changed = attr.ib(default=attr.Factory(list))
+
+
+def diff_tables(old, new):
+    """Compare two tables of packages sharing a string table
+
+    Returns
+    -------
+    TableDiff
+    """
+    old_rows = old.get_rows() if old is not None else {}
+    new_rows = new.get_rows() if new is not None else {}
+    strings = (new if new is not None else old).strings
+    old_keys = set(old_rows)
+    new_keys = set(new_rows)
+    changed = [k for k in old_keys.intersection(new_keys)
+               if old_rows[k] != new_rows[k]]
+
+    # sort and compare as ids, so only rows to return get their strings
+    def sort_key(key):
+        return tuple(strings[id_] or '' for id_ in key)
+
+    def get_row(key, rows):
+        return PackageRow._make(map(strings.__getitem__, key + rows[key]))
+
+    return TableDiff(
+        added=[get_row(k, new_rows) for k in
+               sorted(new_keys.difference(old_keys), key=sort_key)],
+        removed=[get_row(k, old_rows) for k in
+                 sorted(old_keys.difference(new_keys), key=sort_key)],
+        changed=[(get_row(k, old_rows), get_row(k, new_rows))
+                 for k in sorted(changed, key=sort_key)])
+
+
+def diff_spec_tables(old, new):
+    """Compare tables of packages of two specs (see get_spec_tables)
+
+    Returns
+    -------
+    dict
+      Type of distribution -> TableDiff
+    """
+    return dict((dist_type, diff_tables(old.get(dist_type),
+                                        new.get(dist_type)))
+                for dist_type in set(old).union(new))
+
+
+def _format_version(row):
+    version = row.version or ''
+    if row.source:
+        version += ' (%s)' % row.source
+    return version
+
+
+def _format_row(row):
+    name = row.name
+    if row.architecture:
+        name += ':' + row.architecture
+    if row.environment:
+        name = '%s: %s' % (row.environment, name)
+    return '%s %s' % (name, _format_version(row))
@@ -12,17 +12,26 @@
 from __future__ import unicode_literals
 
 from os.path import normpath
+import json
+import os
+import posixpath
 import sys
+import tempfile
 import time
+import uuid
 
 from niceman.resource.session import get_local_session
 from .base import Interface
+from ..support.constraints import EnsureInt
 from ..support.constraints import EnsureNone
 from ..support.constraints import EnsureStr
 from ..support.exceptions import InsufficientArgumentsError
+from ..support.exceptions import ResourceError
 from ..support.param import Parameter
 from ..utils import assure_list
+from ..utils import get_tempfile_kwargs
 from ..utils import to_unicode
+from ..dochelpers import exc_str
 
 __docformat__ = 'restructuredtext'
 
@@ -33,11 +42,19 @@ lgr = getLogger('niceman.api.retrace')
 class Retrace(Interface):
     """Analyze a known (e.g. ReproZip) trace files or just paths to gather detailed package information
 
+    Paths are traced within the local system, or within resources (see
+    'niceman ls') given with --resource.  With multiple resources they are
+    traced concurrently, and a spec is written for each of them into the
+    output file with {resource} replaced by the name of the resource.
+
     Examples
     --------
 
       $ niceman retrace --spec reprozip_run.yml > niceman_config.yml
 
+      $ niceman retrace --resource web1 --resource web2 \\
+          -o '{resource}.yml' /usr/bin/nginx /etc/nginx
+
     """
 
     _params_ = dict(
@@ -57,22 +74,53 @@ class Retrace(Interface):
             constraints=EnsureStr() | EnsureNone()),
         output_file=Parameter(
             args=("-o", "--output-file",),
-            doc="Output file.  If not specified - printed to stdout",
+            doc="""Output file.  If not specified - printed to stdout.  With
+            multiple resources, it must contain {resource} to be replaced
+            with the name of each resource""",
             metavar='output_file',
             constraints=EnsureStr() | EnsureNone(),
         ),
+        resource=Parameter(
+            args=("-r", "--resource",),
+            doc="""Name of the resource to trace paths within, instead of
+            the local system.  Could be given multiple times to trace
+            within multiple resources concurrently.  To see available
+            resources, run the command 'niceman ls'""",
+            metavar='RESOURCE',
+            action='append',
+            constraints=EnsureStr() | EnsureNone(),
+        ),
+        jobs=Parameter(
+            args=("-J", "--jobs",),
+            doc="""Number of resources to trace concurrently.  If not
+            specified, "resource jobs" option of the "retrace" section of
+            the configuration is used (4 by default)""",
+            metavar='NJOBS',
+            constraints=EnsureInt() | EnsureNone(),
+        ),
+        # TODO: should be moved into generic API
+        config=Parameter(
+            args=("-c", "--config",),
+            doc="path to niceman configuration file",
+            metavar='CONFIG',
+            # constraints=EnsureStr(),
+        ),
     )
 
-    # TODO: add a session/resource so we could trace within
-    # arbitrary sessions
     @staticmethod
-    def __call__(path=None, spec=None, output_file=None):
+    def __call__(path=None, spec=None, output_file=None, resource=None,
+                 jobs=None, config=None):
         # heavy import -- should be delayed until actually used
 
         if not (spec or path):
             raise InsufficientArgumentsError(
                 "Need at least a single --spec or a file"
             )
+        resources = assure_list(resource)
+        if len(resources) > 1 and '{resource}' not in (output_file or ''):
+            raise InsufficientArgumentsError(
+                "Need --output-file with {resource} to write a spec for "
+                "each of multiple resources")
 
         paths = assure_list(path)
         if spec:
@@ -87,41 +135,166 @@ class Retrace(Interface):
         # The tracers assume normalized paths.
         paths = list(map(normpath, paths))
 
-        session = get_local_session()
-
-        # TODO: at the moment assumes just a single distribution etc.
-        #       Generalize
-        # TODO: RF so that only the above portion is reprozip specific.
-        # If we are to reuse their layout largely -- the rest should stay as is
-        (distributions, files) = identify_distributions(
-            paths,
-            session=session
-        )
-        from niceman.distributions.base import EnvironmentSpec
-        spec = EnvironmentSpec(
-            distributions=distributions,
-        )
-        if files:
-            spec.files = sorted(files)
-
-        # TODO: generic writer!
-        from niceman.formats.niceman import NicemanProvenance
-        stream = open(output_file, "w") if output_file else sys.stdout
-        NicemanProvenance.write(stream, spec)
-        if stream is not sys.stdout:
-            stream.close()
+        if not resources:
+            trace_paths(paths, get_local_session(), output_file)
+            return
+
+        # Resources are looked up first, since it might need to ask
+        # questions
+        sessions = [(name, get_resource_session(name, config))
+                    for name in resources]
+        if len(sessions) == 1:
+            name, session = sessions[0]
+            try:
+                trace_paths(paths, session, _get_output_file(output_file,
+                                                             name))
+            finally:
+                session.close()
+            return
+        trace_resources(paths, sessions, output_file, jobs=jobs)
+
+
+def get_resource_session(name, config=None):
+    """Return session within an existing resource
+
+    Parameters
+    ----------
+    name : str
+      Name of the resource in the inventory
+    config : str, optional
+      Path to niceman configuration file
+    """
+    from niceman.resource import ResourceManager
+    resource_info, _ = ResourceManager.get_resource_info(config, name)
+    env_resource = ResourceManager.factory(resource_info)
+    env_resource.connect()
+    if not env_resource.id:
+        raise ValueError(
+            "No resource found given the info %s" % str(resource_info))
+    return env_resource.get_session()
+
+
+def _get_output_file(output_file, name):
+    if output_file:
+        output_file = output_file.replace('{resource}', name)
+    return output_file
+
+
+def trace_paths(paths, session, output_file=None):
+    """Trace paths within session and write the spec
+
+    Parameters
+    ----------
+    paths : list of str
+      Normalized paths
+    session : Session
+    output_file : str, optional
+      If not specified, the spec is printed to stdout
+    """
+    # TODO: at the moment assumes just a single distribution etc.
+    #       Generalize
+    # TODO: RF so that only the above portion is reprozip specific.
+    # If we are to reuse their layout largely -- the rest should stay as is
+    (distributions, files) = identify_distributions(
+        paths,
+        session=session
+    )
+    from niceman.distributions.base import EnvironmentSpec
+    spec = EnvironmentSpec(
+        distributions=distributions,
+    )
+    if files:
+        spec.files = sorted(files)
+
+    # TODO: generic writer!
+    from niceman.formats.niceman import NicemanProvenance
+    stream = open(output_file, "w") if output_file else sys.stdout
+    NicemanProvenance.write(stream, spec)
+    if stream is not sys.stdout:
+        stream.close()
+
+
+def trace_resources(paths, sessions, output_file, jobs=None):
+    """Trace the same paths within multiple resources concurrently
+
+    Tracing is mostly waiting for commands to run in the resources, so
+    resources are traced in a pool of threads.  A failure to trace within a
+    resource does not stop tracing within the others.
+
+    Parameters
+    ----------
+    paths : list of str
+      Normalized paths
+    sessions : list of (str, Session)
+      Names of resources and sessions within them
+    output_file : str
+      Where to write the spec for each resource, with {resource} replaced
+      with the name of the resource
+    jobs : int, optional
+      Number of resources to trace concurrently.  If not specified,
+      "resource jobs" option of the "retrace" section of the configuration
+      is used (4 by default)
+
+    Raises
+    ------
+    ResourceError
+      If tracing failed within any of the resources
+    """
+    if jobs is None:
+        from niceman import cfg
+        jobs = cfg.get_as_dtype('retrace', 'resource jobs', int, default=4)
+
+    def trace(name_session):
+        name, session = name_session
+        output = _get_output_file(output_file, name)
+        try:
+            trace_paths(paths, session, output)
+        except Exception as exc:
+            lgr.error("Failed to trace within resource %s: %s",
+                      name, exc_str(exc))
+            return name
+        finally:
+            session.close()
+        lgr.info("Wrote spec of resource %s into %s", name, output)
+        return None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(jobs, len(sessions))))
+    try:
+        failed = [name for name in pool.map(trace, sessions) if name]
+    finally:
+        pool.terminate()
+        pool.join()
+    if failed:
+        raise ResourceError(
+            "Failed to trace within %d out of %d resources: %s"
+            % (len(failed), len(sessions), ', '.join(failed)))
 
 
 # TODO: session should be with a state.  Idea is that if we want
 #  to trace while inheriting all custom PATHs which that run might have
 #  had
-def identify_distributions(files, session=None, tracer_classes=None):
+def identify_distributions(files, session=None, tracer_classes=None,
+                           jobs=None, agent=None):
     """Identify packages files belong to
 
     Parameters
     ----------
     files : iterable
       Files to consider
+    jobs : int, optional
+      Number of tracers to run concurrently, if the session supports
+      concurrent commands.  All the tracers but the first one then process
+      the files left by the first one, and their results are merged in the
+      order of tracer_classes, so files are assigned as if tracers ran one
+      after another.  If not specified,
+      "tracer jobs" option of the "retrace" section of the configuration
+      is used (1 by default)
+    agent : bool, optional
+      Whether to run the tracing agent within the session first (see
+      run_tracing_agent).  If not specified, "agent" option of the
+      "retrace" section of the configuration is used, and by default it is
+      run within sessions other than the local shell
 
     Returns
     -------
@@ -133,6 +306,21 @@ def identify_distributions(files, session=None, tracer_classes=None):
         tracer_classes = get_tracer_classes()
 
     session = session or get_local_session()
+    if jobs is None:
+        from niceman import cfg
+        jobs = cfg.get_as_dtype('retrace', 'tracer jobs', int, default=1)
+    if jobs > 1 and not getattr(session, 'concurrent_commands', False):
+        lgr.debug("Session %s does not support concurrent commands, "
+                  "running tracers sequentially", session)
+        jobs = 1
+    if agent is None:
+        from niceman import cfg
+        from niceman.resource.session import POSIXSession
+        from niceman.resource.shell import ShellSession
+        agent = cfg.getboolean(
+            'retrace', 'agent',
+            default=isinstance(session, POSIXSession)
+            and not isinstance(session, ShellSession))
     # TODO create list of appropriate for the `environment` OS tracers
     #      in case of no environment -- get current one
     # TODO: should operate in the session, might be given additional information
@@ -143,6 +331,18 @@ def identify_distributions(files, session=None, tracer_classes=None):
     # as they identify files beloning to them
     files_to_consider = set(files)
 
+    # Gather information about all the files at once, to be shared with
+    # tracers, and discarding what might have been gathered before
+    stat_cache = session.stat_cache
+    stat_cache.clear()
+    hints = {}
+    if agent:
+        hints = run_tracing_agent(
+            session, files_to_consider,
+            sorted(set(marker for Tracer in tracer_classes
+                       for marker in getattr(Tracer, 'ROOT_MARKERS', ()))))
+    stat_cache.prefetch(files_to_consider)
+
     distibutions = []
     files_processed = set()
     files_to_trace = files_to_consider
@@ -161,9 +361,18 @@ def identify_distributions(files, session=None, tracer_classes=None):
             break
 
         # Identify directories from the files_to_consider
-        dirs = set(filter(session.isdir, files_to_trace))
-
-        for Tracer in tracer_classes:
+        stat_cache.prefetch(files_to_trace)  # tracers might add new files
+        dirs = set(filter(stat_cache.isdir, files_to_trace))
+
+        speculative = {}
+        for itracer, Tracer in enumerate(tracer_classes):
+            if itracer == 1 and jobs > 1 and files_to_consider:
+                # The first tracer (of the system packages) usually assigns
+                # most of the files, so the rest run concurrently over the
+                # files it left
+                speculative = _trace_concurrently(
+                    tracer_classes[1:], session, files_to_consider, dirs,
+                    jobs, hints)
             lgr.debug("Tracing using %s", Tracer.__name__)
 
             # Pull out directories if the tracer can't handle them
@@ -174,23 +383,23 @@ def identify_distributions(files, session=None, tracer_classes=None):
                 files_to_trace = files_to_consider - dirs
                 files_skipped = files_to_consider - files_to_trace
 
-            tracer = Tracer(session=session)
+            tracer = Tracer(session=session, hints=hints)
             begin = time.time()
             # yoh things the idea was that tracer might trace even without
             #     files, so we should not just 'continue' the loop if there is no
             #     files_to_trace
             if files_to_trace:
-                remaining_files_to_trace = files_to_trace
-                nenvs = 0
-                for env, remaining_files_to_trace in tracer.identify_distributions(
-                        files_to_trace):
-                    distibutions.append(env)
-                    nenvs += 1
+                traced = _merge_speculative(
+                    speculative.get(Tracer), files_to_trace)
+                if traced is None:
+                    traced = _trace(tracer, files_to_trace)
+                envs, remaining_files_to_trace = traced
+                distibutions.extend(envs)
                 files_processed |= files_to_trace - remaining_files_to_trace
                 files_to_trace = remaining_files_to_trace
                 lgr.info("%s: %d envs with %d other files remaining",
                          Tracer.__name__,
-                         nenvs,
+                         len(envs),
                          len(files_to_trace))
 
             # Re-combine any files that were skipped
@@ -207,6 +416,162 @@ def identify_distributions(files, session=None, tracer_classes=None):
     return distibutions, files_to_consider
 
 
+def _trace(tracer, files):
+    """Run a tracer over files
+
+    Returns
+    -------
+    envs : list of Distribution
+    remaining_files : set
+      Files not assigned to any of envs, as the last one reported by tracer
+    """
+    envs = []
+    remaining_files = files
+    for env, remaining_files in tracer.identify_distributions(files):
+        envs.append(env)
+    return envs, remaining_files
+
+
+def _trace_concurrently(tracer_classes, session, files, dirs, jobs, hints):
+    """Speculatively run all tracers over the same files in a thread pool
+
+    Returns
+    -------
+    dict
+      Tracer class -> (files, envs, remaining_files), with files traced.
+      Tracers which failed are not included, so they get to run again
+      (and fail) in order.
+    """
+    def trace(Tracer):
+        files_to_trace = files if Tracer.HANDLES_DIRS else files - dirs
+        if not files_to_trace:
+            return None
+        try:
+            return (files_to_trace,) + _trace(
+                Tracer(session=session, hints=hints), files_to_trace)
+        except Exception as exc:
+            lgr.debug("Speculative tracing with %s failed: %s",
+                      Tracer.__name__, exc_str(exc))
+            return None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(tracer_classes)))
+    try:
+        results = pool.map(trace, tracer_classes)
+    finally:
+        pool.terminate()
+        pool.join()
+    return dict((Tracer, result)
+                for Tracer, result in zip(tracer_classes, results)
+                if result is not None)
+
+
+def _merge_speculative(traced, files_to_trace):
+    """Adopt results of a speculative tracing for the files left to trace
+
+    Results are valid only if the tracer did not assign any file which
+    a preceding tracer has assigned already, otherwise None is returned, so
+    the tracer should run again over files_to_trace.
+
+    Returns
+    -------
+    (envs, remaining_files) or None
+    """
+    if traced is None:
+        return None
+    files, envs, remaining_files = traced
+    assigned = files - remaining_files
+    if not assigned <= files_to_trace:
+        lgr.debug("%d files are already assigned by preceding tracers",
+                  len(assigned - files_to_trace))
+        return None
+    # tracer might also report new files to trace
+    return envs, (files_to_trace - assigned) | (remaining_files - files)
+
+
+# Runs the agent with the first python found, and removes its files
+_AGENT_COMMAND = [
+    'sh', '-c',
+    'trap \'rm -f "$1" "$2"\' EXIT; '
+    'for python in python3 python python2; do '
+    'if command -v $python >/dev/null 2>&1; then $python "$@"; exit; fi; '
+    'done; exit 127',
+    'niceman-agent']
+
+
+def run_tracing_agent(session, files, markers):
+    """Gather information about files at once, running an agent within session
+
+    Tracers would otherwise run commands in the session for every file,
+    directory or repository they look at.  The agent
+    (niceman.distributions.tracing_agent) is copied into the session and
+    gathers all the information tracers need (details of paths, dpkg and git
+    ownership of files, virtualenvs) in a single run.  Details of paths are
+    added to the stat cache of the session.
+
+    Parameters
+    ----------
+    session : Session
+    files : iterable of str
+      Only absolute paths are considered
+    markers : list of str
+      Names to look for within directories above files (see
+      DistributionTracer.ROOT_MARKERS)
+
+    Returns
+    -------
+    dict
+      Hints for tracers (see DistributionTracer).  Empty if the agent could
+      not run, e.g. since there is no python within the session
+    """
+    from niceman.distributions import tracing_agent
+    from niceman.resource.session import PathStat
+    files = sorted(f for f in files if posixpath.isabs(f))
+    if not files:
+        return {}
+    agent_file = os.path.splitext(tracing_agent.__file__)[0] + '.py'
+    remote_prefix = '/tmp/niceman-agent-%s' % uuid.uuid4().hex
+    fd, request_file = tempfile.mkstemp(
+        **get_tempfile_kwargs({'suffix': '.json'}, prefix='agent'))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'files': files, 'markers': markers}, f)
+        session.put(agent_file, remote_prefix + '.py')
+        session.put(request_file, remote_prefix + '.json')
+        out, _ = session.execute_command(
+            _AGENT_COMMAND + [remote_prefix + '.py', remote_prefix + '.json'])
+        result = json.loads(to_unicode(out))
+    except Exception as exc:
+        lgr.debug("Could not run the tracing agent, tracers will look at "
+                  "files on their own: %s", exc_str(exc))
+        try:
+            session.execute_command(
+                ['rm', '-f', remote_prefix + '.py', remote_prefix + '.json'])
+        except Exception:
+            pass
+        return {}
+    finally:
+        os.unlink(request_file)
+    lgr.debug("Tracing agent gathered information about %d files",
+              len(files))
+
+    stats = dict(
+        (path, PathStat(type=type_, size=size, mtime=mtime, link=link,
+                        target_type=target_type))
+        for path, (type_, size, mtime, link, target_type)
+        in result['stats'].items())
+    paths = files + ['%s/%s' % (dirpath, marker)
+                     for dirpath in result['probed'] for marker in markers]
+    session.stat_cache.update(dict((p, stats.get(p)) for p in paths))
+    return {
+        'files': set(files),
+        'debian': result['debian'],
+        'git': result['git'],
+        'vcs_unresolved': set(result['vcs_unresolved']),
+        'venvs': result['venvs'],
+    }
+
+
 def get_tracer_classes():
     """A helper which returns a list of all available Tracers
 
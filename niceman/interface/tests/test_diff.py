@@ -0,0 +1,110 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import pytest
+
+from niceman.cmdline.main import main
+from niceman.distributions.base import EnvironmentSpec
+from niceman.distributions.conda import CondaDistribution
+from niceman.distributions.conda import CondaEnvironment
+from niceman.distributions.conda import CondaPackage
+from niceman.distributions.debian import DebianDistribution
+from niceman.distributions.debian import DEBPackage
+from niceman.formats.niceman import NicemanProvenance
+from niceman.interface.diff import StringTable
+from niceman.interface.diff import PackageRow
+from niceman.interface.diff import get_spec_tables
+from niceman.interface.diff import diff_spec_tables
+from niceman.utils import swallow_outputs
+
+
+def _conda_package(name, version, channel='conda-forge'):
+    return CondaPackage(name=name, installer=None, version=version,
+                        build=None, channel_name=channel, size=None,
+                        md5=None, url=None)
+
+
+def _get_spec(deb_packages, conda_packages):
+    return [
+        DebianDistribution(name='debian', packages=deb_packages),
+        CondaDistribution(name='conda', environments=[
+            CondaEnvironment(name='root', path='/opt/conda',
+                             packages=conda_packages)])]
+
+
+def test_diff_spec_tables():
+    strings = StringTable()
+    old = get_spec_tables(_get_spec(
+        [DEBPackage(name='a', version='1', architecture='amd64'),
+         DEBPackage(name='a', version='1', architecture='i386'),
+         DEBPackage(name='b', version='1', source_name='bsrc'),
+         DEBPackage(name='c', version='1')],
+        [_conda_package('numpy', '1.13')]), strings)
+    new = get_spec_tables(_get_spec(
+        [DEBPackage(name='a', version='2', architecture='amd64'),
+         DEBPackage(name='a', version='1', architecture='i386'),
+         DEBPackage(name='b', version='1', source_name='b-src'),
+         DEBPackage(name='d', version='1')],
+        [_conda_package('numpy', '1.13')]), strings)
+    n_strings = len(strings)
+    # strings are shared
+    get_spec_tables(_get_spec(
+        [DEBPackage(name='a', version='1', architecture='amd64')], []),
+        strings)
+    assert len(strings) == n_strings
+
+    diff = diff_spec_tables(old, new)
+    assert sorted(diff) == ['conda', 'debian']
+    assert not (diff['conda'].added or diff['conda'].removed
+                or diff['conda'].changed)
+    debian = diff['debian']
+    assert debian.added == [PackageRow(None, 'd', None, '1', None)]
+    assert debian.removed == [PackageRow(None, 'c', None, '1', None)]
+    assert debian.changed == [
+        (PackageRow(None, 'a', 'amd64', '1', None),
+         PackageRow(None, 'a', 'amd64', '2', None)),
+        (PackageRow(None, 'b', None, '1', 'bsrc'),
+         PackageRow(None, 'b', None, '1', 'b-src'))]
+
+    # distributions present in only one of the specs
+    diff = diff_spec_tables(old, {})
+    assert len(diff['conda'].removed) == 1
+    assert len(diff['debian'].removed) == 4
+
+
+def _write_spec(path, distributions):
+    with open(path, 'w') as f:
+        NicemanProvenance.write(f, EnvironmentSpec(distributions=distributions))
+    return path
+
+
+def test_diff_interface(tmpdir):
+    spec1 = _write_spec(str(tmpdir.join('spec1.yml')), _get_spec(
+        [DEBPackage(name='a', version='1', architecture='amd64')],
+        [_conda_package('numpy', '1.13')]))
+    spec2 = _write_spec(str(tmpdir.join('spec2.yml')), _get_spec(
+        [DEBPackage(name='a', version='2', architecture='amd64')],
+        [_conda_package('numpy', '1.13'), _conda_package('scipy', '1.0')]))
+
+    with swallow_outputs() as cm:
+        main(['diff', spec1, spec2, spec1])
+        out = cm.out
+    assert out.splitlines() == [
+        '--- %s' % spec1,
+        '+++ %s' % spec2,
+        'conda',
+        '+ /opt/conda: scipy 1.0 (conda-forge)',
+        'debian',
+        '~ a:amd64 1 -> 2',
+        '--- %s' % spec1,
+        '+++ %s' % spec1,
+    ]
+
+    with pytest.raises(SystemExit):
+        main(['diff', spec1])
@@ -9,8 +9,9 @@
 
 from niceman.cmdline.main import main
 
+import io
 import logging
-from mock import patch, call, MagicMock
+from mock import patch, call, MagicMock, ANY
 
 from ...utils import swallow_logs
 from ...tests.utils import assert_in
@@ -23,6 +24,7 @@ def test_install_interface(demo1_spec, niceman_cfg_path):
         patch('niceman.resource.ResourceManager.set_inventory'), \
         patch('niceman.resource.ResourceManager.get_inventory') as get_inventory, \
         patch('requests.get') as requests, \
+        patch('niceman.resource.docker_container.DockerSession.put') as put, \
         swallow_logs(new_level=logging.DEBUG) as log:
 
         client.return_value = MagicMock(
@@ -33,7 +35,8 @@ def test_install_interface(demo1_spec, niceman_cfg_path):
                     'State': 'running'
                 }
             ],
-            exec_inspect=lambda id: { 'ExitCode': 0 }
+            exec_inspect=lambda id: { 'ExitCode': 0 },
+            exec_start=lambda exec_id, socket: io.BytesIO()
         )
 
         get_inventory.return_value = {
@@ -65,23 +68,18 @@ def test_install_interface(demo1_spec, niceman_cfg_path):
         calls = [
             call(base_url='tcp://127.0.0.1:2375'),
             call().exec_create(cmd=['bash', '-c', 'test -e /etc/apt/sources.list.d/niceman.sources.list && echo Found'], container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd='sh -c \'echo "# Niceman repo sources" > /etc/apt/sources.list.d/niceman.sources.list\'', container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd="grep -q 'deb http://snapshot.debian.org/archive/debian/20170531T084046Z/ sid main contrib non-free' /etc/apt/sources.list.d/niceman.sources.list", container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd="grep -q 'deb http://snapshot.debian.org/archive/debian/20171208T032012Z/ sid main contrib non-free' /etc/apt/sources.list.d/niceman.sources.list", container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd="grep -q 'deb http://snapshot-neuro.debian.net:5002/archive/neurodebian/20171208T032012Z/ xenial main contrib non-free' /etc/apt/sources.list.d/niceman.sources.list", container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd="grep -q 'deb http://snapshot-neuro.debian.net:5002/archive/neurodebian/20171208T032012Z/ xenial main contrib non-free' /etc/apt/sources.list.d/niceman.sources.list", container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd=['apt-key', 'adv', '--recv-keys', '--keyserver', 'hkp://pool.sks-keyservers.net:80', '0xA5D32F012649A5A9'], container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd="grep -q 'deb http://snapshot-neuro.debian.net:5002/archive/neurodebian/20171208T032012Z/ xenial main contrib non-free' /etc/apt/sources.list.d/niceman.sources.list", container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
-            call().exec_create(cmd="grep -q 'deb http://snapshot-neuro.debian.net:5002/archive/neurodebian/20171208T032012Z/ xenial main contrib non-free' /etc/apt/sources.list.d/niceman.sources.list", container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
             call().exec_create(cmd=['apt-key', 'adv', '--recv-keys', '--keyserver', 'hkp://pool.sks-keyservers.net:80', '0xA5D32F012649A5A9'], container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']}),
             call().exec_create(cmd=['apt-get', '-o', 'Acquire::Check-Valid-Until=false', 'update'], container={'Id': '326b0fdfbf838', 'State': 'running', 'Names': ['/my-resource']})
         ]
         client.assert_has_calls(calls, any_order=True)
+        # sources list is written at once
+        put.assert_called_once_with(
+            ANY, '/etc/apt/sources.list.d/niceman.sources.list')
 
         assert_in('Adding Debian update to environment command list.', log.lines)
         assert_in("Running command ['bash', '-c', 'test -e /etc/apt/sources.list.d/niceman.sources.list && echo Found']", log.lines)
-        assert_in('Running command "grep -q \'deb http://snapshot.debian.org/archive/debian/20170531T084046Z/ sid main contrib non-free\' /etc/apt/sources.list.d/niceman.sources.list"', log.lines)
-        assert_in('Running command "grep -q \'deb http://snapshot.debian.org/archive/debian/20171208T032012Z/ sid main contrib non-free\' /etc/apt/sources.list.d/niceman.sources.list"', log.lines)
-        assert_in('Running command "grep -q \'deb http://snapshot-neuro.debian.net:5002/archive/neurodebian/20171208T032012Z/ xenial main contrib non-free\' /etc/apt/sources.list.d/niceman.sources.list"', log.lines)
+        assert_in("Adding line 'deb http://snapshot.debian.org/archive/debian/20170531T084046Z/ sid main contrib non-free' to /etc/apt/sources.list.d/niceman.sources.list", log.lines)
+        assert_in("Adding line 'deb http://snapshot.debian.org/archive/debian/20171208T032012Z/ sid main contrib non-free' to /etc/apt/sources.list.d/niceman.sources.list", log.lines)
+        assert_in("Adding line 'deb http://snapshot-neuro.debian.net:5002/archive/neurodebian/20171208T032012Z/ xenial main contrib non-free' to /etc/apt/sources.list.d/niceman.sources.list", log.lines)
         assert_in("Running command ['apt-key', 'adv', '--recv-keys', '--keyserver', 'hkp://pool.sks-keyservers.net:80', '0xA5D32F012649A5A9']", log.lines)
         assert_in("Running command ['apt-get', '-o', 'Acquire::Check-Valid-Until=false', 'update']", log.lines)
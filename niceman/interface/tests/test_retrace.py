@@ -11,11 +11,30 @@ from niceman.cmdline.main import main
 from niceman.formats import Provenance
 
 import logging
+import os
+import threading
+
+from mock import patch
+from pytest import raises
 
 from niceman.utils import swallow_logs, swallow_outputs, make_tempfile
 from niceman.tests.utils import assert_in, skip_if_no_apt_cache
+from niceman.tests.fixtures import git_repo_fixture
 
+from niceman.distributions.vcs import GitRepoShim
+from niceman.distributions.vcs import VCSTracer
+from niceman.distributions.venv import VenvTracer
+from niceman.resource.session import PathStat
+from niceman.resource.session import StatCache
+from niceman.resource.shell import ShellSession
+from niceman.support.exceptions import ResourceError
+from ..retrace import get_resource_session
 from ..retrace import identify_distributions
+from ..retrace import run_tracing_agent
+from ..retrace import trace_resources
+
+git_repo = git_repo_fixture()
+
 
 def test_retrace(reprozip_spec2):
     """
@@ -53,12 +72,15 @@ def test_retrace_normalize_paths():
 def get_tracer_session(protocols):
     class FakeSession(object):
         """A fake session attributes and methods of which should not
-        actually be used only but isdir.
+        actually be used only but stat_cache.
         If anything else is accessed, it means that we have some assumptions
         """
 
-        def isdir(self, _):
-            return False  # TODO: make it parametric
+        def __init__(self):
+            self.stat_cache = StatCache(self)
+
+        def stat_many(self, paths):
+            return {}  # TODO: make it parametric
 
     tracer_classes = []
     for itracer, protocol in enumerate(protocols):
@@ -67,7 +89,7 @@ def get_tracer_session(protocols):
             _protocol = protocol[:]
             HANDLES_DIRS = False  # ???
 
-            def __init__(self, session):
+            def __init__(self, session, hints=None):
                 assert session
                 assert self._protocol, \
                     "No more protocols to go through, but were were asked to"
@@ -146,4 +168,158 @@ def test_retrace_loop_over_tracers():
         ],
         files=["file1", "file2"],
         tenvs=['Env1', 'Env2', 'Env2.1', 'Env3'],
-        tfiles={'file3'})
\ No newline at end of file
+        tfiles={'file3'})
+
+
+def _get_prefix_tracer(prefix, handles_dirs=False, started=None, wait=None):
+    """Tracer assigning files starting with prefix to an env of that name"""
+    class PrefixTracer(object):
+        HANDLES_DIRS = handles_dirs
+        inputs = []
+
+        def __init__(self, session, hints=None):
+            pass
+
+        def identify_distributions(self, files):
+            self.inputs.append(set(files))
+            if started:
+                started.set()
+            if wait:
+                # would time out if tracers were not run concurrently
+                assert wait.wait(10)
+            assigned = set(f for f in files if f.startswith(prefix))
+            if assigned:
+                yield (prefix, sorted(assigned)), set(files) - assigned
+    PrefixTracer.__name__ = "PrefixTracer_%s" % prefix
+    return PrefixTracer
+
+
+def test_identify_distributions_concurrent():
+    class Session(object):
+        concurrent_commands = True
+
+        def __init__(self):
+            self.stat_cache = StatCache(self)
+
+        def stat_many(self, paths):
+            return dict((p, PathStat(type='d', target_type='d'))
+                        for p in paths if p.endswith('/'))
+
+    files = ['a1', 'b1', 'b2', 'bc1', 'c1', 'd/', 'z']
+    c_started = threading.Event()
+
+    def get_tracers(concurrent):
+        return [
+            _get_prefix_tracer('a'),
+            _get_prefix_tracer(
+                'b', wait=c_started if concurrent else None),
+            # would claim bc1 which is already claimed by 'b'
+            _get_prefix_tracer('bc', started=c_started),
+            _get_prefix_tracer('c'),
+            _get_prefix_tracer('d', handles_dirs=True),
+        ]
+
+    tracers = get_tracers(False)
+    dists, unknown_files = identify_distributions(
+        files, Session(), tracer_classes=tracers, jobs=1)
+    assert dists == [('a', ['a1']), ('b', ['b1', 'b2', 'bc1']),
+                     ('c', ['c1']), ('d', ['d/'])]
+    assert unknown_files == {'z'}
+
+    tracers_concurrent = get_tracers(True)
+    assert (dists, unknown_files) == identify_distributions(
+        files, Session(), tracer_classes=tracers_concurrent, jobs=4)
+    # 'bc' tracer ran again over the files left by the 'b' one, so in
+    # the first iteration it processed files twice while others once
+    assert [len(t.inputs) for t in tracers_concurrent] == \
+        [len(t.inputs) + i for i, t in zip([0, 0, 1, 0, 0], tracers)]
+    assert tracers_concurrent[2].inputs[:2] == [
+        {'b1', 'b2', 'bc1', 'c1', 'z'}, {'c1', 'z'}]
+
+
+def test_identify_distributions_agent(git_repo, tmpdir):
+    venv = tmpdir.mkdir('venv')
+    venv.mkdir('bin').join('activate').write('')  # not a virtualenv
+    files = [os.path.join(git_repo, 'foo'),
+             os.path.join(git_repo, 'subdir', 'baz'),
+             str(venv.join('bin', 'activate'))]
+    tracer_classes = [VenvTracer, VCSTracer]
+    dists, unknown = identify_distributions(
+        files, session=ShellSession(), tracer_classes=tracer_classes,
+        agent=False)
+
+    session = ShellSession()
+    hints = run_tracing_agent(session, files, ['bin/activate'])
+    assert hints['git'] == dict((f, git_repo) for f in files[:2])
+    assert hints['venvs'] == {str(venv): False}
+    assert session.stat_cache.isdir(str(venv.join('bin')))
+    assert not session.stat_cache.exists(str(tmpdir.join('bin/activate')))
+
+    # no commands to find repositories or virtualenvs
+    with patch.object(GitRepoShim, 'get_at_dirpath',
+                      side_effect=AssertionError("looked for repository")), \
+            patch.object(ShellSession, 'stat_many',
+                         side_effect=AssertionError("stat files")), \
+            patch.object(ShellSession, 'read_many',
+                         side_effect=AssertionError("read files")):
+        dists_agent, unknown_agent = identify_distributions(
+            files, session=ShellSession(), tracer_classes=tracer_classes,
+            agent=True)
+    assert dists_agent == dists
+    assert unknown_agent == unknown == {files[2]}
+
+
+def test_run_tracing_agent_fails(tmpdir):
+    session = ShellSession()
+    with patch.object(session, 'put', side_effect=[None, OSError("full")]):
+        assert run_tracing_agent(session, ['/bin/sh'], ['bin']) == {}
+    with patch.object(session, 'put'), \
+            patch.object(session, '_execute_command',
+                         return_value=('garbage', '')):
+        assert run_tracing_agent(session, ['/bin/sh'], ['bin']) == {}
+    assert run_tracing_agent(session, ['relative'], ['bin']) == {}
+
+
+def test_retrace_resources(niceman_cfg_path, tmpdir):
+    path = str(tmpdir.join('file'))
+    with open(path, 'w') as f:
+        f.write('content')
+    inventory = dict(
+        (name, {'type': 'shell', 'name': name, 'id': name + '-id'})
+        for name in ('local1', 'local2'))
+    # tracers which do not need anything installed
+    with patch('niceman.resource.ResourceManager.get_inventory',
+               return_value=inventory), \
+            patch('niceman.interface.retrace.get_tracer_classes',
+                  return_value=[VenvTracer, VCSTracer]):
+        with swallow_outputs(), \
+                swallow_logs(new_level=logging.ERROR) as log:
+            with raises(SystemExit):
+                main(['retrace', '-c', niceman_cfg_path, '-r', 'local1',
+                      '-r', 'local2', path])
+            assert_in('InsufficientArgumentsError', log.out)
+        main(['retrace', '-c', niceman_cfg_path,
+              '-r', 'local1', '-r', 'local2', '-J', '2',
+              '-o', str(tmpdir.join('{resource}.yml')), path])
+        for name in inventory:
+            with open(str(tmpdir.join(name + '.yml'))) as f:
+                assert_in(path, f.read())
+
+        # a failure within a resource does not stop tracing in the others
+        os.unlink(str(tmpdir.join('local2.yml')))
+
+        def identify(paths, session):
+            if session is sessions[0]:
+                raise RuntimeError("no luck")
+            return [], set(paths)
+
+        sessions = [get_resource_session(name, niceman_cfg_path)
+                    for name in sorted(inventory)]
+        with patch('niceman.interface.retrace.identify_distributions',
+                   identify), \
+                raises(ResourceError) as cm:
+            trace_resources([path], list(zip(sorted(inventory), sessions)),
+                            str(tmpdir.join('{resource}.yml')))
+        assert 'local1' in str(cm.value)
+        assert 'local2' not in str(cm.value)
+        assert tmpdir.join('local2.yml').check()
@@ -10,15 +10,20 @@
 
 import attr
 import docker
+from contextlib import contextmanager
 import dockerpty
-import io
 import json
 import os
+import struct
 import tarfile
+import threading
 from niceman import utils
 from ..support.exceptions import CommandError, ResourceError
 from niceman.dochelpers import borrowdoc
 from niceman.resource.session import POSIXSession, Session
+from niceman.resource.session import ShellMarkers
+from niceman.resource.session import get_shell_script
+from niceman.resource.session import iter_tar_chunks
 from .base import Resource, attrib
 
 import logging
@@ -154,48 +159,222 @@ class DockerContainer(Resource):
         )
 
 
+# Size of the header of frames multiplexing stdout and stderr of an exec
+_FRAME_HEADER = struct.Struct('>BxxxL')
+_STDERR = 2
+_BUFSIZE = 1 << 16
+
+
+def _demultiplex(data, out, err):
+    """Append payloads of complete frames in data to out and err
+
+    Outputs of an exec (without tty) come as frames with a header of the
+    stream (1 for stdout, 2 for stderr) and of the payload size.
+
+    Returns
+    -------
+    int
+      Number of bytes of data consumed
+    """
+    pos = 0
+    while len(data) - pos >= _FRAME_HEADER.size:
+        stream, size = _FRAME_HEADER.unpack_from(data, pos)
+        start = pos + _FRAME_HEADER.size
+        if len(data) - start < size:
+            break
+        (err if stream == _STDERR else out).extend(data[start:start + size])
+        pos = start + size
+    return pos
+
+
+def _get_exec_socket(client, container, command, stdin=False):
+    """Start command within container, and return socket attached to it"""
+    kwargs = {'stdin': True} if stdin else {}
+    execute = client.exec_create(container=container, cmd=command, **kwargs)
+    sock = client.exec_start(exec_id=execute['Id'], socket=True)
+    # the client's timeout is set on the socket, but a command could take
+    # any time to produce its output
+    for s in sock, getattr(sock, '_sock', None):
+        if hasattr(s, 'settimeout'):
+            s.settimeout(None)
+    return execute['Id'], sock
+
+
+# The socket is a file-like object (SocketIO) under Python 3, unless it is
+# over TLS
+def _recv(sock):
+    if hasattr(sock, 'recv'):
+        return sock.recv(_BUFSIZE)
+    return sock.read(_BUFSIZE)
+
+
+def _sendall(sock, data):
+    if hasattr(sock, 'sendall'):
+        sock.sendall(data)
+        return
+    data = memoryview(data)
+    while data:
+        data = data[sock.write(data):]
+
+
+class _ExecOutput(object):
+    """Stdout of an exec read from its socket as a file, keeping stderr"""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._data = bytearray()
+        self._out = bytearray()
+        self.err = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._out) < size):
+            chunk = _recv(self._sock)
+            if not chunk:
+                self._eof = True
+                break
+            self._data += chunk
+            del self._data[:_demultiplex(self._data, self._out, self.err)]
+        if size < 0 or size > len(self._out):
+            size = len(self._out)
+        data = bytes(self._out[:size])
+        del self._out[:size]
+        return data
+
+
+class ContainerShell(object):
+    """Shell within a container executing commands one after another
+
+    As RemoteShell of ssh sessions, but with the shell started by a single
+    exec, so running a command does not take creating, starting and
+    inspecting an exec for it.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._markers = ShellMarkers()
+
+    @classmethod
+    def open(cls, client, container):
+        _, sock = _get_exec_socket(client, container, ['/bin/sh'],
+                                   stdin=True)
+        return cls(sock)
+
+    def run(self, command, env=None, cwd=None):
+        """Run a command (see DockerSession.execute_command)
+
+        Returns
+        -------
+        (exit code, stdout, stderr)
+          Outputs as bytes
+        """
+        _sendall(self._sock, self._markers.get_script(command, env, cwd))
+        data, out, err = bytearray(), bytearray(), bytearray()
+        exit_code = None
+        err_done = False
+        while True:
+            chunk = _recv(self._sock)
+            if not chunk:
+                raise CommandError(
+                    str(command),
+                    "Shell within the container exited while running %r"
+                    % (command,))
+            data += chunk
+            del data[:_demultiplex(data, out, err)]
+            if exit_code is None:
+                exit_code = self._markers.pop_exit_code(out)
+            if not err_done:
+                err_done = self._markers.pop_err_end(err)
+            if exit_code is not None and err_done:
+                return exit_code, bytes(out), bytes(err)
+
+    def close(self):
+        self._sock.close()
+
+
 @attr.s
 class DockerSession(POSIXSession):
     client = attr.ib()
     container = attr.ib()
+    # Whether to run commands in shells kept running within the container
+    # instead of an exec for each command.  If None, "persistent shell"
+    # option of the "docker" section of the configuration is used
+    # (False by default)
+    persistent_shell = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        super(DockerSession, self).__attrs_post_init__()
+        if self.persistent_shell is None:
+            from niceman import cfg
+            self.persistent_shell = cfg.getboolean(
+                'docker', 'persistent shell', default=False)
+        self._shells = []  # idle ContainerShells, started as needed
+        self._lock = threading.Lock()
+
+    def _run_exec(self, command, env=None, cwd=None):
+        """Run command in an exec of its own
 
-    @borrowdoc(Session)
-    def _execute_command(self, command, env=None, cwd=None):
-        #command_env = self.get_updated_env(env)
-        if env:
-            raise NotImplementedError("passing env variables to docker session execution")
-
-        if cwd:
-            raise NotImplementedError("handle cwd for docker")
-        # if command_env:
-            # TODO: might not work - not tested it
-            # command = ['export %s=%s' % k for k in command_env.items()] + command
-
+        Returns
+        -------
+        (exit code, stdout, stderr)
+          Outputs as bytes
+        """
+        if env or cwd:
+            command = ['sh', '-c', get_shell_script(command, env, cwd)]
         # The following call may throw the following exception:
         #    docker.errors.APIError - If the server returns an error.
+        exec_id, sock = _get_exec_socket(self.client, self.container,
+                                         command)
+        try:
+            output = _ExecOutput(sock)
+            out, err = output.read(), bytes(output.err)
+        finally:
+            sock.close()
+        for output in out, err:
+            if output.startswith(b'rpc error'):
+                raise CommandError(cmd=str(command),
+                                   msg="Docker error - %s" % output)
+        exit_code = self.client.exec_inspect(exec_id)['ExitCode']
+        return exit_code, out, err
+
+    def _run_in_shell(self, command, env=None, cwd=None):
+        with self._lock:
+            shell = self._shells.pop() if self._shells else None
+        if shell is None:
+            shell = ContainerShell.open(self.client, self.container)
+        try:
+            result = shell.run(command, env, cwd)
+        except Exception:
+            shell.close()
+            raise
+        with self._lock:
+            self._shells.append(shell)
+        return result
+
+    @borrowdoc(Session)
+    def _execute_command(self, command, env=None, cwd=None):
         lgr.debug('Running command %r', command)
-        out = []
-        execute = self.client.exec_create(container=self.container, cmd=command)
-        out = ''
-        for i, line in enumerate(
-                self.client.exec_start(exec_id=execute['Id'],
-                stream=True)
-        ):
-            if line.startswith(b'rpc error'):
-                raise CommandError(cmd=command, msg="Docker error - %s" % line)
-            out += utils.to_unicode(line, "utf-8")
-            lgr.debug("exec#%i: %s", i, line.rstrip())
-
-        exit_code = self.client.exec_inspect(execute['Id'])['ExitCode']
+        run = self._run_in_shell if self.persistent_shell else self._run_exec
+        exit_code, out, err = run(command, env, cwd)
+        out = utils.to_unicode(out, "utf-8")
+        err = utils.to_unicode(err, "utf-8")
+
         if exit_code not in [0, None]:
             msg = "Failed to run %r. Exit code=%d. out=%s err=%s" \
-                % (command, exit_code, out, out)
-            raise CommandError(str(command), msg, exit_code, '', out)
+                % (command, exit_code, out, err)
+            raise CommandError(str(command), msg, exit_code, out, err)
         else:
             lgr.log(8, "Finished running %r with status %s", command,
                 exit_code)
 
-        return (out, '')
+        return (out, err)
+
+    @borrowdoc(Session)
+    def close(self):
+        with self._lock:
+            shells, self._shells = self._shells, []
+        for shell in shells:
+            shell.close()
 
     # XXX should we start/stop on open/close or just assume that it is running already?
 
@@ -207,13 +386,9 @@ class DockerSession(POSIXSession):
         dest_dir, dest_basename = os.path.split(dest_path)
         if not self.exists(dest_dir):
             self.mkdir(dest_dir, parents=True)
-        tar_stream = io.BytesIO()
-        tar_file = tarfile.TarFile(fileobj=tar_stream, mode='w')
-        tar_file.add(src_path, arcname=dest_basename)
-        tar_file.close()
-        tar_stream.seek(0)
+        # the archive is streamed as it is written
         self.client.put_archive(container=self.container['Id'], path=dest_dir,
-            data=tar_stream)
+            data=iter_tar_chunks([(src_path, dest_basename)]))
 
         if uid > -1 or gid > -1:
             self.chown(dest_path, uid, gid)
@@ -225,13 +400,39 @@ class DockerSession(POSIXSession):
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
         stream, stat = self.client.get_archive(self.container, src_path)
-        tarball = tarfile.open(fileobj=io.BytesIO(stream.read()))
+        tarball = tarfile.open(fileobj=stream, mode='r|')
         tarball.extractall(path=dest_dir)
         os.rename(os.path.join(dest_dir, src_basename), dest_path)
 
         if uid > -1 or gid > -1:
             self.chown(dest_path, uid, gid, remote=False)
 
+    @borrowdoc(POSIXSession)
+    def _put_archive(self, chunks):
+        # chunks are sent as they come (with chunked transfer encoding)
+        if not self.client.put_archive(container=self.container['Id'],
+                                       path='/', data=chunks):
+            raise CommandError(msg="Failed to put archive into the container")
+
+    @borrowdoc(POSIXSession)
+    @contextmanager
+    def _get_archive(self, names):
+        command = self._TAR_CREATE_CMD + names
+        exec_id, sock = _get_exec_socket(self.client, self.container,
+                                         command)
+        try:
+            output = _ExecOutput(sock)
+            yield output
+            output.read()  # whatever follows the end of the archive
+        finally:
+            sock.close()
+        exit_code = self.client.exec_inspect(exec_id)['ExitCode']
+        if exit_code not in [0, None]:
+            err = utils.to_unicode(bytes(output.err), "utf-8")
+            raise CommandError(str(command),
+                               "Failed to archive files: %s" % err,
+                               exit_code, '', err)
+
 
 @attr.s
 class PTYDockerSession(DockerSession):
@@ -13,9 +13,18 @@ import logging
 lgr = logging.getLogger('niceman.resource.session')
 
 import attr
+import base64
 import json
 import os
+import posixpath
 import re
+import stat
+import tarfile
+import threading
+import uuid
+from pipes import quote
+
+from six import string_types
 
 from niceman.support.exceptions import SessionRuntimeError
 from niceman.cmd import Runner
@@ -23,6 +32,8 @@ from niceman.dochelpers import exc_str, borrowdoc
 from niceman.support.exceptions import CommandError
 from niceman.utils import updated
 from niceman.utils import to_unicode
+from niceman.utils import execute_command_batch
+from niceman.utils import get_cmd_batch_len
 
 import logging
 lgr = logging.getLogger('niceman.session')
@@ -32,6 +43,10 @@ lgr = logging.getLogger('niceman.session')
 class Session(object):
     """Interface for Resources to provide interaction within that environment"""
 
+    # Whether commands could be executed concurrently (e.g. from multiple
+    # threads) within the session (see utils.execute_command_batch)
+    concurrent_commands = False
+
     def __attrs_post_init__(self):
         """
         Maintain both current and future session environments.
@@ -41,6 +56,17 @@ class Session(object):
         """
         self._env = {}           # environment which would be in-effect only for this session
         self._env_permanent = {} # environment variables which would be in-effect in future sessions if resource is persistent
+        self._stat_cache = None
+
+    @property
+    def stat_cache(self):
+        """Cache of information about paths within the session
+
+        See StatCache.
+        """
+        if self._stat_cache is None:
+            self._stat_cache = StatCache(self)
+        return self._stat_cache
 
     def __enter__(self):
         self.open()
@@ -277,6 +303,51 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def stat_many(self, paths):
+        """Gather information about many paths at once (see also StatCache)
+
+        This generic implementation tests paths one at a time, sessions
+        should gather it in bulk.
+
+        Parameters
+        ----------
+        paths : list of str
+
+        Returns
+        -------
+        dict
+          Path -> PathStat, for existing paths
+        """
+        stats = {}
+        for path in paths:
+            if self.exists(path):
+                type_ = 'd' if self.isdir(path) else 'f'
+                stats[path] = PathStat(type=type_, target_type=type_)
+        return stats
+
+    def read_many(self, paths):
+        """Return content of many files at once
+
+        This generic implementation reads files one at a time, sessions
+        should read them in bulk.
+
+        Parameters
+        ----------
+        paths : list of str
+
+        Returns
+        -------
+        dict
+          Path -> content, for files which could be read
+        """
+        contents = {}
+        for path in paths:
+            try:
+                contents[path] = self.read(path)
+            except Exception as exc:
+                lgr.debug("Could not read %s: %s", path, exc_str(exc))
+        return contents
+
     def put(self, src_path, dest_path, uid=-1, gid=-1):
         """Take file on the local file system and copy over into the resource
 
@@ -319,6 +390,56 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def put_many(self, paths, uid=-1, gid=-1):
+        """Copy many files on the local file system into the resource
+
+        Progress (in bytes) is reported with a progress bar.
+
+        Parameters
+        ----------
+        paths : iterable of (string, string)
+            Paths of local files and (absolute) paths to put them at in the
+            resource, as src_path and dest_path of put
+        uid : int, optional
+            As for put
+        gid : int, optional
+            As for put
+        """
+        paths = list(paths)
+        pbar = _get_progressbar(
+            "Putting %d files" % len(paths),
+            sum(_get_file_size(src_path) for src_path, _ in paths))
+        try:
+            for src_path, dest_path in paths:
+                self.put(src_path, dest_path, uid, gid)
+                pbar.update(_get_file_size(src_path), increment=True)
+        finally:
+            pbar.finish()
+
+    def get_many(self, paths, uid=-1, gid=-1):
+        """Copy many files on the resource into the local system
+
+        Progress (in bytes) is reported with a progress bar.
+
+        Parameters
+        ----------
+        paths : iterable of (string, string)
+            Paths of files in the resource and paths to put them at in the
+            local file system, as src_path and dest_path of get
+        uid : int, optional
+            As for get
+        gid : int, optional
+            As for get
+        """
+        paths = list(paths)
+        pbar = _get_progressbar("Getting %d files" % len(paths))
+        try:
+            for src_path, dest_path in paths:
+                self.get(src_path, dest_path, uid, gid)
+                pbar.update(_get_file_size(dest_path), increment=True)
+        finally:
+            pbar.finish()
+
     def get_mtime(self, path):
         """Returns the modification time for a file in the resource
         
@@ -529,6 +650,70 @@ class POSIXSession(Session):
                       "test for file presence has failed", err)
             return False
 
+    # GNU find prints details of all the paths at once, with '/' added to
+    # find out whether it worked at all (e.g. busybox's does not support
+    # -printf), while a missing path makes it exit with 1
+    _STAT_COMMAND = [
+        'sh', '-c',
+        'find "$@" -maxdepth 0 -printf "%p\\0%y\\0%Y\\0%s\\0%T@\\0%l\\0" '
+        '2>/dev/null; [ $? -le 1 ]',
+        'find', '/']
+
+    @borrowdoc(Session)
+    def stat_many(self, paths):
+        # find would take paths starting with - or ( for its options
+        args = dict((p if p.startswith('/') else './' + p, p) for p in paths)
+        stats = {}
+        try:
+            for out, _, _ in execute_command_batch(
+                    self, self._STAT_COMMAND, args):
+                fields = out.split('\0')
+                if '/' not in fields[0::6]:
+                    raise CommandError(msg="find did not print details")
+                for i in range(0, len(fields) - 5, 6):
+                    arg, type_, target_type, size, mtime, link = \
+                        fields[i:i + 6]
+                    if arg not in args:
+                        continue  # '/' we added
+                    stats[args[arg]] = PathStat(
+                        type=type_,
+                        size=int(size),
+                        mtime=float(mtime),
+                        link=link if type_ == 'l' else None,
+                        target_type=target_type
+                        if target_type in _FILE_TYPES else None)
+        except CommandError as exc:
+            lgr.debug("Failed to stat paths in bulk, will test them one by "
+                      "one: %s", exc_str(exc))
+            return super(POSIXSession, self).stat_many(paths)
+        return stats
+
+    # Content of every readable file is printed as its path and base64 (the
+    # output is decoded as UTF-8 text, but files need not be) separated by
+    # NULs.  A missing base64 fails the whole command
+    _READ_COMMAND = [
+        'sh', '-c',
+        'for p; do [ -f "$p" ] && [ -r "$p" ] || continue; '
+        'printf "%s\\0" "$p"; base64 <"$p" || exit 2; printf "\\0"; done',
+        'read']
+
+    @borrowdoc(Session)
+    def read_many(self, paths):
+        contents = {}
+        try:
+            for out, _, _ in execute_command_batch(
+                    self, self._READ_COMMAND, set(paths)):
+                fields = out.split('\0')
+                for i in range(0, len(fields) - 1, 2):
+                    contents[fields[i]] = to_unicode(
+                        base64.b64decode(fields[i + 1]))
+        except (CommandError, TypeError, ValueError) as exc:
+            # TypeError or ValueError (binascii.Error) on unexpected output
+            lgr.debug("Failed to read files in bulk, will read them one by "
+                      "one: %s", exc_str(exc))
+            return super(POSIXSession, self).read_many(paths)
+        return contents
+
     # def lexists(self, path):
     #     """Return if file (or just a broken symlink) exists"""
     #     return os.path.lexists(path)
@@ -536,9 +721,10 @@ class POSIXSession(Session):
     # Seems to have no generic implementation in POSIX?  TODO: check
     #  may be we could assume presence of e.g. python so we could use std library?
     def get_mtime(self, path):
-        # TODO:  too common of a pattern -- we need a helper to wrap such calls
+        # find starts much faster than python, which might not even be there
         out, err = self.execute_command(
-            ['python', '-c', "import os, sys; print(os.path.getmtime(sys.argv[1]))", path]
+            ['find', '-L', path if path.startswith('/') else './' + path,
+             '-maxdepth', '0', '-printf', '%T@']
         )
         return out.strip()
 
@@ -552,6 +738,107 @@ class POSIXSession(Session):
             raise SessionRuntimeError("Running had std error output: %s" % err)
         return out
 
+    def put_many(self, paths, uid=-1, gid=-1):
+        """Copy many files on the local file system into the resource
+
+        Files are packed into a single tar archive, which is streamed into
+        the resource (see _put_archive) as it is written, and extracted
+        under /.  Progress (in bytes) is reported with a progress bar.
+
+        Parameters
+        ----------
+        paths : iterable of (string, string)
+            Paths of local files and (absolute) paths to put them at in the
+            resource, as src_path and dest_path of put
+        uid : int, optional
+            As for put
+        gid : int, optional
+            As for put
+        """
+        paths = list(paths)
+        if not paths:
+            return
+        pbar = _get_progressbar(
+            "Putting %d files" % len(paths),
+            sum(_get_file_size(src_path) for src_path, _ in paths))
+        try:
+            self._put_archive(iter_tar_chunks(paths, pbar))
+        finally:
+            pbar.finish()
+        if uid > -1 or gid > -1:
+            for _ in execute_command_batch(
+                    self, _get_chown_command(uid, gid),
+                    [dest_path for _, dest_path in paths]):
+                pass
+
+    def get_many(self, paths, uid=-1, gid=-1):
+        """Copy many files on the resource into the local system
+
+        Files are packed into tar archives by tar running in the resource
+        (see _get_archive), as many files per archive as fit a command
+        line, and each archive is extracted as it is read.  Progress (in
+        bytes) is reported with a progress bar.
+
+        Parameters
+        ----------
+        paths : iterable of (string, string)
+            Paths of files in the resource and paths to put them at in the
+            local file system, as src_path and dest_path of get
+        uid : int, optional
+            As for get
+        gid : int, optional
+            As for get
+        """
+        # names of members of archives, relative to / -> local destination
+        destinations = dict(
+            (posixpath.normpath(posixpath.join('/', src_path)).lstrip('/'),
+             dest_path)
+            for src_path, dest_path in paths)
+        names = sorted(destinations)
+        if not names:
+            return
+        batch_len = get_cmd_batch_len(
+            names, sum(map(len, self._TAR_CREATE_CMD))
+            + len(self._TAR_CREATE_CMD))
+        pbar = _get_progressbar("Getting %d files" % len(names))
+        try:
+            for i in range(0, len(names), batch_len):
+                with self._get_archive(names[i:i + batch_len]) as stream:
+                    extract_tar_stream(stream, destinations, uid, gid, pbar)
+        finally:
+            pbar.finish()
+
+    # Command writing tar archive of files (relative to /) to stdout,
+    # dereferencing symlinks as put and get do
+    _TAR_CREATE_CMD = ['tar', '-chf', '-', '-C', '/']
+
+    def _put_archive(self, chunks):
+        """Extract tar archive under / of the resource
+
+        Parameters
+        ----------
+        chunks : iterable of bytes
+            Consecutive parts of the archive, to be sent as they come
+        """
+        raise NotImplementedError
+
+    def _get_archive(self, names):
+        """Return context manager with tar archive of files in the resource
+
+        Parameters
+        ----------
+        names : list of string
+            Paths relative to / of files to pack into the archive (with
+            _TAR_CREATE_CMD)
+
+        Returns
+        -------
+        context manager
+            Providing file-like object to read the archive from.  On exit,
+            CommandError is raised if tar failed
+        """
+        raise NotImplementedError
+
     def mkdir(self, path, parents=False):
         """Create a directory
         """
@@ -588,20 +875,7 @@ class POSIXSession(Session):
     def chown(self, path, uid=-1, gid=-1, recursive=False, remote=True):
         """Set the user and gid of a path
         """
-        uid = int(uid) # Command line parameters getting passed as type str
-        gid = int(gid)
-
-        if uid == -1 and gid > -1:
-            command = ['chgrp']
-        else:
-            command = ['chown']
-        if recursive: command += ["-R"]
-        if uid > -1 and gid > -1: command += ["{}.{}".format(uid, gid)]
-        elif uid > -1: command += [uid]
-        elif gid > -1: command += [gid]
-        else: raise CommandError(cmd='chown', msg="Invalid command \
-            parameters.")
-        command += [path]
+        command = _get_chown_command(uid, gid, recursive) + [path]
         if remote:
             self.execute_command(command)
         else:
@@ -609,6 +883,243 @@ class POSIXSession(Session):
             Runner().run(command)
             
 
+def _get_chown_command(uid=-1, gid=-1, recursive=False):
+    """Return chown (or chgrp) command, without paths, to set uid and gid"""
+    uid = int(uid) # Command line parameters getting passed as type str
+    gid = int(gid)
+
+    if uid == -1 and gid > -1:
+        command = ['chgrp']
+    else:
+        command = ['chown']
+    if recursive: command += ["-R"]
+    if uid > -1 and gid > -1: command += ["{}.{}".format(uid, gid)]
+    elif uid > -1: command += [str(uid)]
+    elif gid > -1: command += [str(gid)]
+    else: raise CommandError(cmd='chown', msg="Invalid command \
+        parameters.")
+    return command
+
+
+def _get_progressbar(label, maxval=None):
+    """Return started progress bar of bytes transferred"""
+    from niceman.ui import ui
+    pbar = ui.get_progressbar(label=label, maxval=maxval, unit='B')
+    pbar.start()
+    return pbar
+
+
+def _get_file_size(path):
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+_TAR_BUFSIZE = 1 << 16
+
+
+def iter_tar_chunks(paths, pbar=None):
+    """Yield parts of a tar archive of local files as it is written
+
+    The archive is written by a thread into a pipe, so neither the archive
+    nor the files are kept in memory.  Members are named after their
+    destination paths relative to /, for the archive to be extracted
+    under /.
+
+    Parameters
+    ----------
+    paths : list of (string, string)
+        Paths of local files and absolute paths of their destinations
+    pbar : ProgressBar, optional
+        To update with sizes of the files as they are added
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def write():
+        try:
+            with os.fdopen(write_fd, 'wb') as f:
+                tar = tarfile.open(fileobj=f, mode='w|', dereference=True)
+                for src_path, dest_path in paths:
+                    tar.add(src_path, arcname=dest_path.lstrip('/'))
+                    if pbar is not None:
+                        pbar.update(_get_file_size(src_path), increment=True)
+                tar.close()
+        except Exception as exc:
+            # e.g. the reading end was closed since sending failed
+            errors.append(exc)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as f:
+            for chunk in iter(lambda: f.read(_TAR_BUFSIZE), b''):
+                yield chunk
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def extract_tar_stream(stream, destinations, uid=-1, gid=-1, pbar=None):
+    """Extract members of a tar archive, as they are read, to destinations
+
+    Parameters
+    ----------
+    stream : file-like
+        To read the archive from (sequentially)
+    destinations : dict
+        Paths in the archive -> local paths to extract them to.  Members
+        within directories are extracted into directories of destinations
+    uid : int, optional
+        User to own the files (if running as root), by default the current
+        one
+    gid : int, optional
+        Group to own the files (if running as root), by default the current
+        one
+    pbar : ProgressBar, optional
+        To update with sizes of members as they are extracted
+    """
+    uid = os.getuid() if uid < 0 else uid
+    gid = os.getgid() if gid < 0 else gid
+    tar = tarfile.open(fileobj=stream, mode='r|')
+    extracted = {}  # names of members -> where they were extracted to
+    for member in tar:
+        name = member.name.rstrip('/')
+        path = name
+        while path and path not in destinations:
+            path = posixpath.dirname(path)
+        if not path:
+            lgr.debug("Skipping %s not requested from the archive", name)
+            continue
+        dest_path = destinations[path]
+        if name != path:
+            dest_path = os.path.join(
+                dest_path, *name[len(path) + 1:].split('/'))
+        dest_path = os.path.abspath(dest_path)
+        if member.islnk():
+            # tar -h still archives files hardlinked to ones already in
+            # the archive as links, to be made to where those went
+            linkname = member.linkname.rstrip('/')
+            if linkname not in extracted:
+                raise CommandError(
+                    msg="Hardlink %s to %s not in the archive"
+                        % (name, linkname))
+            member.linkname = extracted[linkname]
+        extracted[name] = dest_path
+        member.name = os.path.basename(dest_path)
+        member.uid, member.gid = uid, gid
+        member.uname = member.gname = ''
+        tar.extract(member, path=os.path.dirname(dest_path))
+        if pbar is not None:
+            pbar.update(member.size, increment=True)
+    tar.close()
+
+
+# Types of files, as reported by find's %y
+_FILE_TYPES = {
+    stat.S_IFREG: 'f',
+    stat.S_IFDIR: 'd',
+    stat.S_IFLNK: 'l',
+    stat.S_IFBLK: 'b',
+    stat.S_IFCHR: 'c',
+    stat.S_IFIFO: 'p',
+    stat.S_IFSOCK: 's',
+}
+_FILE_TYPES.update((v, v) for v in list(_FILE_TYPES.values()))
+
+
+def get_file_type(mode):
+    """Return type of a file (e.g. 'd' for a directory) given its st_mode"""
+    return _FILE_TYPES.get(stat.S_IFMT(mode))
+
+
+@attr.s(slots=True, frozen=True)
+class PathStat(object):
+    """Information about a path within a session
+
+    type and target_type are as reported by find's %y (e.g. 'f' for a
+    regular file, 'd' for a directory, 'l' for a symbolic link), with
+    target_type being the type of the file a link points to (None if it is
+    broken), and the same as type for anything but links.
+    """
+    type = attr.ib()
+    size = attr.ib(default=None)
+    mtime = attr.ib(default=None)
+    link = attr.ib(default=None)  # target of a symbolic link
+    target_type = attr.ib(default=None)
+
+    @property
+    def exists(self):
+        return self.target_type is not None
+
+    @property
+    def isdir(self):
+        return self.target_type == 'd'
+
+    @property
+    def islink(self):
+        return self.type == 'l'
+
+
+class StatCache(object):
+    """Information about paths within a session, gathered in bulk
+
+    Tracing tests many paths (e.g. whether they are directories), which in
+    remote sessions takes a command per test.  Instead paths could be
+    prefetched all at once, and then tested from the cache.  The cache is
+    not invalidated by changes within the session, so it is meant for
+    analysis of its state (e.g. by retrace, which clears it first).  It
+    could be used from multiple threads.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._stats = {}  # path -> PathStat, or None if it does not exist
+        self._lock = threading.Lock()
+
+    def prefetch(self, paths):
+        """Gather information about all the paths not known yet at once"""
+        with self._lock:
+            paths = [p for p in set(paths) if p not in self._stats]
+        if not paths:
+            return
+        lgr.debug("Gathering information about %d paths", len(paths))
+        stats = self._session.stat_many(paths)
+        with self._lock:
+            for path in paths:
+                self._stats[path] = stats.get(path)
+
+    def stat(self, path):
+        """Return PathStat for a path, or None if it does not exist"""
+        try:
+            return self._stats[path]
+        except KeyError:
+            self.prefetch([path])
+            return self._stats[path]
+
+    def exists(self, path):
+        stat_ = self.stat(path)
+        return stat_ is not None and stat_.exists
+
+    def isdir(self, path):
+        stat_ = self.stat(path)
+        return stat_ is not None and stat_.isdir
+
+    def update(self, stats):
+        """Add information about paths gathered elsewhere
+
+        Parameters
+        ----------
+        stats : dict
+          Path -> PathStat, or None if it does not exist
+        """
+        with self._lock:
+            self._stats.update(stats)
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
 def get_local_session(env={'LC_ALL': 'C'}, pty=False, shared=False):
     """A shortcut to get a local session"""
     # TODO: support arbitrary session as obtained from a resource
@@ -621,6 +1132,74 @@ def get_local_session(env={'LC_ALL': 'C'}, pty=False, shared=False):
         session.set_envvar(env)
     return session
 
+
+def get_shell_script(command, env=None, cwd=None):
+    """Return shell script running command with env variables within cwd
+
+    For sessions which could run only a command line (or feed it to a
+    shell), to execute commands as POSIXSession.execute_command would.
+    """
+    if not isinstance(command, string_types):
+        command = ' '.join(quote(s) for s in command)
+    if not (env or cwd):
+        return command
+    lines = []
+    if cwd:
+        lines.append('cd %s || exit 1' % quote(cwd))
+    for variable, value in sorted((env or {}).items()):
+        lines.append('unset %s' % variable if value is None
+                     else 'export %s=%s' % (variable, quote(value)))
+    return '\n'.join(lines + [command])
+
+
+class ShellMarkers(object):
+    """Markers telling apart outputs of commands run by a long-running shell
+
+    Every command written to the standard input of the shell is followed by
+    printing a marker (with exit code of the command) to stdout and stderr,
+    so running a command does not need to start a new process (or channel)
+    for it.
+    """
+
+    def __init__(self):
+        self.marker = 'niceman-%s' % uuid.uuid4().hex
+        marker = self.marker.encode()
+        self._out_end = re.compile(b'\n' + marker + br' ([0-9]+)\n\Z')
+        self._err_end = b'\n' + marker + b'\n'
+        # the tail of stdout which could contain the marker
+        self._tail = len(marker) + 32
+
+    def get_script(self, command, env=None, cwd=None):
+        """Return script (as bytes) to write to the shell to run a command"""
+        # eval, so a malformed command does not leave the shell waiting
+        # for the rest of it
+        script = "( eval %s ) </dev/null\n" \
+                 "printf '\\n%%s %%d\\n' %s \"$?\"\n" \
+                 "printf '\\n%%s\\n' %s >&2\n" \
+                 % (quote(get_shell_script(command, env, cwd)),
+                    self.marker, self.marker)
+        return script.encode('utf-8')
+
+    def pop_exit_code(self, out):
+        """Return exit code if stdout (bytearray) is complete, or None
+
+        The marker is removed from the complete stdout.
+        """
+        match = self._out_end.search(out, max(0, len(out) - self._tail))
+        if not match:
+            return None
+        exit_code = int(match.group(1))
+        del out[match.start():]
+        return exit_code
+
+    def pop_err_end(self, err):
+        """Return whether stderr (bytearray) is complete, removing marker"""
+        if not err.endswith(self._err_end):
+            return False
+        del err[-len(self._err_end):]
+        return True
+
+
 def get_updated_env(env, update):
     """Given an environment and set of updates, return updated one
     
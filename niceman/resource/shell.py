@@ -13,9 +13,10 @@ import shutil
 
 from .base import Resource
 from niceman.cmd import Runner
-from niceman.dochelpers import borrowdoc
+from niceman.dochelpers import borrowdoc, exc_str
 from niceman.resource.session import Session
 from niceman.support.exceptions import CommandError
+from niceman.utils import to_unicode
 
 import logging
 lgr = logging.getLogger('niceman.resource.shell')
@@ -23,6 +24,7 @@ lgr = logging.getLogger('niceman.resource.shell')
 import os
 
 from .session import POSIXSession, get_updated_env
+from .session import PathStat, get_file_type
 
 
 # For now just assuming that local shell is a POSIX shell
@@ -31,6 +33,9 @@ from .session import POSIXSession, get_updated_env
 class ShellSession(POSIXSession):
     """Local shell session"""
 
+    # Every command is a separate local process
+    concurrent_commands = True
+
     def __init__(self):
         super(ShellSession, self).__init__()
         self._runner = None
@@ -65,10 +70,67 @@ class ShellSession(POSIXSession):
             **run_kw
         )  # , shell=True)
 
+    # Local files are accessed directly instead of running commands (test,
+    # cat, python) for them, still failing with CommandError like they would
+
+    @borrowdoc(Session)
+    def exists(self, path):
+        return os.path.exists(path)
+
     @borrowdoc(Session)
     def isdir(self, path):
         return os.path.isdir(path)
 
+    @borrowdoc(Session)
+    def get_mtime(self, path):
+        try:
+            return str(os.path.getmtime(path))
+        except OSError as exc:
+            raise CommandError(cmd='get_mtime', msg=exc_str(exc))
+
+    @borrowdoc(Session)
+    def read(self, path, mode='r'):
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except (IOError, OSError) as exc:
+            raise CommandError(cmd='read', msg=exc_str(exc))
+        return content if 'b' in mode else to_unicode(content)
+
+    @borrowdoc(Session)
+    def stat_many(self, paths):
+        stats = {}
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            type_ = target_type = get_file_type(st.st_mode)
+            link = None
+            if type_ == 'l':
+                link = os.readlink(path)
+                try:
+                    target_type = get_file_type(os.stat(path).st_mode)
+                except OSError:
+                    target_type = None  # broken link
+            stats[path] = PathStat(type=type_, size=st.st_size,
+                                   mtime=st.st_mtime, link=link,
+                                   target_type=target_type)
+        return stats
+
+    @borrowdoc(Session)
+    def read_many(self, paths):
+        contents = {}
+        for path in paths:
+            if not os.path.isfile(path):
+                continue  # e.g. reading a FIFO could block
+            try:
+                with open(path, 'rb') as f:
+                    contents[path] = to_unicode(f.read())
+            except (IOError, OSError, ValueError) as exc:
+                lgr.debug("Could not read %s: %s", path, exc_str(exc))
+        return contents
+
     @borrowdoc(Session)
     def mkdir(self, path, parents=False):
         if not os.path.exists(path):
@@ -95,6 +157,17 @@ class ShellSession(POSIXSession):
         # put is the same as get for the shell resource
         self.get(src_path, dest_path, uid, gid)
 
+    # Local files are just copied, there is nothing to gain from packing
+    # them into an archive
+
+    @borrowdoc(Session)
+    def put_many(self, paths, uid=-1, gid=-1):
+        Session.put_many(self, paths, uid, gid)
+
+    @borrowdoc(Session)
+    def get_many(self, paths, uid=-1, gid=-1):
+        Session.get_many(self, paths, uid, gid)
+
 
 @attr.s
 class Shell(Resource):
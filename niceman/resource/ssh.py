@@ -10,8 +10,10 @@
 
 import attr
 import uuid
+from contextlib import contextmanager
 from pipes import quote
 import socket
+import threading
 import termios
 import tty
 import sys
@@ -23,7 +25,7 @@ import logging
 lgr = logging.getLogger('niceman.resource.ssh')
 
 from .base import Resource, attrib
-from niceman.dochelpers import borrowdoc
+from niceman.dochelpers import borrowdoc, exc_str
 from niceman.resource.session import Session
 from niceman import utils
 from ..support.exceptions import CommandError, SSHError, SSHConnectionError, \
@@ -117,29 +119,111 @@ class Ssh(SSH):
 
 
 from niceman.resource.session import POSIXSession
+from niceman.resource.session import ShellMarkers
+from niceman.resource.session import get_shell_script
+
+
+class RemoteShell(object):
+    """Shell on the remote end executing commands one after another
+
+    Commands are written to the standard input of a shell started in a
+    single channel, each followed by printing a marker (with exit code of
+    the command) to stdout and stderr.  Outputs of consecutive commands are
+    told apart by the markers, so running a command takes a single round
+    trip instead of opening a new channel for it.
+    """
+
+    _BUFSIZE = 1 << 16
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._markers = ShellMarkers()
+
+    @classmethod
+    def open(cls, transport):
+        """Start a shell in a new channel of the paramiko transport"""
+        channel = transport.open_session()
+        channel.exec_command('/bin/sh')
+        return cls(channel)
+
+    def run(self, command, env=None, cwd=None):
+        """Run a command (see SSHSession.execute_command)
+
+        Returns
+        -------
+        (exit code, stdout, stderr)
+          Outputs as bytes
+        """
+        channel = self._channel
+        channel.sendall(self._markers.get_script(command, env, cwd))
+        out, err = bytearray(), bytearray()
+        exit_code = None
+        err_done = False
+        while True:
+            while channel.recv_ready():
+                out += channel.recv(self._BUFSIZE)
+            while channel.recv_stderr_ready():
+                err += channel.recv_stderr(self._BUFSIZE)
+            if exit_code is None:
+                exit_code = self._markers.pop_exit_code(out)
+            if not err_done:
+                err_done = self._markers.pop_err_end(err)
+            if exit_code is not None and err_done:
+                return exit_code, bytes(out), bytes(err)
+            if channel.exit_status_ready() and not (
+                    channel.recv_ready() or channel.recv_stderr_ready()):
+                raise SSHError(
+                    "Remote shell exited while running %r" % (command,))
+            # channel's fileno becomes ready as stdout or stderr data comes
+            select.select([channel], [], [], 1.0)
+
+    def close(self):
+        self._channel.close()
+
 
 @attr.s
 class SSHSession(POSIXSession):
     ssh = attr.ib()
 
+    # Commands run in shells of their own channels of the (thread-safe)
+    # transport
+    concurrent_commands = True
+
+    def __attrs_post_init__(self):
+        super(SSHSession, self).__attrs_post_init__()
+        self._shells = []  # idle RemoteShells, started as needed
+        self._sftp = None
+        self._lock = threading.Lock()
+
+    def _acquire_shell(self):
+        with self._lock:
+            if self._shells:
+                return self._shells.pop()
+        return RemoteShell.open(self.ssh.get_transport())
+
     @borrowdoc(Session)
     def _execute_command(self, command, env=None, cwd=None):
-        # TODO -- command_env is not used etc...
-        # command_env = self.get_updated_env(env)
-        if env:
-            raise NotImplementedError("passing env variables to execution")
-
-        if cwd:
-            raise NotImplementedError("implement cwd support")
-        # if command_env:
-            # TODO: might not work - not tested it
-            # command = ['export %s=%s;' % k for k in command_env.items()] + command
-
-        escaped_command = ' '.join(quote(s) for s in command)
-        stdin, stdout, stderr = self.ssh.exec_command(escaped_command)
-        exit_code = stdout.channel.recv_exit_status()
-        stdout = utils.to_unicode(stdout.read(), "utf-8")
-        stderr = utils.to_unicode(stderr.read(), "utf-8")
+        try:
+            shell = self._acquire_shell()
+        except Exception as exc:
+            lgr.debug("Could not start a remote shell, running %r in a "
+                      "channel of its own: %s", command, exc_str(exc))
+            shell = None
+        if shell is None:
+            stdin, stdout, stderr = self.ssh.exec_command(
+                get_shell_script(command, env, cwd))
+            exit_code = stdout.channel.recv_exit_status()
+            stdout, stderr = stdout.read(), stderr.read()
+        else:
+            try:
+                exit_code, stdout, stderr = shell.run(command, env, cwd)
+            except Exception:
+                shell.close()
+                raise
+            with self._lock:
+                self._shells.append(shell)
+        stdout = utils.to_unicode(stdout, "utf-8")
+        stderr = utils.to_unicode(stderr, "utf-8")
 
         if exit_code not in [0, None]:
             msg = "Failed to run %r. Exit code=%d. out=%s err=%s" \
@@ -151,14 +235,30 @@ class SSHSession(POSIXSession):
 
         return (stdout, stderr)
 
+    @property
+    def sftp(self):
+        """SFTP client of the session, opened once on the first use"""
+        with self._lock:
+            if self._sftp is None:
+                self._sftp = self.ssh.open_sftp()
+            return self._sftp
+
+    @borrowdoc(Session)
+    def close(self):
+        with self._lock:
+            shells, self._shells = self._shells, []
+            sftp, self._sftp = self._sftp, None
+        for shell in shells:
+            shell.close()
+        if sftp is not None:
+            sftp.close()
+
     @borrowdoc(Session)
     def put(self, src_path, dest_path, uid=-1, gid=-1):
         dest_dir, dest_basename = os.path.split(dest_path)
         if not self.exists(dest_dir):
             self.mkdir(dest_dir, parents=True)
-        sftp = self.ssh.open_sftp()
-        sftp.put(src_path, dest_path)
-        sftp.close()
+        self.sftp.put(src_path, dest_path)
 
         if uid > -1 or gid > -1:
             self.chown(dest_path, uid, gid)
@@ -168,13 +268,48 @@ class SSHSession(POSIXSession):
         dest_dir, dest_basename = os.path.split(dest_path)
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
-        sftp = self.ssh.open_sftp()
-        sftp.get(src_path, dest_path)
-        sftp.close()
+        self.sftp.get(src_path, dest_path)
 
         if uid > -1 or gid > -1:
             self.chown(dest_path, uid, gid, remote=False)
 
+    @borrowdoc(POSIXSession)
+    def _put_archive(self, chunks):
+        command = 'tar -xof - -C /'
+        channel = self.ssh.get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            for chunk in chunks:
+                channel.sendall(chunk)
+            channel.shutdown_write()
+            exit_code = channel.recv_exit_status()
+            stderr = utils.to_unicode(
+                channel.makefile_stderr('rb').read(), "utf-8")
+        finally:
+            channel.close()
+        if exit_code:
+            raise CommandError(
+                command, "Failed to extract files: %s" % stderr, exit_code,
+                '', stderr)
+
+    @borrowdoc(POSIXSession)
+    @contextmanager
+    def _get_archive(self, names):
+        command = get_shell_script(self._TAR_CREATE_CMD + names)
+        channel = self.ssh.get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            yield channel.makefile('rb')
+            exit_code = channel.recv_exit_status()
+            stderr = utils.to_unicode(
+                channel.makefile_stderr('rb').read(), "utf-8")
+        finally:
+            channel.close()
+        if exit_code:
+            raise CommandError(
+                command, "Failed to archive files: %s" % stderr, exit_code,
+                '', stderr)
+
 
 @attr.s
 class PTYSSHSession(SSHSession):
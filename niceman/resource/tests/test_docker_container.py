@@ -10,16 +10,26 @@
 import logging
 from mock import patch, MagicMock, call
 import os
+import shlex
+import struct
+import subprocess
+import threading
 import uuid
 
+import pytest
+
 from ...utils import swallow_logs
 from ...tests.utils import assert_in
 from ..base import ResourceManager
+from ..docker_container import DockerSession
+from ...support.exceptions import CommandError
 from ...support.exceptions import ResourceError
 
 from niceman.tests.fixtures import get_docker_fixture
 
 from pytest import raises
+from socket import SHUT_WR
+from socket import socketpair
 
 
 setup_ubuntu = get_docker_fixture(
@@ -27,6 +37,85 @@ setup_ubuntu = get_docker_fixture(
     scope='module'
 )
 
+
+def _frames(*chunks):
+    """Return (stream, data) chunks as multiplexed by docker for an exec"""
+    return b''.join(struct.pack('>BxxxL', stream, len(data)) + data
+                    for stream, data in chunks)
+
+
+def _get_socket(data):
+    """Return socket to read data from, as returned by exec_start"""
+    ours, theirs = socketpair()
+    theirs.sendall(data)
+    theirs.close()
+    return ours
+
+
+class _LocalDockerClient(object):
+    """Docker client running commands of execs as local processes"""
+
+    def __init__(self):
+        self.execs = {}
+
+    def exec_create(self, container, cmd, stdin=False):
+        exec_id = uuid.uuid4().hex
+        self.execs[exec_id] = {'cmd': cmd, 'stdin': stdin, 'ExitCode': None}
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, socket=False):
+        assert socket
+        execute = self.execs[exec_id]
+        cmd = execute['cmd']
+        if not isinstance(cmd, list):
+            cmd = shlex.split(cmd)
+        ours, theirs = socketpair()
+        devnull = open(os.devnull)
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE if execute['stdin'] else devnull)
+        lock = threading.Lock()
+
+        def feed():
+            for data in iter(lambda: theirs.recv(4096), b''):
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+
+        def pump(stream, pipe):
+            for data in iter(lambda: os.read(pipe.fileno(), 4096), b''):
+                with lock:
+                    theirs.sendall(_frames((stream, data)))
+
+        pumps = [threading.Thread(target=pump, args=args)
+                 for args in ((1, process.stdout), (2, process.stderr))]
+        if execute['stdin']:
+            threading.Thread(target=feed).start()
+
+        def wait():
+            for thread in pumps:
+                thread.start()
+            for thread in pumps:
+                thread.join()
+            execute['ExitCode'] = process.wait()
+            devnull.close()
+            theirs.shutdown(SHUT_WR)
+
+        threading.Thread(target=wait).start()
+        return ours
+
+    def exec_inspect(self, exec_id):
+        return {'ExitCode': self.execs[exec_id]['ExitCode']}
+
+    def put_archive(self, container, path, data):
+        process = subprocess.Popen(['tar', '-xf', '-', '-C', path],
+                                   stdin=subprocess.PIPE)
+        for chunk in data:
+            process.stdin.write(chunk)
+        process.stdin.close()
+        return process.wait() == 0
+
+
 def test_dockercontainer_class():
 
     with patch('docker.Client') as client, \
@@ -59,11 +148,11 @@ def test_dockercontainer_class():
                 'Id': '18b31b30e3a5'
             },
             exec_inspect=lambda id: { 'ExitCode': 0 },
-            exec_start=lambda exec_id, stream: [
-                b'stdout line 1',
-                b'stdout line 2',
-                b'stdout line 3'
-            ]
+            exec_start=lambda exec_id, socket: _get_socket(_frames(
+                (1, b'stdout line 1\n'),
+                (2, b'stderr line 1\n'),
+                (1, b'stdout line 2\n'),
+            )),
         )
 
         # Test connecting when a resource doens't exist.
@@ -156,6 +245,57 @@ def test_dockercontainer_class():
         ]
         client.assert_has_calls(calls, any_order=True)
 
+
+@pytest.mark.parametrize('persistent_shell', [False, True])
+def test_docker_session(persistent_shell):
+    client = _LocalDockerClient()
+    session = DockerSession(client=client, container={'Id': 'container'},
+                            persistent_shell=persistent_shell)
+    assert session.execute_command(['sh', '-c', 'echo out; echo err >&2']) \
+        == ('out\n', 'err\n')
+    assert session.execute_command('echo "$V"', env={'V': 'a  b'}) \
+        == ('a  b\n', '')
+    assert session.execute_command(['pwd'], cwd='/') == ('/\n', '')
+    with raises(CommandError) as cm:
+        session.execute_command(['sh', '-c', 'echo out; exit 3'])
+    assert cm.value.code == 3
+    assert cm.value.stdout == 'out\n'
+    with raises(CommandError):
+        session.execute_command(['pwd'], cwd='/non/existent')
+    # output larger than frames and socket buffers
+    out, _ = session.execute_command(['sh', '-c', 'yes | head -n 200000'])
+    assert out == 'y\n' * 200000
+    # a single shell runs all the commands
+    assert len(client.execs) == (1 if persistent_shell else 6)
+    session.close()
+
+
+def test_docker_session_put_get_many(tmpdir):
+    client = _LocalDockerClient()
+    session = DockerSession(client=client, container={'Id': 'container'})
+    src = tmpdir.mkdir('src')
+    src.join('a').write('a content')
+    src.mkdir('sub').join('b').write('b content')
+    dest = tmpdir.join('dest')
+    session.put_many([(str(src.join('a')), str(dest.join('a'))),
+                      (str(src.join('sub')), str(dest.join('sub2')))])
+    assert dest.join('a').read() == 'a content'
+    assert dest.join('sub2', 'b').read() == 'b content'
+    # putting files takes no exec
+    assert not client.execs
+
+    back = tmpdir.join('back')
+    session.get_many([(str(dest.join('a')), str(back.join('a'))),
+                      (str(dest.join('sub2')), str(back.join('sub')))])
+    assert back.join('a').read() == 'a content'
+    assert back.join('sub', 'b').read() == 'b content'
+    assert back.join('a').stat().uid == os.getuid()
+    assert len(client.execs) == 1
+
+    with raises(CommandError):
+        session.get_many([(str(tmpdir.join('missing')), str(back.join('m')))])
+
+
 def test_setup_ubuntu(setup_ubuntu):
     print(setup_ubuntu)
     assert setup_ubuntu['container_id']
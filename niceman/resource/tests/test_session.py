@@ -12,10 +12,12 @@ import docker
 import os
 import paramiko
 import pytest
+import subprocess
 import tempfile
 import uuid
 
 from ..session import get_updated_env, Session, POSIXSession
+from ..session import extract_tar_stream
 from ...support.exceptions import CommandError
 from ..docker_container import DockerSession, PTYDockerSession
 from ..shell import ShellSession
@@ -86,6 +88,31 @@ def test_get_local_session():
     return
 
 
+def test_extract_tar_stream_hardlinks(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('a').write('content')
+    os.link(str(src.join('a')), str(src.join('b')))
+    # tar -h archives the second file as a link to the first one
+    process = subprocess.Popen(
+        ['tar', '-chf', '-', '-C', str(tmpdir), 'src/a', 'src/b'],
+        stdout=subprocess.PIPE)
+    dest = tmpdir.join('dest')
+    extract_tar_stream(process.stdout, {'src/a': str(dest.join('a2')),
+                                        'src/b': str(dest.join('sub', 'b2'))})
+    assert process.wait() == 0
+    assert dest.join('a2').read() == 'content'
+    assert dest.join('sub', 'b2').read() == 'content'
+
+    process = subprocess.Popen(
+        ['tar', '-chf', '-', '-C', str(tmpdir), 'src/a', 'src/b'],
+        stdout=subprocess.PIPE)
+    with pytest.raises(CommandError):
+        # the first file was not requested
+        extract_tar_stream(process.stdout, {'src/b': str(dest.join('b3'))})
+    process.stdout.close()
+    process.wait()
+
+
 def test_session_class():
 
     with Session() as session:
@@ -19,6 +19,8 @@ from ...utils import swallow_logs
 from ...tests.utils import assert_in
 from ..base import ResourceManager
 from ...cmd import Runner
+from ...support.exceptions import CommandError
+from ..session import POSIXSession
 from ..shell import Shell, ShellSession
 from .test_session import check_session_passing_envvars
 
@@ -152,3 +154,136 @@ def test_shell_resource():
         resource.get_session(pty=True)
     with raises(NotImplementedError):
         resource.get_session(pty=False, shared=True)
+
+
+def _make_stat_tree(path):
+    os.mkdir(os.path.join(path, 'dir'))
+    with open(os.path.join(path, 'file'), 'w') as f:
+        f.write('content')
+    os.symlink('dir', os.path.join(path, 'link'))
+    os.symlink('missing', os.path.join(path, 'broken'))
+    return [os.path.join(path, p)
+            for p in ('dir', 'file', 'link', 'broken', 'missing')]
+
+
+def test_stat_many(tmpdir):
+    dir_, file_, link, broken, missing = paths = \
+        _make_stat_tree(str(tmpdir))
+    session = ShellSession()
+    for stats in (session.stat_many(paths),
+                  # find-based implementation for remote sessions
+                  POSIXSession.stat_many(session, paths)):
+        assert sorted(stats) == sorted(paths[:4])
+        assert stats[file_].type == 'f'
+        assert stats[file_].size == 7
+        assert abs(stats[file_].mtime - os.path.getmtime(file_)) < 1e-3
+        assert stats[dir_].isdir
+        assert stats[link].islink and stats[link].isdir
+        assert stats[link].link == 'dir'
+        assert stats[broken].islink and not stats[broken].exists
+        assert not stats[file_].isdir and not stats[file_].islink
+
+
+def test_stat_many_fallback(tmpdir):
+    dir_, file_, link, broken, missing = paths = \
+        _make_stat_tree(str(tmpdir))
+    session = ShellSession()
+    # e.g. find without -printf
+    with patch.object(POSIXSession, '_STAT_COMMAND', ['true']):
+        stats = POSIXSession.stat_many(session, paths)
+    assert sorted(stats) == [dir_, file_, link]
+    assert stats[dir_].isdir and stats[link].isdir
+    assert not stats[file_].isdir
+
+
+def test_stat_cache(tmpdir):
+    dir_, file_, link, broken, missing = paths = \
+        _make_stat_tree(str(tmpdir))
+    session = ShellSession()
+    cache = session.stat_cache
+    assert session.stat_cache is cache
+    with patch.object(session, 'stat_many',
+                      wraps=session.stat_many) as stat_many:
+        cache.prefetch(paths)
+        cache.prefetch(paths[:2])
+        assert cache.isdir(dir_) and cache.isdir(link)
+        assert not cache.isdir(file_) and not cache.isdir(missing)
+        assert cache.exists(file_) and not cache.exists(broken)
+        assert cache.stat(missing) is None
+        # all at once
+        assert stat_many.call_count == 1
+        other = str(tmpdir.join('other'))
+        assert not cache.exists(other)
+        assert stat_many.call_count == 2
+        # not invalidated until cleared
+        open(other, 'w').close()
+        assert not cache.exists(other)
+        cache.clear()
+        assert cache.exists(other)
+
+
+def test_read_many(tmpdir):
+    dir_, file_, link, broken, missing = paths = \
+        _make_stat_tree(str(tmpdir))
+    binary = str(tmpdir.join('binary'))
+    with open(binary, 'wb') as f:
+        f.write(b'\xd1\x8e\n\x00end')
+    paths += [binary, os.path.join(link, 'file')]
+    os.symlink('file', os.path.join(dir_, 'file'))  # dangling, in dir
+    expected = {file_: 'content', binary: u'\u044e\n\x00end'}
+    session = ShellSession()
+    assert session.read_many(paths) == expected
+    # base64-based implementation for remote sessions
+    assert POSIXSession.read_many(session, paths) == expected
+    # e.g. no base64
+    with patch.object(POSIXSession, '_READ_COMMAND',
+                      ['sh', '-c', 'echo garbage; exit 2']):
+        assert POSIXSession.read_many(session, paths) == expected
+
+
+def test_get_mtime(tmpdir):
+    dir_, file_, link, broken, missing = _make_stat_tree(str(tmpdir))
+    session = ShellSession()
+    assert abs(float(POSIXSession.get_mtime(session, file_))
+               - os.path.getmtime(file_)) < 1e-3
+    # follows links
+    assert abs(float(POSIXSession.get_mtime(session, link))
+               - os.path.getmtime(dir_)) < 1e-3
+    with raises(CommandError):
+        POSIXSession.get_mtime(session, missing)
+
+
+def test_native_file_access(tmpdir):
+    dir_, file_, link, broken, missing = _make_stat_tree(str(tmpdir))
+    session = ShellSession()
+    # no commands are run for local files
+    with patch.object(session, '_execute_command',
+                      side_effect=AssertionError("ran a command")):
+        assert session.exists(file_) and session.exists(link)
+        assert not session.exists(broken) and not session.exists(missing)
+        assert session.read(file_) == 'content'
+        assert session.read(file_, 'rb') == b'content'
+        assert float(session.get_mtime(file_)) == os.path.getmtime(file_)
+        for method in session.read, session.get_mtime:
+            with raises(CommandError):
+                method(missing)
+        with raises(CommandError):
+            session.read(dir_)
+    # consistent with the commands run by remote sessions
+    for path in dir_, file_, link, broken, missing:
+        assert session.exists(path) == POSIXSession.exists(session, path)
+    assert session.read(file_) == POSIXSession.read(session, file_)
+
+
+def test_put_get_many(tmpdir):
+    session = ShellSession()
+    src = tmpdir.mkdir('src')
+    src.join('a').write('a content')
+    src.join('b').write('b content')
+    dest = tmpdir.join('dest')
+    session.put_many([(str(src.join(n)), str(dest.join(n))) for n in 'ab'])
+    assert dest.join('a').read() == 'a content'
+    assert dest.join('b').read() == 'b content'
+    back = tmpdir.join('back')
+    session.get_many([(str(dest.join(n)), str(back.join(n))) for n in 'ab'])
+    assert back.join('b').read() == 'b content'
@@ -13,12 +13,17 @@ import os
 import paramiko
 import re
 import six
+import subprocess
+import threading
+import time
 import uuid
 from pytest import raises
 
 from ...utils import swallow_logs
 from ...tests.utils import assert_in, skip_ssh
+from ...support.exceptions import CommandError
 from ..base import ResourceManager
+from ..ssh import SSHSession
 from niceman.tests.fixtures import get_docker_fixture
 
 # Note: due to skip_ssh right here, it would skip the entire module with
@@ -107,8 +112,9 @@ def test_ssh_class(setup_ssh, resource_test_dir):
         assert session.isdir('not-a-dir') == False
         assert session.isdir('/etc/hosts') == False
 
-        with raises(NotImplementedError) as err:
-            session._execute_command('non-existent-command', cwd='/path')
+        assert session.execute_command(['pwd'], cwd='/tmp') == ('/tmp\n', '')
+        with raises(CommandError):
+            session.execute_command(['ls'], cwd='/no/such/path')
 
 
 def test_ssh_resource(setup_ssh):
@@ -132,3 +138,211 @@ def test_ssh_resource(setup_ssh):
 
     resource.get_session()
     assert type(resource._ssh) == paramiko.SSHClient
+
+
+class _ProcessChannel(object):
+    """Channel of a paramiko transport running a local process instead"""
+
+    def __init__(self):
+        self._buffers = {1: bytearray(), 2: bytearray()}
+        self._lock = threading.Lock()
+        # always ready, so readers just poll
+        self._ready, w = os.pipe()
+        os.write(w, b'x')
+        os.close(w)
+
+    def exec_command(self, command):
+        self._process = subprocess.Popen(
+            command, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._threads = []
+        for fd, f in (1, self._process.stdout), (2, self._process.stderr):
+            thread = threading.Thread(target=self._feed, args=(fd, f))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _feed(self, fd, f):
+        for chunk in iter(lambda: os.read(f.fileno(), 4096), b''):
+            with self._lock:
+                self._buffers[fd] += chunk
+
+    def _recv(self, fd, nbytes):
+        with self._lock:
+            data = bytes(self._buffers[fd][:nbytes])
+            del self._buffers[fd][:nbytes]
+            return data
+
+    def fileno(self):
+        return self._ready
+
+    def sendall(self, data):
+        self._process.stdin.write(data)
+        self._process.stdin.flush()
+
+    def shutdown_write(self):
+        self._process.stdin.close()
+
+    def makefile(self, mode):
+        return _ChannelFile(self, 1)
+
+    def makefile_stderr(self, mode):
+        return _ChannelFile(self, 2)
+
+    def recv_ready(self):
+        return bool(self._buffers[1])
+
+    def recv_stderr_ready(self):
+        return bool(self._buffers[2])
+
+    def recv(self, nbytes):
+        return self._recv(1, nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._recv(2, nbytes)
+
+    def exit_status_ready(self):
+        return self._process.poll() is not None
+
+    def recv_exit_status(self):
+        return self._process.wait()
+
+    def close(self):
+        if not self._process.stdin.closed:
+            self._process.stdin.close()
+        self._process.wait()
+        os.close(self._ready)
+
+
+class _LocalSSHClient(object):
+    """paramiko.SSHClient opening channels running local processes"""
+
+    def __init__(self):
+        self.channels = []
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        self.channels.append(_ProcessChannel())
+        return self.channels[-1]
+
+
+def test_remote_shell(tmpdir):
+    ssh = _LocalSSHClient()
+    session = SSHSession(ssh=ssh)
+    assert session.execute_command(['echo', 'a  b']) == ('a  b\n', '')
+    assert session.execute_command(['printf', 'no newline']) == \
+        ('no newline', '')
+    assert session.execute_command(
+        'echo out; echo err >&2; echo out2') == ('out\nout2\n', 'err\n')
+    with raises(CommandError) as cme:
+        session.execute_command(['sh', '-c', 'echo failed >&2; exit 3'])
+    assert cme.value.code == 3
+    assert cme.value.stderr == 'failed\n'
+    # a malformed command fails on its own
+    with raises(CommandError):
+        session.execute_command('echo "')
+    with raises(CommandError):
+        session.execute_command('exit 1')
+    # the environment and directory are only for the command
+    assert session.execute_command(
+        'echo "$FOO"; pwd', env={'FOO': "'bar' baz"}, cwd=str(tmpdir)) == \
+        ("'bar' baz\n%s\n" % tmpdir, '')
+    assert session.execute_command('echo "$FOO"; pwd')[0] != \
+        session.execute_command('echo "$FOO"; pwd', cwd=str(tmpdir))[0]
+    out, _ = session.execute_command(
+        ['sh', '-c', 'head -c 1000000 /dev/zero | tr "\\0" x'])
+    assert out == 'x' * 1000000
+    # all the commands ran in the same shell
+    assert len(ssh.channels) == 1
+
+    # concurrent commands get shells of their own
+    results = {}
+
+    def run(i):
+        results[i] = session.execute_command(
+            ['sh', '-c', 'sleep 0.2; echo %d' % i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == dict((i, ('%d\n' % i, '')) for i in range(4))
+    assert 1 < len(ssh.channels) <= 4
+
+    session.close()
+    assert all(c.exit_status_ready() for c in ssh.channels)
+
+
+class _ChannelFile(object):
+    """stdout or stderr of a command (see paramiko.ChannelFile)"""
+
+    def __init__(self, channel, fd):
+        self.channel = channel
+        self._fd = fd
+
+    def read(self, size=-1):
+        if size < 0:
+            for thread in self.channel._threads:
+                thread.join()
+            return self.channel._recv(self._fd, 1 << 30)
+        while True:
+            # whatever is available, as a socket would give
+            finished = not any(t.is_alive() for t in self.channel._threads)
+            data = self.channel._recv(self._fd, size)
+            if data or finished:
+                return data
+            time.sleep(0.01)
+
+
+class _NoShellSSHClient(_LocalSSHClient):
+    """paramiko.SSHClient which could only run commands in new channels"""
+
+    def open_session(self):
+        raise paramiko.SSHException("Unable to open channel.")
+
+    def exec_command(self, command):
+        channel = _ProcessChannel()
+        channel.exec_command(command)
+        channel._process.stdin.close()
+        self.channels.append(channel)
+        return None, _ChannelFile(channel, 1), _ChannelFile(channel, 2)
+
+
+def test_remote_shell_fallback(tmpdir):
+    ssh = _NoShellSSHClient()
+    session = SSHSession(ssh=ssh)
+    assert session.execute_command(
+        'echo "$FOO"; pwd >&2', env={'FOO': 'bar'}, cwd=str(tmpdir)) == \
+        ('bar\n', '%s\n' % tmpdir)
+    with raises(CommandError):
+        session.execute_command('exit 1')
+    assert len(ssh.channels) == 2
+
+
+def test_put_get_many(tmpdir):
+    ssh = _LocalSSHClient()
+    session = SSHSession(ssh=ssh)
+    src = tmpdir.mkdir('src')
+    src.join('a').write('a content')
+    src.mkdir('sub').join('b').write('b content')
+    dest = tmpdir.join('dest')
+    session.put_many([(str(src.join('a')), str(dest.join('a'))),
+                      (str(src.join('sub')), str(dest.join('sub2')))])
+    assert dest.join('a').read() == 'a content'
+    assert dest.join('sub2', 'b').read() == 'b content'
+    os.link(str(dest.join('a')), str(dest.join('sub2', 'a')))
+
+    back = tmpdir.join('back')
+    session.get_many([(str(dest.join('a')), str(back.join('a'))),
+                      (str(dest.join('sub2')), str(back.join('sub')))])
+    assert back.join('a').read() == 'a content'
+    assert back.join('sub', 'b').read() == 'b content'
+    assert back.join('sub', 'a').read() == 'a content'
+
+    with raises(CommandError):
+        session.get_many([(str(tmpdir.join('missing')), str(back.join('m')))])
+    # a channel per archive, no shell
+    assert len(ssh.channels) == 3
@@ -16,12 +16,121 @@ import logging
 import re
 import string
 
+from collections import defaultdict
+
 import attr
+from six import string_types
 
 lgr = logging.getLogger('niceman.distributions.debian')
 
 __docformat__ = 'restructuredtext'
 
+# Locations of the dpkg database
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+DPKG_INFO_DIR = '/var/lib/dpkg/info'
+# and of the lists of packages available from apt sources
+APT_LISTS_DIR = '/var/lib/apt/lists'
+
+# Field of the marker paragraphs which separate Packages lists in the dump
+# produced by APT_LISTS_DUMP_SCRIPT
+_APT_LIST_MARKER_FIELD = 'Niceman-Apt-List'
+
+# Shell script to dump all (possibly compressed) Packages lists at once,
+# each one preceded by a marker paragraph with the name of the list file.
+# apt-helper knows how to decompress anything apt could have stored.
+APT_LISTS_DUMP_SCRIPT = """
+for f in {dir}/*_Packages {dir}/*_Packages.gz {dir}/*_Packages.xz \\
+         {dir}/*_Packages.bz2 {dir}/*_Packages.lz4 {dir}/*_Packages.zst; do
+    [ -f "$f" ] || continue
+    echo "{marker}: ${{f##*/}}"; echo
+    case "$f" in
+        *_Packages) cat "$f" ;;
+        *.gz) gzip -dc "$f" ;;
+        *.xz) xz -dc "$f" ;;
+        *) /usr/lib/apt/apt-helper cat-file "$f" ;;
+    esac || exit 1
+    echo
+done
+""".format(dir=APT_LISTS_DIR, marker=_APT_LIST_MARKER_FIELD)
+
+# Line starting PGP signature of a signed deb822 file (e.g. InRelease)
+_PGP_SIGNATURE_START = '-----BEGIN PGP SIGNATURE-----'
+
+# deb822 tokens (see iter_deb822_paragraphs): paragraphs are separated by
+# blank lines, and a field is a "tag: value" line followed by any
+# continuation lines (which begin with a space).  Fields are matched
+# starting from the preceding new line, since a literal prefix lets the
+# regex engine skip quickly to the candidate positions
+_RE_DEB822_PARAGRAPH_SEP = re.compile(r'\n(?:[ \t\r]*\n)+')
+_DEB822_FIELD_PATTERN = r'''
+    \n(?P<tag>%s):[ \t]*           # Tag - begins at start of line
+    (?P<val>.*)                     # Value - till the end of the line
+    (?P<cont>(?:\n[ \t]+\S.*)*)     # Continuation lines
+'''
+_DEB822_ANY_TAG = '[a-zA-Z][^:\n]*'
+# Compiled _DEB822_FIELD_PATTERN per (frozen)set of fields to match, None
+# for all fields (see _get_deb822_field_re)
+_DEB822_FIELD_RES = {}
+_RE_DEB822_CONTINUATION = re.compile(r'\n[ \t]+')
+
+# Field of the marker paragraphs which separate release files in the dump
+# produced by APT_RELEASE_HEADERS_DUMP_SCRIPT
+_RELEASE_FILE_MARKER_FIELD = 'Niceman-Release-File'
+
+# Shell script to dump only the headers of the release files passed as
+# arguments (fields up to the first blank line or PGP signature, without
+# the lists of files), each one preceded by a marker paragraph.  Missing
+# files are skipped.
+APT_RELEASE_HEADERS_DUMP_SCRIPT = """
+for f in "$@"; do
+    [ -f "$f" ] || continue
+    echo "{marker}: $f"; echo
+    awk '
+        NR == 1 && /^-----BEGIN PGP SIGNED MESSAGE/ {{ armor = 1; next }}
+        armor {{ if ($0 ~ /^[ \t\r]*$/) armor = 0; next }}
+        /^-----BEGIN PGP SIGNATURE/ || /^[ \t\r]*$/ {{ exit }}
+        /^[ \t]/ {{ next }}
+        {{ print }}
+    ' "$f" || exit 1
+    echo
+done
+""".format(marker=_RELEASE_FILE_MARKER_FIELD)
+
+# To split "Source: name (version)" field
+_RE_SOURCE_FIELD = re.compile(r"""
+    ^(?P<source_name>[^ ]+)                # source name before any space
+    ([^(]*\((?P<source_version>[^)]+)\))?  # source version in parentheses
+""", flags=re.VERBOSE)
+
+# apt-cache policy lines: package header (name or name:arch followed by ":"),
+# version in the version table (after "***" for the installed one), and a
+# source in the "Package files:" section
+_RE_POLICY_PKG = re.compile(
+    r'(?P<name>[^\s:]+):((?P<architecture>\S+):)?\s*$')
+_RE_POLICY_VERSION = re.compile(
+    r'((?P<installed>\*\*\*)\s+)?(?P<version>\S+)\s+(?P<priority>\S+)')
+_RE_POLICY_SOURCE = re.compile(r' +(?P<priority>-?[0-9]+) +(?P<source>.*)$')
+# To split the source into archive URI and suite (up to the first "/")
+_RE_POLICY_SOURCE_LINE = re.compile(
+    r'(?P<archive_uri>\S+)( (?P<uri_suite>[^/]+))?')
+# A tag of the release line is a single letter followed by "=", and the
+# value includes any non commas, or commas not followed by another tag
+_RE_POLICY_RELEASE_ATTRIB = re.compile(
+    r'(?P<tag>[a-z])=(?P<value>([^,]|(,(?![a-z]=)))*)')
+# The release line has a terse tag=value format. This maps the release tags
+# to more meaningful values
+_POLICY_RELEASE_TAGS = {"c": "component",
+                        "n": "codename",
+                        "a": "archive",
+                        "b": "architecture",
+                        "o": "origin",
+                        "l": "label"}
+
+# Fields to query from dpkg-query -W (see parse_dpkg_query_output)
+DPKG_QUERY_FORMAT = '\\t'.join([
+    '${binary:Package}', '${Package}', '${Architecture}', '${Version}',
+    '${source:Package}', '${source:Version}']) + '\\n'
+
 
 @attr.s
 class DebianReleaseSpec(object):
@@ -51,58 +160,238 @@ class DebianReleaseSpec(object):
 def get_spec_from_release_file(content):
     """Provide specification object describing the component of the distribution
     """
-    # RegExp to pull a single line "tag: value" pair from a deb822 file
-    re_deb822_single_line_tag = re.compile("""
-        ^(?P<tag>[a-zA-Z][^:]*):[\ ]+  # Tag - begins at start of line
-        (?P<val>\S.*)$           # Value - after colon to the end of the line
-    """, flags=re.VERBOSE + re.MULTILINE)
+    # Parse the content (up to the PGP signature if present) for tags and
+    # values into a dictionary
+    release = {}
+    for paragraph in iter_deb822_paragraphs(content):
+        release.update(paragraph)
+    return get_spec_from_release_fields(release)
 
-    # Split before PGP signature if present
-    content = content.split("-----BEGIN PGP SIGNATURE-----")[0]
 
-    # Parse the content for tags and values into a dictionary
-    release = {
-        match.group("tag"): match.group("val")
-        for match in re_deb822_single_line_tag.finditer(content)
-    }
+def get_spec_from_release_fields(release):
+    """Provide specification object given fields of a release file
 
+    Parameters
+    ----------
+    release : dict
+      lower-cased tag -> value, as provided by iter_deb822_paragraphs
+    """
     # TODO: redo with conversions of components and architectures in into lists
     # and date in machine-readable presentation
     return DebianReleaseSpec(**{
-        a.name: release.get(a.name.title(), None)
+        a.name: release.get(a.name, None)
         for a in attr.fields(DebianReleaseSpec)
         })
 
 
-def parse_apt_cache_show_pkgs_output(output):
+def get_release_files_headers(output):
+    """Parse the dump produced by APT_RELEASE_HEADERS_DUMP_SCRIPT
+
+    Parameters
+    ----------
+    output : str or iterable of str
+
+    Returns
+    -------
+    dict
+      release file name -> dict of lower-cased tag -> value
+    """
+    marker = _RELEASE_FILE_MARKER_FIELD.lower()
+    headers = {}
+    current = None
+    for paragraph in iter_deb822_paragraphs(output):
+        if marker in paragraph:
+            current = headers[paragraph[marker]] = {}
+        elif current is not None:
+            current.update(paragraph)
+    return headers
+
+
+def _iter_deb822_chunks(lines):
+    """Group lines of deb822 content into chunks of paragraphs' text
+
+    Each chunk starts with a new line, as _DEB822_FIELD_PATTERN expects.
+    """
+    if isinstance(lines, string_types):
+        # Split the text in place, without going through individual lines
+        content = '\n' + lines
+        end = content.find(_PGP_SIGNATURE_START)
+        if end >= 0:
+            content = content[:end]
+        start = 0
+        for match in _RE_DEB822_PARAGRAPH_SEP.finditer(content):
+            yield content[start:match.start()]
+            start = match.end() - 1
+        yield content[start:]
+        return
+    chunk = ['']
+    for line in lines:
+        if not line or line.isspace():
+            if len(chunk) > 1:
+                yield '\n'.join(chunk)
+                chunk = ['']
+            continue
+        if line.startswith(_PGP_SIGNATURE_START):
+            break
+        chunk.append(line.rstrip('\r\n'))
+    if len(chunk) > 1:
+        yield '\n'.join(chunk)
+
+
+def iter_deb822_paragraphs(lines, fields=None):
+    """Iterate over paragraphs of deb822 formatted content
+
+    Paragraphs are tokenized in a single pass with precompiled regular
+    expressions and yielded as soon as they are complete, so it could be
+    used on files or other streams of arbitrary size.  Continuation lines
+    of multi-line fields (e.g. Description) are appended to the value of
+    the field, separated by new lines.  Comments and lines of PGP armor are
+    skipped, and tokenizing stops at the PGP signature.
+
+    Parameters
+    ----------
+    lines : str or iterable of str
+    fields : collection of str, optional
+      Lower-cased tags of the fields to collect.  Other fields are skipped
+      along with their continuation lines.  All fields are collected if
+      not specified.
+
+    Yields
+    ------
+    dict
+      lower-cased tag -> value
+    """
+    re_field = _get_deb822_field_re(fields)
+    join_cont = _join_deb822_continuation
+    for chunk in _iter_deb822_chunks(lines):
+        paragraph = {
+            tag.lower(): (val + join_cont(cont) if val else join_cont(cont)[1:])
+            if cont else val
+            for tag, val, cont in re_field.findall(chunk)}
+        if paragraph:
+            yield paragraph
+
+
+def _get_deb822_field_re(fields=None):
+    """Return compiled regular expression to match the fields
+
+    Regular expressions are compiled once per set of fields, so unneeded
+    fields are skipped by the regex engine itself.
+    """
+    key = frozenset(fields) if fields is not None else None
+    re_field = _DEB822_FIELD_RES.get(key)
+    if re_field is None:
+        if key is None:
+            tag = _DEB822_ANY_TAG
+        else:
+            # Tags are case-insensitive, but re.IGNORECASE would slow down
+            # matching considerably
+            tag = '|'.join(
+                ''.join('[%s%s]' % (c.upper(), c) if c.isalpha()
+                        else re.escape(c) for c in f)
+                for f in sorted(key))
+        re_field = _DEB822_FIELD_RES[key] = re.compile(
+            _DEB822_FIELD_PATTERN % tag, flags=re.VERBOSE)
+    return re_field
+
+
+def _join_deb822_continuation(cont):
+    return _RE_DEB822_CONTINUATION.sub('\n', cont)
+
+
+def parse_source_field(source):
+    """Split value of the "Source" field into source_name and source_version
+
+    source_version is provided only if specified in the field.
+    """
+    match = _RE_SOURCE_FIELD.match(source)
+    if not match:
+        return {}
+    return {k: v for k, v in match.groupdict().items() if v}
+
+
+# Fields of the Packages lists paragraphs needed by get_apt_lists_index
+_APT_LISTS_INDEX_FIELDS = frozenset([
+    _APT_LIST_MARKER_FIELD.lower(), 'package', 'architecture', 'version',
+    'source', 'size', 'md5sum', 'sha1', 'sha256'])
+
+
+def get_apt_lists_index(lines):
+    """Index packages available from the apt Packages lists
+
+    Parameters
+    ----------
+    lines : str or iterable of str
+      Dump of the lists as produced by APT_LISTS_DUMP_SCRIPT
+
+    Returns
+    -------
+    list_files, index
+      list_files is a list of names of the dumped lists (without
+      compression suffixes), and index is a dict
+      (name, architecture) -> {version: details}, where details is a dict
+      with size, md5, sha1, sha256, source_name and source_version (those
+      which are known) and "lists" -- the names of the lists which provide
+      that version.
+    """
+    marker = _APT_LIST_MARKER_FIELD.lower()
+    list_files = []
+    current_list = None
+    index = defaultdict(dict)
+    for paragraph in iter_deb822_paragraphs(lines, _APT_LISTS_INDEX_FIELDS):
+        if marker in paragraph:
+            current_list = re.sub(r'_Packages\.[^_]+$', '_Packages',
+                                  paragraph[marker])
+            list_files.append(current_list)
+            continue
+        if "package" not in paragraph:
+            continue
+        versions = index[(paragraph["package"],
+                          paragraph.get("architecture"))]
+        version = paragraph.get("version")
+        details = versions.get(version)
+        if details is None:
+            details = versions[version] = {"lists": []}
+            for tag, field in (("size", "size"), ("md5sum", "md5"),
+                               ("sha1", "sha1"), ("sha256", "sha256")):
+                if tag in paragraph:
+                    details[field] = paragraph[tag]
+            if "source" in paragraph:
+                details.update(parse_source_field(paragraph["source"]))
+        if current_list and current_list not in details["lists"]:
+            details["lists"].append(current_list)
+    return list_files, dict(index)
+
+
+def parse_apt_cache_show_pkgs_output(output, fields=None):
+    """Parse deb822 records of packages (e.g. apt-cache show output)
+
+    Parameters
+    ----------
+    output : str or iterable of str
+    fields : collection of str, optional
+      Lower-cased tags of the fields to collect (see
+      iter_deb822_paragraphs).  "package" is always collected.  Only
+      parsing a few fields is faster than parsing them all, so callers
+      should specify those they need.
+
+    Returns
+    -------
+    list of dict
+      Fields of the package records with lower-cased tags, with "Source"
+      split into source_name and source_version and "MD5sum" provided
+      as md5.
+    """
+    if fields is not None:
+        fields = set(fields) | {"package"}
     package_info = []
-    # Split into entries (one per package)
-    entries = filter(bool, re.split('\n(?=Package:)', output,
-                                    flags=re.MULTILINE))
-
-    # RegExp to pull a single line "tag: value" pair from a deb822 file
-    re_deb822_single_line_tag = re.compile("""
-        ^(?P<tag>[a-zA-Z][^:]*):[\ ]+  # Tag - begins at start of line
-        (?P<val>\S.*)$           # Value - after colon to the end of the line
-    """, flags=re.VERBOSE + re.MULTILINE)
-    # RegExp to split source into source and version
-    re_source = re.compile("""
-        ^(?P<source_name>[^ ]+)                # source name before any space
-        ([^(]*\((?P<source_version>[^)]+)\))?  # source version in parentheses
-    """, flags=re.VERBOSE)
-
-    # For each package entry, collect single line tag/value pairs into a
-    # dictionary
-    for entry in entries:
-        pkg = {
-           match.group("tag").lower(): match.group("val")
-           for match in re_deb822_single_line_tag.finditer(entry)
-        }
+    for pkg in iter_deb822_paragraphs(output, fields):
         # Process the package if one was found
         if "package" in pkg:
             # Parse source line to get source version (if present)
             if "source" in pkg:
-                for match in re_source.finditer(pkg["source"]):
+                match = _RE_SOURCE_FIELD.match(pkg["source"])
+                if match:
                     pkg["source_name"] = match.group("source_name")
                     pkg["source_version"] = match.group("source_version")
             # Move md5sum to md5
@@ -112,124 +401,303 @@ def parse_apt_cache_show_pkgs_output(output):
     return package_info
 
 
+def parse_depends_field(depends):
+    """Return names of packages in a Depends-like field of a package
+
+    Version restrictions and architecture qualifiers are dropped, and all
+    the alternatives are included, e.g. "libc6 (>= 2.14), debconf |
+    debconf-2.0, python3:any" gives {"libc6", "debconf", "debconf-2.0",
+    "python3"}.
+    """
+    names = set()
+    for relation in depends.split(","):
+        for alternative in relation.split("|"):
+            name = alternative.split("(", 1)[0].split("[", 1)[0].strip()
+            if name:
+                names.add(name.split(":", 1)[0])
+    return names
+
+
+def order_by_dependencies(names, depends):
+    """Order package names so that their dependencies come first
+
+    Parameters
+    ----------
+    names : list of str
+    depends : dict
+      name -> collection of names of the packages it depends on.  Only the
+      dependencies among `names` are considered.
+
+    Returns
+    -------
+    list of str
+      The names, in their original order unless a package needs to be moved
+      after its dependencies.  Dependency cycles are broken arbitrarily.
+    """
+    known = set(names)
+    ordered = []
+    seen = set()
+    for root in names:
+        if root in seen:
+            continue
+        seen.add(root)
+        # depth-first, without recursion since chains could be long
+        stack = [(root, iter(sorted(depends.get(root, ()))))]
+        while stack:
+            name, deps = stack[-1]
+            for dep in deps:
+                if dep in known and dep not in seen:
+                    seen.add(dep)
+                    stack.append((dep, iter(sorted(depends.get(dep, ())))))
+                    break
+            else:
+                stack.pop()
+                ordered.append(name)
+    return ordered
+
+
+def parse_dpkg_list_files_output(output):
+    """Parse a dump of the dpkg database *.list files
+
+    The dump is expected in the "grep -H" format, i.e. each line is
+    "/var/lib/dpkg/info/<package>.list:<path>", where <package> is either
+    "name" or "name:arch" (for Multi-Arch: same packages), exactly as
+    dpkg-query -S would report it.
+
+    Returns
+    -------
+    dict
+      package -> list of paths installed by the package
+    """
+    pkg_files = defaultdict(list)
+    for line in output.splitlines():
+        list_file, sep, path = line.partition('.list:')
+        if not (sep and path):
+            lgr.debug("Skipping line %s", line)
+            continue
+        pkg_files[list_file.rsplit('/', 1)[-1]].append(path)
+    return dict(pkg_files)
+
+
+def parse_dpkg_query_output(output):
+    """Parse output of dpkg-query -W -f=DPKG_QUERY_FORMAT
+
+    Records are provided in the same form as parse_apt_cache_show_pkgs_output
+    provides them, i.e. source_name and source_version are present only if
+    they differ from the binary package name and version.
+    """
+    package_info = []
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 6:
+            lgr.debug("Skipping line %s", line)
+            continue
+        _, name, architecture, version, source_name, source_version = fields
+        if not version:
+            # known to dpkg but not installed
+            continue
+        pkg = {"package": name,
+               "architecture": architecture,
+               "version": version}
+        if source_name and source_name != name:
+            pkg["source_name"] = source_name
+        if source_version and source_version != version:
+            pkg["source_version"] = source_version
+        package_info.append(pkg)
+    return package_info
+
+
+def get_installed_pkgs_from_dpkg_status(content):
+    """Return packages which (could) have files installed per dpkg status
+
+    Packages are returned both as "name" and "name:arch" so they could be
+    matched against names of the .list files in the dpkg database.
+    Packages which are not installed or have only config files left are
+    skipped.
+    """
+    installed = set()
+    for pkg in iter_deb822_paragraphs(
+            content, fields=('package', 'architecture', 'status')):
+        if "package" not in pkg:
+            continue
+        state = pkg.get("status", "").split()
+        if not state or state[-1] in ("not-installed", "config-files"):
+            continue
+        installed.add(pkg["package"])
+        if "architecture" in pkg:
+            installed.add("%(package)s:%(architecture)s" % pkg)
+    return installed
+
+
+def _iter_lines(output):
+    """Iterate over lines (without line endings) of a string or a stream"""
+    if isinstance(output, string_types):
+        output = output.splitlines()
+    for line in output:
+        yield line.rstrip('\r\n')
+
+
 def parse_apt_cache_policy_pkgs_output(output):
-    # findall wasn't greedy enough for some reason, so decided first to
-    # split into entries (one per package)
-    entries = filter(bool, re.split('\n(?=\S)', output, flags=re.MULTILINE))
-    # now we need to parse/match each entry
-    re_pkg = re.compile("""
-        ^(?P<name>[^\s:]+):((?P<architecture>\S+):)?\s*\n  # package name
-        \s+Installed:\s*(?P<installed>\S*)\s*\n    # Installed version
-        \s+Candidate:\s*(?P<candidate>\S*)\s*\n    # Candidate version
-        \s+Version\stable:[^\n]*
-        (?P<version_table>(\n\s.*)+)
-        """, flags=re.VERBOSE)
-
-    re_versions = re.compile("""
-        ^(\s{5}|\s(?P<installed>\*\*\*)\s)
-        (?P<version>\S+)\s+
-        (?P<priority>\S+)\n.*
-        (?P<sources>(\n\s{8}.*)+)
-    """, flags=re.VERBOSE + re.MULTILINE)
-    re_source = re.compile("""
-        ^\s{8}(?P<priority>\S+)\s+
-        (?P<source>.*)$
-    """, flags=re.VERBOSE + re.MULTILINE)
+    """Parse output of apt-cache policy for packages
+
+    Output is consumed one line at a time, so it could be fed with lines
+    of the output while the command is still producing them.
+
+    Parameters
+    ----------
+    output : str or iterable of str
+
+    Returns
+    -------
+    dict
+      package name -> dict with architecture, installed, candidate and
+      versions -- a list of dicts with installed ("***" for the installed
+      version), version, priority and sources (a list of dicts with
+      priority and source).
+    """
     pkgs = {}
-    for entry in entries:
-        match = re_pkg.match(entry.strip())
-        if not match:
-            lgr.warning("FAILED in %s " % entry)
+    name = info = version = None
+    for line in _iter_lines(output):
+        if not line.strip():
             continue
-        info = match.groupdict()
-        pkgs[info.pop('name')] = info
-        info['versions'] = []
-        for version in re_versions.finditer(info.pop('version_table')):
-            version_dict = version.groupdict()
-            version_dict["sources"] = [
-                source.groupdict()
-                for source in re_source.finditer(version.group("sources"))
-                ]
-            info['versions'].append(version_dict)
-        # process version_table
+        stripped = line.lstrip(' ')
+        indent = len(line) - len(stripped)
+        if not indent:
+            # Header of a new package entry, e.g. "name:" or "name:arch:"
+            if info is not None:
+                _add_apt_cache_policy_pkg(pkgs, name, info)
+            match = _RE_POLICY_PKG.match(line)
+            if not match:
+                lgr.warning("Unexpected apt-cache policy line %s" % line)
+                name = info = version = None
+                continue
+            name = match.group("name")
+            info = {"architecture": match.group("architecture"),
+                    "versions": []}
+            version = None
+        elif info is None:
+            continue  # within entry we could not parse
+        elif indent >= 8:
+            # A source of the version
+            if version is not None:
+                priority, _, source = stripped.partition(' ')
+                version["sources"].append(
+                    {"priority": priority, "source": source.strip()})
+        elif indent == 2:
+            # Installed:, Candidate:, Version table:, Package pin: ...
+            tag, _, val = stripped.partition(':')
+            if tag in ("Installed", "Candidate"):
+                info[tag.lower()] = val.strip()
+        else:
+            # A version in the version table
+            match = _RE_POLICY_VERSION.match(stripped)
+            if not match:
+                lgr.warning("Unexpected apt-cache policy line %s" % line)
+                version = None
+                continue
+            version = match.groupdict()
+            version["sources"] = []
+            info["versions"].append(version)
+    if info is not None:
+        _add_apt_cache_policy_pkg(pkgs, name, info)
     return pkgs
-    #for pkg_match in re_pkg.finditer(output):
-    #    print type(pkg_match), pkg_match.groupdict()
+
+
+def _add_apt_cache_policy_pkg(pkgs, name, info):
+    if "installed" not in info or "candidate" not in info:
+        lgr.warning("No installed or candidate version for %s in "
+                    "apt-cache policy output" % name)
+        return
+    pkgs[name] = info
 
 
 def parse_apt_cache_policy_source_info(policy_output):
+    """Parse information about sources from apt-cache policy output
+
+    Output is consumed one line at a time, so it could be fed with lines
+    of the output while the command is still producing them.
+
+    Parameters
+    ----------
+    policy_output : str or iterable of str
+      Output of apt-cache policy without arguments
+
+    Returns
+    -------
+    dict
+      source line -> dict with site, archive_uri, uri_suite and the
+      attributes from the release line (component, codename, archive,
+      architecture, origin, label) which are present.
+    """
     source_info = {}
-    re_section = re.compile("""
-        ^(?P<header_line>\S.*)$[\r\n]*  # Header - non whitespace at the
-                                        #          beginning of the line
-        (?P<body>(^\ .*$[\r\n]*)*)      # Body - All subsequent lines that
-                                        #        begin with a space
-        """, flags=re.VERBOSE + re.MULTILINE)
-    re_source = re.compile("""
-        ^(\ (?P<priority>[0-9]+)\ +(?P<source>.*)$[\r\n]+
-         (^(
-            (\ \ +release\ +(?P<release_info>.*))|
-            (\ \ +origin\ +(?P<origin_info>.*))|
-            (\ \ .*)
-           )$[\r\n]+
-          )*
-        )
-        """, flags=re.VERBOSE + re.MULTILINE)
-    re_rel_attrib = re.compile("""
-        (?P<tag>[a-z])=    # A tag is a single letter followed by "="
-        (?P<value>([^,]|(,(?![a-z]=)))*)
-                           # The value follows the "=", and include any
-                           # non commas, or commas not followed by another tag
-        """, flags=re.VERBOSE)
-    re_source_line = re.compile("""
-        (?P<archive_uri>\S+)        # Archive URI up to the first " "
-        (\ (?P<uri_suite>[^/]+))?   # The suite goes up to the first "/"
-        """, flags=re.VERBOSE)
-    # The release line has a terse tag=value format. This maps
-    # the release tags to more meaningful values
-    tag_map = {"c": "component",
-               "n": "codename",
-               "a": "archive",
-               "b": "architecture",
-               "o": "origin",
-               "l": "label"}
-
-    sections = re_section.finditer(policy_output)
-    for section in sections:
-        if section.group("header_line").startswith("Package files:"):
-            sources = re_source.finditer(section.group("body"))
-            for source in sources:
-                info = source.groupdict()
-                if info.get("source"):
-                    src_detail = dict()
-                    src_detail["site"] = info.get("origin_info")
-                    match = re_source_line.search(info.get("source"))
-                    if match:
-                        match = match.groupdict()
-                        src_detail["archive_uri"] = match["archive_uri"]
-                        src_detail["uri_suite"] = match["uri_suite"]
-                    else:
-                        lgr.warning("Unexpected source line %s" %
-                                    info.get("source"))
-                    release_info = info.get("release_info")
-                    if release_info:
-                        attribs = re_rel_attrib.finditer(release_info)
-                        for attrib in attribs:
-                            if attrib.group("tag") in tag_map:
-                                src_detail[tag_map[attrib.group("tag")]] = \
-                                    attrib.group("value")
-                    source_info[info.get("source")] = src_detail
+    in_package_files = False
+    src_detail = None
+    for line in _iter_lines(policy_output):
+        if not line.strip():
+            continue
+        if not line.startswith(' '):
+            # Header of a section
+            in_package_files = line.startswith("Package files:")
+            src_detail = None
+            continue
+        if not in_package_files:
+            continue
+        match = _RE_POLICY_SOURCE.match(line)
+        if match:
+            source = match.group("source")
+            src_detail = source_info[source] = {"site": None}
+            match = _RE_POLICY_SOURCE_LINE.match(source)
+            if match:
+                src_detail.update(match.groupdict())
+            else:
+                lgr.warning("Unexpected source line %s" % source)
+            continue
+        if src_detail is None:
+            continue
+        tag, _, val = line.strip().partition(' ')
+        if tag == "release":
+            for attrib in _RE_POLICY_RELEASE_ATTRIB.finditer(val):
+                if attrib.group("tag") in _POLICY_RELEASE_TAGS:
+                    src_detail[_POLICY_RELEASE_TAGS[attrib.group("tag")]] = \
+                        attrib.group("value")
+        elif tag == "origin":
+            src_detail["site"] = val.strip()
     return source_info
 
 
+def _get_apt_list_prefix(url):
+    """Convert archive URI into the prefix apt uses for its lists files"""
+    url = url.strip("/")                  # Remove any trailing /
+    url = re.sub("^[a-z+]+://", "", url)  # Remove leading http:// etc
+    url = url.replace("file:/", "_")      # file:/ is converted to single _
+    url = url.replace("/", "_")           # Any other / becomes _
+    return url
+
+
 def get_apt_release_file_names(url, url_suite):
-    url = url.strip("/")              # Remove any trailing /
-    url = url.replace("http://", "")  # Remove leading http://
-    url = url.replace("file:/", "_")  # file:/ is converted to single _
-    url = url.replace("/", "_")       # Any other / becomes _
+    url = _get_apt_list_prefix(url)
     if url_suite:
         filename = url + "_dists_" + url_suite
     else:
         filename = url
     return ["/var/lib/apt/lists/" + filename + "_Release",
             "/var/lib/apt/lists/" + filename + "_InRelease"]
+
+
+def get_apt_packages_list_name(source):
+    """Return name of the apt list file for a source of apt-cache policy
+
+    E.g. "http://deb.debian.org/debian stretch/main amd64 Packages" is
+    stored in "deb.debian.org_debian_dists_stretch_main_binary-amd64_Packages".
+
+    Returns None if the source is not a "Packages" source of a regular
+    (non-flat) repository.
+    """
+    parts = source.split()
+    if len(parts) != 4 or parts[3] != "Packages" or "/" not in parts[1]:
+        return None
+    uri, dist_component, architecture, _ = parts
+    dist, component = dist_component.rsplit("/", 1)
+    return "%s_dists_%s_%s_binary-%s_Packages" % (
+        _get_apt_list_prefix(uri), dist.replace("/", "_"), component,
+        architecture)
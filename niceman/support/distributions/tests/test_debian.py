@@ -10,11 +10,21 @@
 
 """
 
+import logging
+import re
+import timeit
+
+import pytest
+
 from ..debian import DebianReleaseSpec
 from ..debian import get_spec_from_release_file
+from ..debian import parse_depends_field
+from ..debian import order_by_dependencies
 
 from niceman.tests.utils import eq_, assert_is_subset_recur
 
+lgr = logging.getLogger('niceman.tests')
+
 
 def test_get_spec_from_release_file(f=None):
     content = """\
@@ -53,6 +63,86 @@ JZ0An0Uoocusvjco1t6RAwxt/y3lQoWV
         ))
 
 
+def test_get_release_files_headers(tmpdir):
+    import subprocess
+    from ..debian import APT_RELEASE_HEADERS_DUMP_SCRIPT
+    from ..debian import get_release_files_headers
+    release = tmpdir.join('Release')
+    release.write("""\
+Origin: Debian
+Codename: stretch
+Date: Sat, 14 Oct 2017 10:24:26 UTC
+MD5Sum:
+ d9650396c56a6f9521d0bbd9f719efbe 482669 main/binary-i386/Packages
+Acquire-By-Hash: yes
+""")
+    inrelease = tmpdir.join('InRelease')
+    inrelease.write("""\
+-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA256
+
+Origin: NeuroDebian
+Date: Thu, 15 Sep 2016 01:30:57 UTC
+-----BEGIN PGP SIGNATURE-----
+Version: GnuPG v2
+
+iEYEAREIAAYFAlfZ+dEACgkQpdMvASZJpamBowCfXOPQimiIy2wnVY5U9sLs1jSn
+-----END PGP SIGNATURE-----
+""")
+    out = subprocess.check_output(
+        ['sh', '-c', APT_RELEASE_HEADERS_DUMP_SCRIPT, 'sh', str(release),
+         str(inrelease), str(tmpdir.join('missing'))],
+        universal_newlines=True)
+    assert get_release_files_headers(out) == {
+        # lists of files are not dumped
+        str(release): {'origin': 'Debian', 'codename': 'stretch',
+                       'date': 'Sat, 14 Oct 2017 10:24:26 UTC',
+                       'md5sum': '', 'acquire-by-hash': 'yes'},
+        str(inrelease): {'origin': 'NeuroDebian',
+                         'date': 'Thu, 15 Sep 2016 01:30:57 UTC'},
+    }
+
+
+def test_iter_deb822_paragraphs():
+    from ..debian import iter_deb822_paragraphs
+    txt = """\
+# comment
+Package: openssl
+Conffiles:
+ /etc/ssl/openssl.cnf 7df26c55291b33344dc15e3935dabaf3
+Description: Secure Sockets Layer toolkit
+ This package is part of the OpenSSL project.
+ .
+ Package: not-a-field
+Version: 1.0.2g-1
+
+ \t
+Package: alienblaster
+Version: 1.1.0-9
+-----BEGIN PGP SIGNATURE-----
+Package: signature
+"""
+    expected = [
+        {'package': 'openssl',
+         'conffiles': '/etc/ssl/openssl.cnf 7df26c55291b33344dc15e3935dabaf3',
+         'description': 'Secure Sockets Layer toolkit\n'
+                        'This package is part of the OpenSSL project.\n'
+                        '.\n'
+                        'Package: not-a-field',
+         'version': '1.0.2g-1'},
+        {'package': 'alienblaster', 'version': '1.1.0-9'},
+    ]
+    assert list(iter_deb822_paragraphs(txt)) == expected
+    # lines could come from a stream, with line endings
+    assert list(iter_deb822_paragraphs(txt.splitlines(True))) == expected
+    # and paragraphs are provided as soon as they are complete
+    paragraphs = iter_deb822_paragraphs(iter(txt.splitlines()))
+    assert next(paragraphs) == expected[0]
+    # only requested fields are collected
+    assert list(iter_deb822_paragraphs(txt, fields={'package', 'foo'})) == \
+        [{'package': 'openssl'}, {'package': 'alienblaster'}]
+
+
 def test_parse_apt_cache_show_pkgs_output():
     from ..debian import parse_apt_cache_show_pkgs_output
     txt1 = """\
@@ -166,6 +256,156 @@ Origin: Ubuntu
     assert_is_subset_recur(out1, out, [dict, list])
 
 
+def _parse_apt_cache_show_pkgs_output_regex(output):
+    # Regex based parser niceman used before iter_deb822_paragraphs, as the
+    # reference for the benchmark
+    entries = filter(bool, re.split('\n(?=Package:)', output,
+                                    flags=re.MULTILINE))
+    re_deb822_single_line_tag = re.compile(r"""
+        ^(?P<tag>[a-zA-Z][^:]*):[\ ]+  # Tag - begins at start of line
+        (?P<val>\S.*)$           # Value - after colon to the end of the line
+    """, flags=re.VERBOSE + re.MULTILINE)
+    re_source = re.compile(r"""
+        ^(?P<source_name>[^ ]+)                # source name before any space
+        ([^(]*\((?P<source_version>[^)]+)\))?  # source version in parentheses
+    """, flags=re.VERBOSE)
+    package_info = []
+    for entry in entries:
+        pkg = {
+           match.group("tag").lower(): match.group("val")
+           for match in re_deb822_single_line_tag.finditer(entry)
+        }
+        if "package" in pkg:
+            if "source" in pkg:
+                for match in re_source.finditer(pkg["source"]):
+                    pkg["source_name"] = match.group("source_name")
+                    pkg["source_version"] = match.group("source_version")
+            pkg["md5"] = pkg.pop("md5sum", None)
+            package_info.append(pkg)
+    return package_info
+
+
+@pytest.mark.slow
+def test_parse_apt_cache_show_pkgs_output_benchmark():
+    from ..debian import parse_apt_cache_show_pkgs_output
+    entry = """\
+Package: pkg{i}
+Priority: optional
+Section: utils
+Installed-Size: 934
+Maintainer: Debian Developers <debian-devel@lists.debian.org>
+Architecture: amd64
+Source: src{i} (1.0.{i})
+Version: 1.0.{i}-1
+Depends: libc6 (>= 2.15), libssl1.0.0 (>= 1.0.2g)
+Filename: pool/main/p/pkg{i}/pkg{i}_1.0.{i}-1_amd64.deb
+Size: 492190
+MD5sum: 8280148dc2991da94be5810ad4d91552
+SHA1: b5326f27aae83c303ff934121dede47d9fce7c76
+SHA256: e897ffc8d84b0d436baca5dbd684a85146ffa78d3f2d15093779d3f5a8189690
+Description: Some package
+ This package is part of the benchmark of the deb822 parsers and
+ it has a multi-line description as most of the packages do.
+ .
+ It contains the general-purpose command line binary /usr/bin/pkg{i},
+ useful for many things.
+Description-md5: 9b6de2bb6e1d9016aeb0f00bcf6617bd
+
+"""
+    output = ''.join(entry.format(i=i) for i in range(10000))
+
+    def single_line_fields(pkg):
+        return {k: v.split('\n', 1)[0] for k, v in pkg.items()}
+
+    # (comparisons are not asserted directly to not get all the records
+    # reported on failure)
+    new = parse_apt_cache_show_pkgs_output(output)
+    old = _parse_apt_cache_show_pkgs_output_regex(output)
+    assert len(new) == 10000
+    same = [single_line_fields(p) for p in new] == old
+    assert same
+    # Typically only a few fields are needed, and others are skipped by
+    # the tokenizer
+    fields = ('architecture', 'version', 'source', 'size', 'md5sum')
+    keys = fields + ('package', 'md5', 'source_name', 'source_version')
+    same = parse_apt_cache_show_pkgs_output(output, fields) == [
+        {k: v for k, v in p.items() if k in keys} for p in new]
+    assert same
+
+    def best_time(f):
+        return min(timeit.repeat(f, number=1, repeat=3))
+
+    t_old = best_time(lambda: _parse_apt_cache_show_pkgs_output_regex(output))
+    t_all = best_time(lambda: parse_apt_cache_show_pkgs_output(output))
+    t_fields = best_time(
+        lambda: parse_apt_cache_show_pkgs_output(output, fields))
+    # Only getting a few fields is faster (about 2x), collecting all of them
+    # is about as fast as before.  Timings vary too much to be asserted on
+    lgr.info("regex based: %.3fs, all fields: %.3fs, %d fields: %.3fs",
+             t_old, t_all, len(fields), t_fields)
+
+
+def test_parse_dpkg_list_files_output():
+    from ..debian import parse_dpkg_list_files_output
+    txt = """\
+/var/lib/dpkg/info/dash.list:/.
+/var/lib/dpkg/info/dash.list:/bin/sh
+/var/lib/dpkg/info/zlib1g:amd64.list:/lib/x86_64-linux-gnu/libz.so.1.2.8
+/var/lib/dpkg/info/bogus.list:
+"""
+    assert parse_dpkg_list_files_output(txt) == {
+        'dash': ['/.', '/bin/sh'],
+        'zlib1g:amd64': ['/lib/x86_64-linux-gnu/libz.so.1.2.8'],
+    }
+
+
+def test_parse_dpkg_query_output():
+    from ..debian import parse_dpkg_query_output
+    txt = (
+        "zlib1g:i386\tzlib1g\ti386\t1:1.2.8.dfsg-5\tzlib\t1:1.2.8.dfsg-5\n"
+        "libssl1.0.0:amd64\tlibssl1.0.0\tamd64\t1.0.2g-1ubuntu4.5\t"
+        "openssl\t1.0.2g-1ubuntu4.5\n"
+        "libpython2.7\tlibpython2.7\tamd64\t2.7.12-1+b1\tpython2.7\t2.7.12-1\n"
+        "dpkg\tdpkg\tamd64\t1.18.24\tdpkg\t1.18.24\n"
+        "removed\tremoved\tamd64\t\t\t\n"
+        "garbage\n"
+    )
+    assert parse_dpkg_query_output(txt) == [
+        {'package': 'zlib1g', 'architecture': 'i386',
+         'version': '1:1.2.8.dfsg-5', 'source_name': 'zlib'},
+        {'package': 'libssl1.0.0', 'architecture': 'amd64',
+         'version': '1.0.2g-1ubuntu4.5', 'source_name': 'openssl'},
+        {'package': 'libpython2.7', 'architecture': 'amd64',
+         'version': '2.7.12-1+b1', 'source_name': 'python2.7',
+         'source_version': '2.7.12-1'},
+        {'package': 'dpkg', 'architecture': 'amd64', 'version': '1.18.24'},
+    ]
+
+
+def test_get_installed_pkgs_from_dpkg_status():
+    from ..debian import get_installed_pkgs_from_dpkg_status
+    txt = """\
+Package: dash
+Status: install ok installed
+Architecture: amd64
+
+Package: zlib1g
+Status: install ok unpacked
+Architecture: i386
+Multi-Arch: same
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+
+Package: purged
+Status: purge ok not-installed
+Architecture: amd64
+"""
+    assert get_installed_pkgs_from_dpkg_status(txt) == {
+        'dash', 'dash:amd64', 'zlib1g', 'zlib1g:i386'}
+
+
 def test_parse_apt_cache_policy_pkgs_output():
     from ..debian import parse_apt_cache_policy_pkgs_output
     txt1 = """\
@@ -340,6 +580,149 @@ Pinned packages:
     assert_is_subset_recur(out1, out, [dict])
 
 
+def test_parse_apt_cache_policy_streamed():
+    from ..debian import parse_apt_cache_policy_pkgs_output
+    from ..debian import parse_apt_cache_policy_source_info
+    consumed = []
+
+    def stream(txt):
+        # Provide lines one at a time, as a pipe would
+        for line in txt.splitlines(True):
+            consumed.append(line)
+            yield line
+
+    pkgs = """\
+broken:
+  Installed: 1.0
+  Version table:
+nipype:
+  Installed: 0.12.0-2
+  Candidate: 0.12.0-2
+  Package pin: 0.12.0-2
+  Version table:
+ *** 0.12.0-2 1001
+        500 http://neuro.debian.net/debian stretch/main amd64 Packages
+        100 /var/lib/dpkg/status
+"""
+    out = parse_apt_cache_policy_pkgs_output(stream(pkgs))
+    assert len(consumed) == len(pkgs.splitlines())
+    assert out == {
+        'nipype': {
+            'architecture': None,
+            'installed': '0.12.0-2',
+            'candidate': '0.12.0-2',
+            'versions': [
+                {'installed': '***', 'version': '0.12.0-2',
+                 'priority': '1001',
+                 'sources': [
+                     {'priority': '500',
+                      'source': 'http://neuro.debian.net/debian '
+                                'stretch/main amd64 Packages'},
+                     {'priority': '100', 'source': '/var/lib/dpkg/status'}]}
+            ]}}
+
+    policy = """\
+Package files:
+ 100 /var/lib/dpkg/status
+     release a=now
+ 500 http://neuro.debian.net/debian stretch/main amd64 Packages
+     release o=NeuroDebian,a=stretch,n=stretch,l=NeuroDebian,c=main,b=amd64
+     origin neuro.debian.net
+Pinned packages:
+     nipype -> 0.12.0-2 with priority 1001
+"""
+    out = parse_apt_cache_policy_source_info(stream(policy))
+    assert out == {
+        '/var/lib/dpkg/status': {
+            'site': None, 'archive_uri': '/var/lib/dpkg/status',
+            'uri_suite': None, 'archive': 'now'},
+        'http://neuro.debian.net/debian stretch/main amd64 Packages': {
+            'site': 'neuro.debian.net',
+            'archive_uri': 'http://neuro.debian.net/debian',
+            'uri_suite': 'stretch', 'origin': 'NeuroDebian',
+            'archive': 'stretch', 'codename': 'stretch',
+            'label': 'NeuroDebian', 'component': 'main',
+            'architecture': 'amd64'},
+    }
+
+
+def test_get_apt_lists_index():
+    from ..debian import get_apt_lists_index
+    txt = """\
+Niceman-Apt-List: deb.debian.org_debian_dists_sid_main_binary-amd64_Packages.lz4
+
+Package: openssl
+Source: openssl-src (1.0.2g)
+Version: 1.0.2g-1
+Architecture: amd64
+Size: 492190
+MD5sum: 8280148dc2991da94be5810ad4d91552
+SHA1: b5326f27aae83c303ff934121dede47d9fce7c76
+SHA256: e897ffc8d84b0d436baca5dbd684a85146ffa78d3f2d15093779d3f5a8189690
+Description: Secure Sockets Layer toolkit - cryptographic utility
+ Package: not-a-package
+ .
+ It contains the general-purpose command line binary /usr/bin/openssl
+
+Package: openssl
+Version: 1.0.2f-1
+Architecture: amd64
+
+Niceman-Apt-List: deb.debian.org_debian_dists_sid_main_binary-i386_Packages
+
+Niceman-Apt-List: neuro.debian.net_debian_dists_sid_main_binary-amd64_Packages
+
+Package: openssl
+Version: 1.0.2g-1
+Architecture: amd64
+Source: openssl-src (1.0.2g)
+Size: 492190
+"""
+    list_files, index = get_apt_lists_index(txt.splitlines(True))
+    assert list_files == [
+        'deb.debian.org_debian_dists_sid_main_binary-amd64_Packages',
+        'deb.debian.org_debian_dists_sid_main_binary-i386_Packages',
+        'neuro.debian.net_debian_dists_sid_main_binary-amd64_Packages',
+    ]
+    assert index == {
+        ('openssl', 'amd64'): {
+            '1.0.2g-1': {
+                'source_name': 'openssl-src',
+                'source_version': '1.0.2g',
+                'size': '492190',
+                'md5': '8280148dc2991da94be5810ad4d91552',
+                'sha1': 'b5326f27aae83c303ff934121dede47d9fce7c76',
+                'sha256': 'e897ffc8d84b0d436baca5dbd684a85146ffa78d3f2d15093779d3f5a8189690',
+                'lists': [
+                    'deb.debian.org_debian_dists_sid_main_binary-amd64_Packages',
+                    'neuro.debian.net_debian_dists_sid_main_binary-amd64_Packages'
+                ]},
+            '1.0.2f-1': {
+                'lists': [
+                    'deb.debian.org_debian_dists_sid_main_binary-amd64_Packages'
+                ]},
+        }
+    }
+
+
+def test_get_apt_packages_list_name():
+    from ..debian import get_apt_packages_list_name
+    assert get_apt_packages_list_name(
+        'http://us.archive.ubuntu.com/ubuntu xenial-updates/main amd64 Packages'
+    ) == 'us.archive.ubuntu.com_ubuntu_dists_xenial-updates_main_binary-amd64_Packages'
+    assert get_apt_packages_list_name(
+        'http://security.debian.org stretch/updates/main i386 Packages'
+    ) == 'security.debian.org_dists_stretch_updates_main_binary-i386_Packages'
+    assert get_apt_packages_list_name(
+        'https://debproxy:9999/debian/ jessie-backports/non-free amd64 Packages'
+    ) == 'debproxy:9999_debian_dists_jessie-backports_non-free_binary-amd64_Packages'
+    assert get_apt_packages_list_name('file:/my/repo ./ Packages') is None
+    assert get_apt_packages_list_name(
+        'http://debproxy:9999/debian/ jessie-backports/contrib Translation-en'
+    ) is None
+    assert get_apt_packages_list_name('/var/lib/dpkg/status') is None
+
+
 def test_get_apt_release_file_names():
     from ..debian import get_apt_release_file_names
     fn = get_apt_release_file_names('http://us.archive.ubuntu.com/ubuntu',
@@ -350,3 +733,18 @@ def test_get_apt_release_file_names():
     assert "/var/lib/apt/lists/_my_repo2_ubuntu_InRelease" in fn
     assert "/var/lib/apt/lists/_my_repo2_ubuntu_Release" in fn
 
+
+def test_parse_depends_field():
+    assert parse_depends_field(
+        "libc6 (>= 2.14), debconf (>= 0.5) | debconf-2.0, python3:any, "
+        "libfoo [amd64]") == \
+        {"libc6", "debconf", "debconf-2.0", "python3", "libfoo"}
+    assert parse_depends_field("") == set()
+
+
+def test_order_by_dependencies():
+    depends = {"a": {"b", "d"}, "b": {"c", "libc6"}, "c": {"a"}, "e": set()}
+    # cycle a -> b -> c -> a is broken where it was entered
+    assert order_by_dependencies(["a", "b", "c", "d", "e"], depends) == \
+        ["c", "b", "d", "a", "e"]
+    assert order_by_dependencies(["e", "d"], depends) == ["e", "d"]
@@ -45,6 +45,7 @@ from ..utils import _path_
 from ..utils import to_unicode
 from ..utils import generate_unique_name
 from ..utils import PathRoot, is_subpath
+from ..utils import intern_str
 
 from nose.tools import ok_, eq_, assert_false, assert_equal, assert_true
 
@@ -414,6 +415,19 @@ def test_generate_unique_set():
     assert(n == "test_1")
 
 
+def test_intern_str():
+    # built at runtime, so not interned by the compiler
+    a = ''.join(['1.2', '-3'])
+    b = ''.join(['1.2-', '3'])
+    assert a is not b
+    assert intern_str(a) is intern_str(b)
+    ua = u''.join([u'1.2', u'-3'])
+    ub = u''.join([u'1.2-', u'3'])
+    assert intern_str(ua) is intern_str(ub)
+    assert intern_str(None) is None
+    assert intern_str(1) == 1
+
+
 def test_hashable_dict():
     key_a = HashableDict({"a": 1, "b": "test"})
     key_b = HashableDict({"a": 1, "b": "test"})
@@ -462,6 +476,68 @@ def test_execute_command_batch():
         assert isinstance(err, ValueError)
 
 
+def test_execute_command_batch_concurrent():
+    import threading
+    import time
+
+    class DummySession(object):
+        concurrent_commands = True
+
+        def __init__(self):
+            self.threads = set()
+
+        def execute_command(self, cmd):
+            self.threads.add(threading.current_thread().name)
+            if "ValueError" in cmd:
+                raise ValueError
+            # let the later batches finish first
+            time.sleep(0.01 * (100 - int(cmd[-1])) / 25)
+            return (" ".join(cmd[1:]), None)
+
+    args = list(map(str, range(1, 101)))
+    session = DummySession()
+    outs = [out for out, _, _ in
+            execute_command_batch(session, ["echo"], args, jobs=4)]
+    # arguments are split so every worker gets a batch, results are ordered
+    assert outs == [" ".join(args[i:i + 25]) for i in range(0, 100, 25)]
+    assert len(session.threads) > 1
+    # or could be yielded as they come
+    outs = [out for out, _, _ in
+            execute_command_batch(session, ["echo"], args, jobs=4,
+                                  ordered=False)]
+    assert len(outs) == 4
+    assert sorted(" ".join(outs).split(), key=int) == args
+
+    # exceptions are handled the same way
+    with pytest.raises(ValueError):
+        list(execute_command_batch(session, ["ValueError"], args, jobs=4))
+    excs = [exc for _, _, exc in
+            execute_command_batch(session, ["ValueError"], args, jobs=4,
+                                  exception_filter=lambda x:
+                                  isinstance(x, ValueError))]
+    assert len(excs) == 4
+    assert all(isinstance(exc, ValueError) for exc in excs)
+
+    # Concurrency could be configured
+    session = DummySession()
+    with patch.dict('os.environ', {'NICEMAN_EXECUTE_BATCH_JOBS': '2'}):
+        from niceman import cfg
+        cfg.reload()
+        try:
+            outs = list(execute_command_batch(session, ["echo"], args))
+        finally:
+            cfg.remove_option('execute', 'batch jobs')
+    assert len(outs) == 2
+    assert threading.current_thread().name not in session.threads
+
+    # but sessions which do not declare it safe execute batches sequentially
+    session = DummySession()
+    session.concurrent_commands = False
+    outs = list(execute_command_batch(session, ["echo"], args, jobs=4))
+    assert len(outs) == 1
+    assert session.threads == {threading.current_thread().name}
+
+
 def test_pathroot():
     proot = PathRoot(lambda s: s.endswith("root"))
     assert proot("") is None
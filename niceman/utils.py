@@ -918,6 +918,24 @@ def to_binarystring(s, encoding="utf-8"):
         return s.encode(encoding=encoding)
 
 
+# Interned unicode strings which could not be interned by Python 2 itself
+_interned_strings = {}
+
+
+def intern_str(s):
+    """Return the shared instance of a string equal to `s`
+
+    So many equal strings (e.g. versions or architectures of many packages)
+    are kept in memory only once.  Anything but strings is returned as is.
+    """
+    if not isinstance(s, six.string_types):
+        return s
+    try:
+        return six.moves.intern(s)
+    except TypeError:  # unicode in Python 2
+        return _interned_strings.setdefault(s, s)
+
+
 def safe_write(ostream, s, encoding="utf-8"):
     """Safely write different string types to an output stream"""
     try:  # Try unicode, and upon failure try binary_string
@@ -1032,7 +1050,8 @@ def cmd_err_filter(err_string):
             err_string in to_unicode(x.stderr, "utf-8"))
 
 
-def execute_command_batch(session, command, args, exception_filter=None):
+def execute_command_batch(session, command, args, exception_filter=None,
+                          jobs=None, ordered=True):
     """
     Generator that executes session.execute_command, with batches of args
 
@@ -1052,6 +1071,15 @@ def execute_command_batch(session, command, args, exception_filter=None):
       The long list of additional arguments we wish to pass to the command
     exception_filter : func x -> bool
       A filter of exception types that the calling code will gracefully handle
+    jobs : int, optional
+      How many batches to execute concurrently.  Batches are executed
+      concurrently only if the session declares it safe (see
+      Session.concurrent_commands), and then arguments are split into at
+      least that many batches.  If not specified, "batch jobs" option of
+      the "execute" configuration section is used (1 by default).
+    ordered : bool, optional
+      If False, results of concurrently executed batches are yielded as soon
+      as they are available instead of in the order of the batches
 
     Returns
     -------
@@ -1060,22 +1088,51 @@ def execute_command_batch(session, command, args, exception_filter=None):
         that is in the list of expected exceptions
 
     """
+    args = list(args)  # we might get in with a set
+    if not args:
+        return
+    if jobs is None:
+        from niceman import cfg
+        jobs = cfg.get_as_dtype('execute', 'batch jobs', int, default=1)
+    if jobs > 1 and not getattr(session, 'concurrent_commands', False):
+        lgr.debug("Session %s does not support concurrent commands, "
+                  "executing batches of %s sequentially", session, command)
+        jobs = 1
     cmd_length = sum(map(len, command)) + len(command)
     num_args = get_cmd_batch_len(args, cmd_length)
-    args = list(args)  # we might get in with a set
-    while args:
-        batch, args = args[:num_args], args[num_args:]
+    if jobs > 1:
+        # Make sure that all the workers get some work
+        num_args = min(num_args, (len(args) + jobs - 1) // jobs)
+    batches = [args[i:i + num_args] for i in range(0, len(args), num_args)]
+
+    def execute_batch(batch):
         try:
-            out, err = session.execute_command(
-                command + batch
-            )
-            out = to_unicode(out, "utf-8")
-            yield (out, err, None)
-        except Exception as e:
-            if exception_filter and exception_filter(e):
-                yield (None, None, e)
+            out, err = session.execute_command(command + batch)
+            return to_unicode(out, "utf-8"), err, None
+        except Exception:
+            return None, None, sys.exc_info()
+
+    if jobs > 1 and len(batches) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(jobs, len(batches)))
+        imap = pool.imap if ordered else pool.imap_unordered
+        results = imap(execute_batch, batches)
+    else:
+        pool = None
+        results = (execute_batch(batch) for batch in batches)
+    try:
+        for out, err, exc_info in results:
+            if exc_info is None:
+                yield (out, err, None)
+            elif exception_filter and exception_filter(exc_info[1]):
+                yield (None, None, exc_info[1])
             else:
-                raise
+                six.reraise(*exc_info)
+    finally:
+        if pool is not None:
+            # do not start any pending batches if we did not get through
+            pool.terminate()
+            pool.join()
 
 
 def items_to_dict(l, attrs='name', ordered=False):
@@ -1195,6 +1252,20 @@ class PathRoot(object):
             path = os.path.dirname(path)
 
 
+def get_path_roots_candidates(paths):
+    """Return paths with all their parent directories
+
+    I.e. all the paths PathRoot could test to find roots of the paths.
+    """
+    candidates = set()
+    for path in paths:
+        for pth in PathRoot._walk_up(path):
+            if pth in candidates:
+                break  # and so are its parents
+            candidates.add(pth)
+    return candidates
+
+
 def is_subpath(path, directory):
     """Test whether `path` is below (or is itself) `directory`.
 